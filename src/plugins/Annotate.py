@@ -34,6 +34,10 @@ import pyflag.TableObj as TableObj
 import pyflag.TableActions as TableActions
 import pyflag.FileSystem as FileSystem
 
+## We add display hooks and operators to the ColumnTypes when we
+## are imported, so we must always be imported:
+eager = True
+
 class AnnotatedInode(FlagFramework.CaseTable):
     """ Annotation table - Annotates and categorizes Inodes """
     name = 'annotate'
@@ -21,5 +21,11 @@ class EpochTimestamp(TimestampType):
     def insert(self, value):
         return "_"+self.column, "from_unixtime(%r)" % value
 
+    def load_value(self, value):
+        return value
+
+    def load_set(self, variable):
+        return "from_unixtime(%s)" % variable
+
 ## Import the unit tests so they are picked up by the registry:
 from pyflag.ColumnTypes import ColumnTypeTests
@@ -44,6 +44,7 @@ import pyflag.pyflaglog as pyflaglog
 import os
 import pyflag.FlagFramework as FlagFramework
 import pyflag.Registry as Registry
+import pyflag.Time as Time
 from pyflag.ColumnTypes import StringType, TimestampType, InodeIDType, FilenameType, IntegerType, DeletedType, SetType, BigIntegerType
 
 config.add_option("SCHEMA_VERSION", default=3, absolute=True,
@@ -311,6 +312,13 @@ class DropCase(Farm.Task):
         pyflaglog.log(pyflaglog.INFO, "Resetting case %s in worker" % case)
         FlagFramework.post_event('reset', case)
 
+class CaseConfigChanged(Farm.Task):
+    """ Expires cached case parameters (e.g. the timezone) after the
+    case is reconfigured
+    """
+    def run(self, case, *args):
+        Time.flush_case_tz(case)
+
 class CaseDBInit(FlagFramework.EventHandler):
     """ A handler for creating common case tables """
     
@@ -333,22 +341,8 @@ class CaseDBInit(FlagFramework.EventHandler):
         KEY property(property),
         KEY joint(property,value(20)))""")
 
-        ## This is a transactional table for managing the cache
-        case_dbh.execute("""CREATE TABLE if not exists `sql_cache` (
-        `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY ,
-        `timestamp` TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL ,
-        `query` MEDIUMTEXT NOT NULL,
-        `limit` INT default 0,
-        `length` INT default 100,
-        `status` enum('progress','dirty','cached')
-        ) ENGINE=InnoDB""")
-
-        case_dbh.execute("""CREATE TABLE sql_cache_tables (
-        `sql_id` INT UNSIGNED,
-        `table_name` VARCHAR(250))""")
-
-        case_dbh.check_index("sql_cache_tables","sql_id")
-        case_dbh.check_index("sql_cache_tables","table_name")
+        ## This is used to invalidate cached table searches
+        DB.create_table_generations(case_dbh)
         
         case_dbh.execute("""CREATE TABLE if not exists `iosources` (
         `id` INT(11) not null auto_increment,
@@ -433,24 +427,14 @@ class CaseDBInit(FlagFramework.EventHandler):
         priority int default 10,
         when_valid TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL,
 	`cookie` INT(11) not null,
-	key `id`(id)
+        pid int default 0,
+        lease_id varchar(100) default NULL,
+        lease_expiry int unsigned default 0,
+	key `id`(id),
+        key `lease_id`(lease_id)
 	)""")
 
-        dbh.execute("""CREATE TABLE sql_cache_tables (
-        `sql_id` INT UNSIGNED,
-        `table_name` VARCHAR(250))""")
-
-        dbh.check_index("sql_cache_tables","sql_id")
-        dbh.check_index("sql_cache_tables","table_name")
-        
-        dbh.execute("""CREATE TABLE `sql_cache` (
-        `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY ,
-        `timestamp` TIMESTAMP ON UPDATE CURRENT_TIMESTAMP NOT NULL ,
-        `query` MEDIUMTEXT NOT NULL,
-        `limit` INT default 0,
-        `length` INT default 100,
-        `locked` INT default 1
-        ) ENGINE=InnoDB""")
+        DB.create_table_generations(dbh)
 
         dbh.execute("""CREATE TABLE `logs` (
         `timestamp` TIMESTAMP NOT NULL ,
@@ -465,16 +449,9 @@ class CaseDBInit(FlagFramework.EventHandler):
         print "Checking schema for compliance"
         ## Make sure that the schema conforms
         dbh = DB.DBO()
-        dbh.execute("select value from meta where property='flag_db'")
-        DB.check_column_in_table(None, 'sql_cache', 'status',
-                                 'enum("progress","dirty","cached")')
-        for row in dbh:
-            try:
-                DB.check_column_in_table(row['value'], 'sql_cache', 'status',
-                                         'enum("progress","dirty","cached")')
-            except: continue
 
         ## Check the schema:
+        DB.create_table_generations(dbh)
         dbh.check_index("jobs", "state")
         DB.check_column_in_table(None, 'jobs', 'priority', 'int default 10')
         DB.check_column_in_table(None, 'jobs', 'pid', 'int default 0')
@@ -488,6 +465,14 @@ class CaseDBInit(FlagFramework.EventHandler):
             dbh.execute("select * from high_priority_jobs limit 1")
         except:
             dbh.execute("create table if not exists high_priority_jobs like jobs")
+
+        ## Workers lease jobs (see Farm.claim_jobs):
+        for table in Farm.JOB_TABLES:
+            DB.check_column_in_table(None, table, 'lease_id',
+                                     'varchar(100) default NULL')
+            DB.check_column_in_table(None, table, 'lease_expiry',
+                                     'int unsigned default 0')
+            dbh.check_index(table, "lease_id")
         
         ## Schedule the first periodic task:
         task = Periodic()
@@ -500,6 +485,7 @@ class CaseDBInit(FlagFramework.EventHandler):
         Scanner.factories.flush()
         
     def reset(self, dbh, case):
+        Time.flush_case_tz(case)
         key_re = "%s.*" % case
         IO.IO_Cache.expire(key_re)
         DB.DBO.DBH.expire(key_re)
@@ -596,8 +582,14 @@ class CaseConfiguration(Reports.report):
                         prop)
             result.row(prop, query[prop])
 
-        ## Expire the parameters:
-        dbh.DBH.get(query['case']).parameter_flush()
+        ## Expire the parameters here and in the workers:
+        Time.flush_case_tz(query['case'])
+        DB.DBO().insert('jobs', command = "CaseConfigChanged", state='broadcast',
+                        arg1=query['case'], cookie=0, _fast = True)
+        try:
+            dbh.DBH.get(query['case']).parameter_flush()
+        except KeyError:
+            pass
 
 class PyFlagStatistics(Reports.report):
     """ Display statistics on the currently running pyflag
@@ -618,6 +610,12 @@ class PyFlagStatistics(Reports.report):
         cdbh.execute("select count(*) as count from inode")
         row = cdbh.fetch()
         result.row("Total Inodes in VFS", row['count'])
+
+        ## How well the statement cache works in this process:
+        stats = DB.statement_stats()
+        result.row("SQL statements parsed", stats['parsed'])
+        result.row("SQL statements reused", stats['reused'])
+        result.row("SQL statements cached", stats['cached'])
         result.link("Changelog", url="images/changelog.html")
         result.end_table()
 
@@ -627,5 +625,60 @@ class PyFlagStatistics(Reports.report):
         def info_cb(query,result):
             result.heading("PyFlag Plugins")
             result.text(FlagFramework.print_info(), font='typewriter')
-            
+
         result.toolbar(cb=info_cb, icon="question.png")
+
+class ScannerProfile(Reports.report):
+    """ Shows how long each scanner took to scan the case.
+
+    Workers record the time each scanner spends in its process, slack
+    and finish methods. The first table shows the totals for each
+    scanner (in milliseconds), most expensive first. The second shows
+    the counts of each worker (in microseconds).
+    """
+    family = "Case Management"
+    name = "Scanner Profile"
+
+    def form(self, query, result):
+        result.case_selector()
+
+    def display(self, query, result):
+        result.heading("Time taken by scanners in case %s" % query['case'])
+
+        ## Include what this process counted so far:
+        Scanner.PROFILE.flush(query['case'])
+        try:
+            rows = Scanner.profile_summary(query['case'])
+        except DB.DBError,e:
+            result.para("No scanners have been profiled in this case")
+            return
+
+        total = sum([ row['process_wall'] + row['slack_wall'] + row['finish_wall']
+                      for row in rows ]) or 1
+
+        result.row("Scanner", "Files", "Skipped", "Bytes", "Process", "(CPU)",
+                   "Slack", "(CPU)", "Finish", "(CPU)", "%", type='heading')
+        for row in rows:
+            wall = row['process_wall'] + row['slack_wall'] + row['finish_wall']
+            result.row(row['scanner'], row['files'], row['skipped'], row['bytes'],
+                       row['process_wall'] / 1000, row['process_cpu'] / 1000,
+                       row['slack_wall'] / 1000, row['slack_cpu'] / 1000,
+                       row['finish_wall'] / 1000, row['finish_cpu'] / 1000,
+                       "%.1f" % (100.0 * wall / total))
+        result.end_table()
+
+        result.heading("By worker")
+        result.table(
+            elements = [ StringType('Scanner', 'scanner'),
+                         StringType('Worker', 'worker'),
+                         IntegerType('Files', 'files'),
+                         IntegerType('Skipped', 'skipped'),
+                         BigIntegerType('Bytes', 'bytes'),
+                         BigIntegerType('Process', 'process_wall'),
+                         BigIntegerType('Process CPU', 'process_cpu'),
+                         BigIntegerType('Slack', 'slack_wall'),
+                         BigIntegerType('Finish', 'finish_wall'),
+                         BigIntegerType('Finish CPU', 'finish_cpu'),
+                         ],
+            table = 'scanner_profile',
+            case = query['case'])
@@ -0,0 +1,78 @@
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Runs all the registered carvers (see Scanner.Carver) in a single pass.
+
+The signatures of all carvers are compiled into one CarveEngine, so
+each file is only searched once no matter how many carvers there
+are. Each carver is then given its hits to examine.
+"""
+import pyflag.Scanner as Scanner
+import pyflag.Registry as Registry
+import pyflag.FileSystem as FileSystem
+import pyflag.CarveEngine as CarveEngine
+import pyflag.pyflaglog as pyflaglog
+
+class CarveScan(Scanner.GenScanFactory):
+    """ Carve files using all the registered carvers """
+    order = 300
+    default = False
+    group = 'Carvers'
+
+    def prepare(self):
+        self.carvers = []
+        self.engine = CarveEngine.CarveEngine()
+        for cls in Registry.CARVERS.classes:
+            carver = cls(self.fsfd)
+            self.carvers.append(carver)
+            for regex in carver.regexs:
+                self.engine.add(regex, carver)
+
+        pyflaglog.log(pyflaglog.DEBUG, "Loaded %s signatures from %s carvers" % (
+            len(self.engine.signatures), len(self.carvers)))
+
+    class Scan(Scanner.BaseScanner):
+        def __init__(self, inode,ddfs,outer,factories=None,fd=None):
+            Scanner.BaseScanner.__init__(self, inode,ddfs,outer,factories, fd=fd)
+            self.stream = outer.engine.stream()
+            self.hits = []
+
+        def process(self, data, metadata=None):
+            self.hits.extend(self.stream.process(data))
+
+        def finish(self):
+            self.hits.extend(self.stream.finish())
+            if not self.hits: return
+
+            fsfd = self.outer.fsfd
+            fd = FileSystem.DBFS(self.case).open(inode_id = self.fd.inode_id)
+
+            ## Carvers ignore their own hits within the files they
+            ## already carved:
+            carved_until = {}
+            fsfd.start_bulk()
+            try:
+                for offset, carver in self.hits:
+                    ## A hit at the start is the file itself:
+                    if offset == 0 or offset < carved_until.get(carver, 0):
+                        continue
+
+                    length = carver.add_inode(fd, offset, self.factories)
+                    carved_until[carver] = offset + (length or 0)
+            finally:
+                fsfd.end_bulk()
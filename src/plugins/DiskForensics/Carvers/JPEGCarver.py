@@ -135,13 +135,14 @@ class CarverScan(Scanner.BaseScanner):
     def add_inode(self, fd, offset):
         """ This is called to allow the Carver to add VFS inodes.
 
-        Returns the new inode_id.
+        Returns the new inode_id. Note that the new inode is only
+        written to the database when the bulk load started in
+        finish() ends.
         """
         ## Calculate the length of the new file
         length = self.get_length(fd,offset)
         new_inode = "%s|o%s:%s" % (self.fd.inode, offset, length)
-        path, inode, inode_id = self.fsfd.lookup(inode_id = self.fd.inode_id)
-        name = DB.expand("%s/%s", (path, self.make_filename(offset)))
+        name = DB.expand("%s/%s", (self.path, self.make_filename(offset)))
         ## By default we just add a VFS Inode for it.
         new_inode_id = self.fsfd.VFSCreate(None,
                                            new_inode,
@@ -154,9 +155,16 @@ class CarverScan(Scanner.BaseScanner):
                                                   name)))
 
         self.add_type_info(new_inode_id)
+        return new_inode_id
 
     def add_type_info(self, inode_id):
-        m = Magic.MagicResolver()
+        """ By default we work out the type from the carved data - we
+        can only do that once the inode is flushed to the database.
+        """
+        self.new_inode_ids.append(inode_id)
+
+    def find_type(self, inode_id):
+        m = Magic.get_resolver()
         m.find_inode_magic(case = self.fd.case, inode_id = inode_id)
 
     def examine_hit(self, fd, offset, length):
@@ -185,9 +193,20 @@ class CarverScan(Scanner.BaseScanner):
                     "class='_Carver' and (%s))",
                     (self.fd.size, self.fd.inode_id, config.FLAGDB, or_claus))
 
-        for row in dbh:
-            ## Now examine each hit in detail to see if its valid:
-            self.examine_hit(fd, row['offset'], row['length'])
+        ## The carved inodes are added in bulk, we then add their type
+        ## information once they are in the database:
+        self.new_inode_ids = []
+        self.path, inode, inode_id = self.fsfd.lookup(inode_id = self.fd.inode_id)
+        self.fsfd.start_bulk()
+        try:
+            for row in dbh:
+                ## Now examine each hit in detail to see if its valid:
+                self.examine_hit(fd, row['offset'], row['length'])
+        finally:
+            self.fsfd.end_bulk()
+
+        for inode_id in self.new_inode_ids:
+            self.find_type(inode_id)
 
 
 class JPEGCarver(Scanner.GenScanFactory):
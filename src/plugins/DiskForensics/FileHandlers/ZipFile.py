@@ -41,6 +41,7 @@ import pyflag.Scanner as Scanner
 import gzip
 import plugins.DiskForensics.DiskForensics as DiskForensics
 import pyflag.Store as Store
+import pyflag.DeflateIndex as DeflateIndex
 import FileFormats.Zip as Zip
 import pyflag.Time as Time
 
@@ -75,29 +76,36 @@ class ZipScan(GenScanFactory):
             
             ## List all the files in the zip file:
             dircount = 0
-            inodes = []
+            inode_ids = []
             namelist = z.namelist()
-            for i in range(len(namelist)):
-                ## Add the file into the VFS
-                try:
-                    ## Convert the time to case timezone
-                    t = Time.convert(z.infolist()[i].date_time, case=self.case, evidence_tz=evidence_tz)
-                except:
-                    t=0
 
-                ## If the entry corresponds to just a directory we ignore it.
-                if not posixpath.basename(namelist[i]): continue
+            ## Zip files may contain many members so we add them in
+            ## bulk:
+            self.ddfs.start_bulk()
+            try:
+                for i in range(len(namelist)):
+                    ## Add the file into the VFS
+                    try:
+                        ## Convert the time to case timezone
+                        t = Time.convert(z.infolist()[i].date_time, case=self.case, evidence_tz=evidence_tz)
+                    except:
+                        t=0
 
-                info = z.infolist()[i]
-                inode = "%s|Z%s:%s" % (self.inode,info.header_offset, info.compress_size)
-                inodes.append(inode)
-                
-                inode_id = self.ddfs.VFSCreate(None,
-                                               inode,DB.expand("%s/%s",(pathname,namelist[i])),
-                                               size=info.file_size,
-                                               mtime=t, _fast=True)
+                    ## If the entry corresponds to just a directory we ignore it.
+                    if not posixpath.basename(namelist[i]): continue
+
+                    info = z.infolist()[i]
+                    inode = "%s|Z%s:%s" % (self.inode,info.header_offset, info.compress_size)
+
+                    inode_id = self.ddfs.VFSCreate(None,
+                                                   inode,DB.expand("%s/%s",(pathname,namelist[i])),
+                                                   size=info.file_size,
+                                                   mtime=t, _fast=True)
+                    inode_ids.append(inode_id)
+            finally:
+                self.ddfs.end_bulk()
                 
-            for inode in inodes:
+            for inode_id in inode_ids:
                 ## Now call the scanners on this new file (FIXME limit
                 ## the recursion level here)
                 fd = self.ddfs.open(inode_id = inode_id)
@@ -132,7 +140,7 @@ class GZScan(ZipScan):
                 ## 1) We try to decompress the first data block from the file to see if the original name is in the header
                 ## 2) Failing this we check if the inodes filename ends with .gz
                 ## 3) Failing that, we call the new file "data"
-                m = Magic.MagicResolver()
+                m = Magic.get_resolver()
                 magic, type_mime = m.find_inode_magic(self.case, inode_id=self.fd.inode_id,
                                                       data=data[:1024])
                 match = re.search(magic,'was "([^"]+)"')
@@ -252,15 +260,13 @@ class ZipFile(File):
         self.init()
 
     def init(self):
-        self.d = zlib.decompressobj(-15)
-        self.left_over = ''
-        self.blocksize = 1024*10
-        self.clength = self.compressed_length
-        offset = self.header.buffer.offset + self.header.size()
-
-        ## Seek our fd to there:
-        self.fd.seek(offset)
-        
+        self.data_offset = self.header.buffer.offset + self.header.size()
+        self.reader = None
+        if self.type == Zip.ZIP_DEFLATED:
+            self.reader = DeflateIndex.InflateReader(
+                self.fd, "%s:%s" % (self.case, self.inode),
+                offset = self.data_offset, length = self.compressed_length)
+
     def read(self,length=None):
         ## Call our baseclass to see if we have cached data:
         try:
@@ -271,65 +277,27 @@ class ZipFile(File):
         ## Read as much as possible
         if length==None:
             length = sys.maxint
-            
-        ## This is done in order to decompress the file in small
-        ## chunks. We try to return as much data as was required
-        ## and not much more
-        try:
-            ## Consume the data left over from previous reads
-            result = self.left_over[:length]
-            self.left_over=self.left_over[length:]
-
-            ## We keep reading compressed data until we can satify
-            ## the desired length
-            while len(result)<length and self.clength>0:
-                ## Read up to 1k of the file:
-                available_clength = min(self.blocksize,self.clength)
-                cdata = self.fd.read(available_clength)
-                self.clength -= available_clength
-
-                if self.type == Zip.ZIP_DEFLATED:
-                    ## Now Decompress that:
-                    try:
-                        ddata = self.d.decompress(cdata)
-                    except:
-                        ddata = ''
-                elif self.type == Zip.ZIP_STORED:
-                    ddata = cdata
-                else:
-                    raise RuntimeError("Compression method %s is not supported" % self.type)
-
-                ## How much data do we require?
-                required_length = length - len(result)
-                result += ddata[:required_length]
 
-                ## This will be '' if we have not finished making
-                ## up the result, and store the rest for next time
-                ## if we have
-                self.left_over = ddata[required_length:]
-
-        except (IndexError, KeyError, zipfile.BadZipfile),e:
-            raise IOError("Zip_File: (%s)" % e)
+        if self.type == Zip.ZIP_DEFLATED:
+            self.reader.seek(self.readptr)
+            result = self.reader.read(length)
+        elif self.type == Zip.ZIP_STORED:
+            length = min(length, self.compressed_length - self.readptr)
+            self.fd.seek(self.data_offset + self.readptr)
+            result = self.fd.read(max(0, length))
+        else:
+            raise RuntimeError("Compression method %s is not supported" % self.type)
 
         self.readptr += len(result)
         return result
 
     def seek(self, offset, rel=None):
-        File.seek(self,offset,rel)
-
-        if self.cached_fd: return
-
-        if self.readptr == 0:
-            self.init()
+        ## The header size is sometimes invalid so we may need to
+        ## work it out:
+        if rel==2 and not self.size and self.reader and not self.cached_fd:
+            self.size = self.reader.get_size()
 
-        ## We want to reinitialise the file pointer:
-        elif self.readptr!=0 and self.type == Zip.ZIP_DEFLATED:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Required to seek to offset %s in Zip File %s (%s,%s). This is inefficient, forcing disk caching." % (self.readptr, self.inode, offset,rel))
-            self.init()
-            self.cache()
-
-            self.seek(offset, rel)
-            return
+        return File.seek(self,offset,rel)
 
     def explain(self, query, result):
         self.fd.explain(query, result)
@@ -338,14 +306,26 @@ class ZipFile(File):
                    "offset %s with length %s" % (self.offset, self.compressed_length))
         result.row("","Filename - %s" % self.header['zip_path'])
 
-### FIXME - This is dangerous!!! We decompress into memory
 class GZ_file(File):
-    """ A file like object to read gzipped files. """
+    """ A file like object to read gzipped files.
+
+    We decompress on demand, so seeking resumes from the nearest
+    checkpoint (see pyflag.DeflateIndex) rather than caching the whole
+    file on disk.
+    """
     specifier = 'G'
+    wbits = DeflateIndex.GZIP
     
     def __init__(self, case, fd, inode):
         File.__init__(self, case, fd, inode)
-        self.gz = None
+        self.reader = None
+
+    def get_reader(self):
+        if not self.reader:
+            self.reader = DeflateIndex.InflateReader(
+                self.fd, "%s:%s" % (self.case, self.inode), wbits = self.wbits)
+
+        return self.reader
 
     def read(self, length=None):
         try:
@@ -353,53 +333,19 @@ class GZ_file(File):
         except IOError:
             pass
 
-        if not self.gz:
-            self.fd.seek(0)
-            self.gz = gzip.GzipFile(fileobj=self.fd, mode='r')
-
-        count = 0
-        step = 1024
-
-        result = ''
-        
-        ## Copy ourself into the file - This is in case we have errors
-        ## in the file, we try to read as much as possible:
-        while 1:
-            try:
-                data=self.gz.read(step)
-            except IOError,e:
-                step /= 2
-                if step<10:
-                    pyflaglog.log(pyflaglog.DEBUG, "Error reading from %s(%s), could only get %s bytes (wanted %s/%s)" % (self.fd.inode, e, count, length,self.size));
-                    break
-                
-                else:
-                    continue
-
-            except Exception, e:
-                #pyflaglog.log(pyflaglog.WARNING, "Unable to decompress inode (%s) %s" % (self.inode, e))
-                break
-            
-            count += len(data)
-            if len(data)==0: break
-            result+=data
+        reader = self.get_reader()
+        reader.seek(self.readptr)
+        result = reader.read(length)
+        self.readptr += len(result)
 
         return result
 
     def seek(self,offset,rel=None):
-        File.seek(self,offset,rel)
+        ## We only know our size after decompressing everything:
+        if rel==2 and not self.size and not self.cached_fd:
+            self.size = self.get_reader().get_size()
 
-        if self.cached_fd: return
-
-        ## If we were asked to seek in a gzip file:
-        if self.readptr!=0:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Asked to seek to %s in gzip file %s. This is expensive, caching on disk." % (self.readptr, self.inode))
-            self.cache()
-
-            self.seek(offset,rel)
-
-        ## Force a new decompressor when rereading:
-        self.gz = None
+        return File.seek(self,offset,rel)
 
     def explain(self, query, result):
         self.fd.explain(query, result)
@@ -409,45 +355,7 @@ class GZ_file(File):
 class DeflateFile(GZ_file):
     """ A File like object to read deflated files """
     specifier = "d"
-
-    def read(self, length=None):
-        try:
-            return File.read(self,length)
-        except IOError:
-            pass
-
-        if not self.gz:
-            self.fd.seek(0)
-            self.gz = gzip.zlib.decompressobj(-15)
-
-        count = 0
-        step = 1024
-
-        result = ''
-        
-        ## Copy ourself into the file - This is in case we have errors
-        ## in the file, we try to read as much as possible:
-        while 1:
-            try:
-                data=self.gz.decompress(self.fd.read(step))
-            except IOError,e:
-                step /= 2
-                if step<10:
-                    pyflaglog.log(pyflaglog.DEBUG, "Error reading from %s, could only get %s bytes" % (self.fd.inode, count));
-                    break
-                
-                else:
-                    continue
-
-            except Exception, e:
-                pyflaglog.log(pyflaglog.WARNING, "Unable to decompress inode %s" % e)
-                break
-            
-            count += len(data)
-            if len(data)==0: break
-            result+=data
-
-        return result
+    wbits = DeflateIndex.RAW
 
     def explain(self, query, result):
         self.fd.explain(query, result)
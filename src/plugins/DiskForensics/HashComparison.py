@@ -29,7 +29,9 @@ config=pyflag.conf.ConfObject()
 import pyflag.FileSystem as FileSystem
 import pyflag.Reports as Reports
 import pyflag.DB as DB
-import os.path
+import pyflag.HashSet as HashSet
+import pyflag.pyflaglog as pyflaglog
+import os
 from pyflag.Scanner import *
 from pyflag.ColumnTypes import StringType, TimestampType, InodeIDType, FilenameType, ColumnType
 
@@ -38,6 +40,40 @@ from hashlib import md5
 config.add_option('hashdb', short_option='H', default="nsrldb",
                   help = "The database which will be used to store hash sets (like nsrl)")
 
+config.add_option('NSRL_HASHSET', default=None,
+                  help = "The NSRL hash set file written by nsrl_load.py (default RESULTDIR/<hashdb>.hashset). MD5Scan only queries the NSRL tables for hashes in this set.")
+
+def hashset_filename():
+    return config.NSRL_HASHSET or os.path.join(config.RESULTDIR,
+                                               "%s.hashset" % config.HASHDB)
+
+## The NSRL hash set is memory mapped read only, so all the workers
+## share the same pages.
+HASH_SET = None
+
+def get_hashset():
+    """ Returns the NSRL hash set or None if there is none.
+
+    The hash set is reopened if nsrl_load.py rewrote it.
+    """
+    global HASH_SET
+
+    filename = hashset_filename()
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        HASH_SET = None
+        return None
+
+    if not HASH_SET or HASH_SET.filename != filename or HASH_SET.mtime != mtime:
+        try:
+            HASH_SET = HashSet.HashSet(filename)
+        except (IOError, EnvironmentError, ValueError), e:
+            pyflaglog.log(pyflaglog.WARNINGS, "Unable to open NSRL hash set %s: %s" % (filename, e))
+            HASH_SET = None
+
+    return HASH_SET
+
 class HashType(ColumnType):
     def __init__(self, **kwargs):
         ColumnType.__init__(self, name="MD5", column='binary_md5', **kwargs)
@@ -125,6 +161,7 @@ class MD5Scan(GenScanFactory):
         dbh_flag=DB.DBO(config.HASHDB)
         dbh_flag.check_index("NSRL_hashes","md5",4)
         dbh_flag.check_index("NSRL_products","Code")
+        self.hashset = get_hashset()
 
     class Scan(BaseScanner):
         def __init__(self, inode,ddfs,outer,factories=None,fd=None):
@@ -142,10 +179,17 @@ class MD5Scan(GenScanFactory):
             ## Dont do short files
             if self.length<16: return
 
-            dbh_flag=DB.DBO(config.HASHDB)
             digest = self.m.digest()
-            dbh_flag.execute("select filename,Name from NSRL_hashes join NSRL_products on productcode=Code where md5=%b limit 1", digest)
-            nsrl=dbh_flag.fetch()
+            nsrl = None
+
+            ## Only go to the database for hashes which are in the
+            ## NSRL:
+            hashset = self.outer.hashset
+            if not hashset or digest in hashset:
+                dbh_flag=DB.DBO(config.HASHDB)
+                dbh_flag.execute("select filename,Name from NSRL_hashes join NSRL_products on productcode=Code where md5=%b limit 1", digest)
+                nsrl=dbh_flag.fetch()
+
             if not nsrl: nsrl={}
             
             dbh=DB.DBO(self.case)
@@ -39,6 +39,15 @@ import pyflag.UI as UI
 from pyflag.ColumnTypes import StringType, TimestampType, InodeIDType, IntegerType, ColumnType
 import pyflag.parser as parser
 import pyflag.Indexing as Indexing
+import pyflag.PostingIndex as PostingIndex
+
+## We install a batch writer and extend the TableRenderer when we
+## are imported:
+eager = True
+
+## Hits in the posting index are written in batches:
+if PostingIndex.WRITER not in Scanner.BATCH_WRITERS:
+    Scanner.BATCH_WRITERS.append(PostingIndex.WRITER)
 
 config.add_option("INDEX_ENCODINGS", default="UTF-8,UTF-16LE",
                   help="A comma seperated list of unicode encodings to mutate the"
@@ -88,6 +97,14 @@ class IndexScan(GenScanFactory):
             self.inode_id = fd.inode_id
             self.stats = {}
 
+            ## When hits are kept in the posting index, we only store
+            ## the first hit of each word in the table (for
+            ## WordColumn):
+            self.posting = config.INDEX_BACKEND == 'posting'
+            if self.posting:
+                PostingIndex.WRITER.start_inode(fd.case, self.inode_id)
+                self.seen = set()
+
             # try to set size. It is helpful to know the correct file size so
             # we can ignore matches which begin after the end of the file+slack
             # space.
@@ -115,6 +132,12 @@ class IndexScan(GenScanFactory):
                         self.stats[id] += 1
                     except:
                         self.stats[id] = 1
+
+                    if self.posting:
+                        PostingIndex.WRITER.add(self.fd.case, self.inode_id, id,
+                                                offset+self.offset, length)
+                        if id in self.seen: continue
+                        self.seen.add(id)
                    
                     self.dbh.mass_insert(
                         inode_id = self.inode_id,
@@ -129,6 +152,9 @@ class IndexScan(GenScanFactory):
 
         def finish(self):
             self.dbh.mass_insert_commit()
+            if self.posting:
+                PostingIndex.WRITER.end_inode(self.fd.case, self.inode_id)
+
             ## Update the version
             self.dbh.update("inode",
                             where = DB.expand('inode_id = %r', self.inode_id),
@@ -464,6 +490,24 @@ class ViewInodeHits(Reports.report):
         task.run(query['case'], query['inode_id'], 2**30 + int(query['word_id']))
 
         case = query['case']
+
+        ## The table only has the first hit of each word when hits
+        ## are kept in the posting index - so we copy all the hits of
+        ## this inode into it:
+        if config.INDEX_BACKEND == 'posting':
+            dbh = DB.DBO(case)
+            dbh.delete("LogicalIndexOffsets",
+                       where = DB.expand("inode_id = %r and word_id = %r",
+                                         (query['inode_id'], query['word_id'])),
+                       _fast = True)
+            dbh.mass_insert_start("LogicalIndexOffsets")
+            index = PostingIndex.get_index(case)
+            for offset, length in index.list_hits(query['inode_id'], query['word_id']):
+                dbh.mass_insert(inode_id = query['inode_id'],
+                                word_id = query['word_id'],
+                                offset = offset, length = length)
+            dbh.mass_insert_commit()
+            dbh.invalidate("LogicalIndexOffsets")
         result.table(
             elements = [ InodeIDType(case=case),
                          OffsetType(case=case),
@@ -753,12 +797,25 @@ class Index(Farm.Task):
         ## Get ready for scan
         dbh.mass_insert_start("LogicalIndexOffsets")
 
+        ## When hits are kept in the posting index, we only store the
+        ## first hit of each word in the table (for WordColumn):
+        posting = config.INDEX_BACKEND == 'posting'
+        if posting:
+            PostingIndex.WRITER.start_inode(case, inode_id)
+            seen = set()
+
         while 1:
             data = fd.read(1024*1024)
             if len(data)==0: break
 
             for offset, matches in INDEX.index_buffer(data, unique = unique):
                 for id, length in matches:
+                    if posting:
+                        PostingIndex.WRITER.add(case, inode_id, id,
+                                                offset + buff_offset, length)
+                        if id in seen: continue
+                        seen.add(id)
+
                     dbh.mass_insert(
                         inode_id = inode_id,
                         word_id = id,
@@ -768,6 +825,9 @@ class Index(Farm.Task):
             buff_offset += len(data)
 
         dbh.mass_insert_commit()
+        if posting:
+            PostingIndex.WRITER.end_inode(case, inode_id)
+            PostingIndex.WRITER.flush(case)
         
         ## Update the version
         dbh.update("inode",
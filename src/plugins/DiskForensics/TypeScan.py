@@ -37,6 +37,14 @@ import pyflag.Registry as Registry
 from pyflag.ColumnTypes import StringType, TimestampType, InodeIDType, FilenameType, IntegerType, InodeType
 import pyflag.Magic as Magic
 
+## We add operators to InodeIDType and install a batch writer when
+## we are imported:
+eager = True
+
+## The types we find are written in batches:
+if Magic.TYPES not in Scanner.BATCH_WRITERS:
+    Scanner.BATCH_WRITERS.append(Magic.TYPES)
+
 class TypeScan(Scanner.GenScanFactory):
     """ Detect File Type (magic). """
     order=5
@@ -56,9 +64,10 @@ class TypeScan(Scanner.GenScanFactory):
     def reset_entire_path(self, path_glob):
         path = path_glob
         if not path.endswith("*"): path = path + "*"  
+        ## This writes any pending types first:
+        Scanner.GenScanFactory.reset_entire_path(self, path_glob)
         db = DB.DBO(self.case)
         db.execute("delete from type where inode_id in (select inode_id from file where file.path rlike %r)", DB.glob2re(path))
-        Scanner.GenScanFactory.reset_entire_path(self, path_glob)
         
     def destroy(self):
         pass
@@ -68,8 +77,10 @@ class TypeScan(Scanner.GenScanFactory):
         
         def process(self, data, metadata=None):
             if self.type_str==None:
-                m = Magic.MagicResolver()
-                self.type_str, self.type_mime = m.cache_type(self.case, self.fd.inode_id, data[:1024])
+                m = Magic.get_resolver()
+                self.type_str, self.type_mime = m.cache_type(
+                    self.case, self.fd.inode_id, data[:config.MAGIC_HEADER_SIZE],
+                    batch=True)
                 metadata['mime'] = self.type_mime
                 metadata['type'] = self.type_str
                 
@@ -88,7 +99,7 @@ class ThumbnailType(InodeIDType):
         ct=''
         try:
             fd = self.fsfd.open(inode_id = inode_id)
-            image = Graph.Thumbnailer(fd, 200)
+            image = Graph.Thumbnailer(fd, Graph.THUMBNAIL_SIZE)
             inode_filename, ct, fd = table_renderer.make_archive_filename(inode_id)
 
             filename, ct, fd = table_renderer.make_archive_filename(inode_id, directory = "thumbnails/")
@@ -105,58 +116,60 @@ class ThumbnailType(InodeIDType):
                          (inode_filename, ct, filename))
 
     def render_thumbnail_hook(self, inode_id, row, result):
+        ## Use the cached thumbnail if there is one, otherwise we only
+        ## read the image header to get its size here and make the
+        ## thumbnail when the browser asks for it:
         try:
-            fd = self.fsfd.open(inode_id=inode_id)
-            image = PIL.Image.open(fd)
-        except IOError,e:
-            result.icon("broken.png")
-            return
-
-        width, height = image.size
-
-        ## Calculate the new width and height:
-        new_width = 200
-        new_height = int(float(new_width) / width * height)
+            content_type, new_width, new_height, magic, data = Graph.get_thumbnail(
+                self.case, inode_id, Graph.THUMBNAIL_SIZE)
+        except (IOError, ValueError):
+            try:
+                fd = self.fsfd.open(inode_id=inode_id)
+                image = PIL.Image.open(fd)
+            except IOError,e:
+                result.icon("broken.png")
+                return
 
-        if new_width > width and new_height > height:
-            new_height = height
-            new_width = width
+            width, height = image.size
+            new_width, new_height = Graph.thumbnail_size(width, height,
+                                                         Graph.THUMBNAIL_SIZE)
 
         def show_image(query, result):
-            ## Try to fetch the cached copy:
-            filename = "thumb_%s" % inode_id
+            fd = self.fsfd.open(inode_id=inode_id)
+            image = Graph.Thumbnailer(fd, Graph.THUMBNAIL_SIZE)
 
-            try:
-                fd = CacheManager.MANAGER.open(self.case, filename)
-                thumbnail = fd.read()
-            except IOError:
-                fd = self.fsfd.open(inode_id=inode_id)
-                fd = cStringIO.StringIO(fd.read(2000000) + "\xff\xd9")
-                image = PIL.Image.open(fd)
-                image = image.convert('RGB')
-                thumbnail = cStringIO.StringIO()
-
-                try:
-                    image.thumbnail((new_width, new_height), PIL.Image.NEAREST)
-                    image.save(thumbnail, 'jpeg')
-                    thumbnail = thumbnail.getvalue()
-                except IOError,e:
-                    print "PIL Error: %s" % e
-                    thumbnail = open("%s/no.png" % (config.IMAGEDIR,),'rb').read()
-
-                CacheManager.MANAGER.create_cache_from_data(self.case, filename, thumbnail)
-                fd = CacheManager.MANAGER.open(self.case, filename)
-                
-            result.result = thumbnail
-            result.content_type = 'image/jpeg'
+            result.result = image.display()
+            result.content_type = image.GetContentType()
             result.decoration = 'raw'
 
-        
         result.result += "<img width=%s height=%s src='f?callback_stored=%s' />" % (new_width, new_height,
                                                                 result.store_callback(show_image))
 
     display_hooks = InodeIDType.display_hooks[:] + [render_thumbnail_hook,]
 
+class ThumbnailScan(Scanner.GenScanFactory):
+    """ Make thumbnails of images while scanning, so galleries and
+    thumbnail columns are quick to view.
+    """
+    order = 6
+    default = False
+    depends = ['TypeScan']
+    group = "FileScanners"
+
+    class Scan(Scanner.BaseScanner):
+        mime = None
+
+        def process(self, data, metadata=None):
+            if self.mime == None:
+                self.mime = metadata.get('mime')
+
+        def finish(self):
+            if not self.mime or not self.mime.startswith("image/"):
+                return
+
+            fd = FileSystem.DBFS(self.case).open(inode_id = self.inode_id)
+            Graph.Thumbnailer(fd, Graph.THUMBNAIL_SIZE)
+
 ## A report to examine the Types of different files:
 class ViewFileTypes(Reports.report):
     """ Browse the file types discovered.
@@ -300,7 +300,39 @@ class scanner_reset(scan):
             f.multiple_inode_reset(self.args[0])
             
         yield "Resetting complete"
-    
+
+class scanner_profile(pyflagsh.command):
+    """ Shows how long each scanner took on the case """
+    def help(self):
+        return "scanner_profile: Shows the time taken by each scanner (totalled over all workers), most expensive first"
+
+    def execute(self):
+        ## Include what this process counted so far:
+        Scanner.PROFILE.flush(self.environment._CASE)
+        try:
+            rows = Scanner.profile_summary(self.environment._CASE)
+        except DB.DBError:
+            yield "No scanners have been profiled in this case"
+            return
+
+        total = sum([ row['process_wall'] + row['slack_wall'] + row['finish_wall']
+                      for row in rows ]) or 1
+
+        yield "%-20s %8s %8s %10s %10s %10s %10s %10s %10s %6s" % (
+            "Scanner", "Files", "Skipped", "MB", "Process", "(CPU)", "Slack",
+            "Finish", "(CPU)", "%")
+        for row in rows:
+            wall = row['process_wall'] + row['slack_wall'] + row['finish_wall']
+            yield "%-20s %8s %8s %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f %6.1f" % (
+                row['scanner'], row['files'], row['skipped'],
+                row['bytes'] / 1024.0 / 1024,
+                row['process_wall'] / 1e6, row['process_cpu'] / 1e6,
+                row['slack_wall'] / 1e6,
+                row['finish_wall'] / 1e6, row['finish_cpu'] / 1e6,
+                100.0 * wall / total)
+
+        yield "Times are in seconds"
+
 class load_and_scan(scan):
     """ Load a filesystem and scan it at the same time """
     def help(self):
@@ -660,7 +660,7 @@ class LoadDataTests(unittest.TestCase):
         tables = [ row.values()[0] for row in dbh ]
         ## At a minimum these tables must exist:
         for required in ['annotate', 'block', 'file', 'filesystems',
-                         'inode', 'meta', 'resident', 'sql_cache', 'xattr']:
+                         'inode', 'meta', 'resident', 'table_generations', 'xattr']:
             self.assert_(required in tables)
 
     def test02LoadFilesystem(self):
@@ -35,10 +35,14 @@ config=pyflag.conf.ConfObject()
 import re
 import pyflag.pyflaglog as pyflaglog
 import pyflag.Store as Store
-import os
+import pyflag.RadixTree as RadixTree
+import os, socket, struct
 
 description = "Offline Whois"
 hidden = False
+
+## We add to IPType when we are imported:
+eager = True
 order = 40
 
 config.add_option("GEOIPDIR", default=config.DATADIR,
@@ -70,10 +74,18 @@ if config.flush_geocache:
 #config.add_option("SEARCHABLE_ORG
 #config.add_option("SEARCHABLE_ISP
 
+config.add_option("WHOIS_ROUTES", default=None,
+                  help="A snapshot of the whois routes (written by whois_load.py). "
+                  "Defaults to whois_routes.trie in the RESULTDIR. It is made from the "
+                  "whois_routes table if it does not exist.")
+
 ## A cache of whois addresses - This really does not need to be
 ## invalidated as the data should never change
 WHOIS_CACHE = Store.Store()
 
+## A cache of geoip records (as returned by _geoip_cached_record):
+GEOIP_CACHE = Store.Store()
+
 ## Try for the GeoIP City Stuff....
 
 def load_geofile(name, type):
@@ -167,7 +179,82 @@ def insert_whois_cache(sql_ip, id, ipinfo):
                _fast = True
                )
 
+## The radix tree of whois routes:
+ROUTES = None
+
+def routes_filename():
+    return config.WHOIS_ROUTES or os.path.join(config.RESULTDIR, "whois_routes.trie")
+
+def build_routes(dbh):
+    """ Builds a radix tree of the whois_routes table """
+    tree = RadixTree.RadixTree()
+    dbh.execute("select network, netmask, whois_id from whois_routes")
+    for row in dbh:
+        ## lookup_whois_id_sql() never matches these:
+        length = RadixTree.prefix_length(row['netmask'])
+        if length is None or row['network'] & ~RadixTree.MASKS[length]:
+            continue
+
+        tree.add(row['network'], length, row['whois_id'])
+
+    return tree
+
+def write_routes(dbh=None):
+    """ Writes the whois routes snapshot """
+    filename = routes_filename()
+    pyflaglog.log(pyflaglog.DEBUG, "Writing whois routes to %s" % filename)
+    build_routes(dbh or DB.DBO()).save(filename)
+
+def get_routes():
+    """ Returns the radix tree of whois routes. The snapshot is made
+    if needed, and reloaded when it changes.
+    """
+    global ROUTES
+
+    filename = routes_filename()
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        try:
+            write_routes()
+            mtime = os.stat(filename).st_mtime
+        except (IOError, OSError), e:
+            ## We can not write the snapshot, so we just keep the
+            ## tree in memory:
+            pyflaglog.log(pyflaglog.WARNING, "Unable to write whois routes: %s" % e)
+            if not ROUTES:
+                ROUTES = build_routes(DB.DBO())
+            return ROUTES
+
+    if not ROUTES or ROUTES.mtime != mtime:
+        ROUTES = RadixTree.RadixTree(filename)
+
+    return ROUTES
+
+def ip_to_int(ip):
+    """ Converts an IP in dot notation (or an integer) to an integer """
+    try:
+        ip/2
+        return ip
+    except TypeError:
+        return struct.unpack(">I", socket.inet_aton(ip.strip()))[0]
+
 def lookup_whois_id(dbh, ip):
+    """ Returns the whois id of the most specific route to ip """
+    try:
+        id = get_routes().lookup(ip_to_int(ip))
+    except (socket.error, AttributeError):
+        id = None
+
+    if id is None:
+        raise Reports.ReportError("Unable to find whois entry for %s. This should not happen... " % ip)
+
+    return id
+
+def lookup_whois_id_sql(dbh, ip):
+    """ Finds the whois id of ip in the whois_routes table (this is
+    much slower than lookup_whois_id() which gives the same result)
+    """
     netmask = 0
     while 1:
         dbh.execute("select whois_id from whois_routes where ( inet_aton(%r) & inet_aton('255.255.255.255') & ~%r ) = network and (inet_aton('255.255.255.255') & ~%r) = netmask limit 1 " , (ip,netmask,netmask))
@@ -290,12 +377,20 @@ def _geoip_cached_record(ip):
     return dbh.fetch()
 
 def geoip_cached_record(ip):
+    try:
+        return GEOIP_CACHE.get(ip)
+    except KeyError:
+        pass
+
     result = _geoip_cached_record(ip)
     if not result:
         lookup_whois(ip)
         ## Now it really should be there...        
         result = _geoip_cached_record(ip)
 
+    if result:
+        GEOIP_CACHE.put(result, key=ip)
+
     return result
 
 def geoip_resolve_extended(ip, result):
@@ -530,6 +625,12 @@ class WhoisInit(FlagFramework.EventHandler):
                    descr='Default Fallthrough Route: IP INVALID OR UNASSIGNED',
                    status='unallocated')
 
+        ## Any routes snapshot is out of date now:
+        try:
+            os.unlink(routes_filename())
+        except OSError:
+            pass
+
         dbh.execute("""CREATE TABLE `whois_sources` (
         `id` int(11) NOT NULL,
         `source` varchar(20) default NULL,
@@ -900,11 +1001,18 @@ def insert(self, value):
         lookup_whois(value)
 
     return "_"+self.column, "inet_aton(%r)" % value.strip()
+
+def load_value(self, value):
+    if config.PRECACHE_IPMETADATA==True:
+        lookup_whois(value)
+
+    return value.strip()
     
 from pyflag.ColumnTypes import IPType, add_display_hook, clear_display_hook
 add_display_hook(IPType, "geoip_display_hook", geoip_display_hook,1)
 
 IPType.insert = insert
+IPType.load_value = load_value
 IPType.extended_csv = extended_csv
 IPType.operator_whois_country = operator_whois_country
 IPType.code_maxmind_isp_like = code_maxmind_isp_like
@@ -956,3 +1064,11 @@ class WhoisTest(unittest.TestCase):
             row = dbh.fetch()
             self.assertEqual(netname, row['netname'])
 
+    def test02RoutesMatchSQL(self):
+        """ Test that the whois routes tree agrees with the database """
+        dbh = DB.DBO()
+        ips = [ ip for domain, ip, netname in test_ips ] + \
+              [ "10.1.2.3", "127.0.0.1", "0.0.0.0", "255.255.255.255" ]
+        for ip in ips:
+            self.assertEqual(lookup_whois_id(dbh, ip), lookup_whois_id_sql(dbh, ip))
+
@@ -37,7 +37,8 @@ import pyflag.DB as DB
 import pyflag.Scanner as Scanner
 import pyflag.ScannerUtils as ScannerUtils
 import pyflag.Registry as Registry
-import os,sys,time
+import os,sys,time,struct
+import pyflag.Store as Store
 import reassembler
 from NetworkScanner import *
 import pypcap
@@ -128,12 +129,175 @@ class ConnectionDetailsTable(FlagFramework.CaseTable):
         [ StateType, dict(name='Type', column='type', states={'tcp':'tcp', 'udp':'udp'})]
         ]
         
+config.add_option("PCAP_BATCH_ROWS", default=5000, type='int',
+                  help="Number of connection rows buffered while loading a PCAP file")
+
+config.add_option("PCAP_BATCH_SIZE", default=512*1024, type='int',
+                  help="Maximum number of bytes of connection rows buffered while loading a PCAP file")
+
+config.add_option("PCAP_LOADERS", default=0, type='int',
+                  help="Number of processes used to reassemble streams when loading a PCAP file (0 reassembles in the loading process)")
+
+def flow_shard(packet, shards):
+    """ Returns the loader responsible for the flow of this packet.
+
+    Both directions of a flow hash to the same loader. Packets which
+    are not IP go to the first loader.
+    """
+    try:
+        ip = packet.find_type("IP")
+    except AttributeError:
+        return 0
+
+    if not ip: return 0
+
+    try:
+        payload = ip.payload
+        a = (ip.src, payload.source)
+        b = (ip.dest, payload.dest)
+    except (AttributeError, KeyError):
+        a = ip.src
+        b = ip.dest
+
+    if a > b:
+        a,b = b,a
+
+    return hash((a,b)) % shards
+
+class PacketShard:
+    """ A file like object which feeds a PyPCAP reader with the packets
+    sent to a loader.
+
+    Each frame on the pipe is the pcap id, the record length and the
+    raw pcap record. PyPCAP reads one record each time it dissects
+    a packet, so we hand it exactly one frame per read.
+    """
+    frame = struct.Struct("<II")
+
+    def __init__(self, fd, file_header):
+        self.fd = fd
+        self.pending = file_header
+
+    def next_packet(self):
+        """ Reads the next frame from the pipe and returns its pcap id """
+        data = self.fd.read(self.frame.size)
+        if len(data) < self.frame.size:
+            return None
+
+        pcap_id, length = self.frame.unpack(data)
+        self.pending = self.fd.read(length)
+
+        return pcap_id
+
+    def read(self, length):
+        result = self.pending
+        self.pending = ''
+
+        return result
+
+class PCAPLoaders:
+    """ Reassembles streams in a number of forked loader processes.
+
+    This object is used in place of the reassembler by
+    PCAPFS.load(). The loading process still dissects every packet and
+    writes the pcap table, but instead of reassembling packets it sends
+    them to a loader chosen by flow_shard(). Each loader has its own
+    reassembler and connection tables writers, and sees the packets of
+    its flows in their original order, so the streams are the same as
+    those made by a single reassembler.
+    """
+    def __init__(self, fs, iosource_name, scanners, data_offset, max_id):
+        ## We need our own fd to read the raw packets from, since the
+        ## fd used by the PyPCAP object keeps track of its own
+        ## position:
+        self.fd = IO.open(fs.case, iosource_name)
+        self.fd.seek(0)
+        file_header = self.fd.read(data_offset)
+
+        self.pipes = []
+        self.pids = []
+        for i in range(config.PCAP_LOADERS):
+            r,w = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(w)
+                for pipe in self.pipes:
+                    pipe.close()
+
+                try:
+                    try:
+                        self.run(fs, iosource_name, scanners,
+                                 PacketShard(os.fdopen(r, 'rb', 1024*1024), file_header),
+                                 max_id)
+                    except Exception,e:
+                        pyflaglog.log(pyflaglog.ERRORS, "PCAP loader failed: %s" % e)
+                        os._exit(1)
+                finally:
+                    os._exit(0)
+
+            os.close(r)
+            self.pipes.append(os.fdopen(w, 'wb', 1024*1024))
+            self.pids.append(pid)
+
+    def run(self, fs, iosource_name, scanners, shard, max_id):
+        """ The main loop of each loader """
+        ## It is an error to fork with db connections established so
+        ## we get new handles (See Farm.worker_run):
+        DB.DBO.DBH_old = DB.DBO.DBH
+        DB.DBO.DBH = Store.Store(max_size=10)
+        DB.db_connections = 0
+
+        pcap_file = pypcap.PyPCAP(shard)
+        cookie, processor = fs.make_processor(iosource_name, scanners)
+
+        ## Flows between the same hosts may go to different loaders,
+        ## which must not each create their directories:
+        fs.bulk_writer.shared = True
+
+        while 1:
+            pcap_id = shard.next_packet()
+            if pcap_id is None: break
+
+            ## Dissect with the same ids the serial loader would use:
+            packet = pcap_file.dissect(id=pcap_id - max_id - 1)
+            pcap_file.set_id(pcap_id)
+            processor.process(packet)
+
+        processor.flush()
+        fs.flush_writers()
+        fs.end_bulk()
+
+    def process(self, packet):
+        pipe = self.pipes[flow_shard(packet, len(self.pipes))]
+
+        length = 16 + packet.caplen
+        self.fd.seek(packet.offset)
+        pipe.write(PacketShard.frame.pack(packet.id, length))
+        pipe.write(self.fd.read(length))
+
+    def flush(self):
+        """ Waits for all the loaders to finish """
+        for pipe in self.pipes:
+            pipe.close()
+
+        failed = 0
+        for pid in self.pids:
+            pid, status = os.waitpid(pid, 0)
+            if status:
+                failed += 1
+
+        if failed:
+            raise IOError("%s PCAP loaders failed" % failed)
+
 class PCAPFS(DBFS):
     """ This implements a simple filesystem for PCAP files.
     """
     name = 'PCAP Filesystem'
     order = 10
 
+    ## The BatchWriters used by the processor:
+    batch_writers = ()
+
     def guess(self, fd, result, metadata):
         """ We need to see if its a PCAP file """
         DBFS.guess(self, fd, result, metadata)
@@ -144,16 +308,34 @@ class PCAPFS(DBFS):
             return -1
 
     def make_processor(self, iosource_name, scanners):
+        """ Returns a reassembler which loads connections into the case.
+
+        Rows are written in batches, so callers must call
+        flush_writers() once they flushed the reassembler in order to
+        make the streams visible.
+        """
         ## We manage a number of tables here with mass insert:
         packet_handlers = [ x(self.case) for x in Registry.PACKET_HANDLERS.classes ]
         dbh = DB.DBO(self.case)
-        ## We do not want to use mass insert here to ensure that
-        ## scanning can begin immediately - this is useful when the
-        ## incremental_loader is used because small files may be
-        ## processed.
         pdbh = DB.DBO()
         cookie = int(time.time())
 
+        ## Connection rows are written in batches and stream inode_ids
+        ## are allocated from reserved blocks. VFS nodes are buffered
+        ## by our bulk writer. Jobs refer to the VFS nodes so they
+        ## must be written after them.
+        connection_writer = FileSystem.BatchWriter(dbh, max_rows = config.PCAP_BATCH_ROWS,
+                                                   max_bytes = config.PCAP_BATCH_SIZE,
+                                                   order = ('connection_details',
+                                                            'connection'))
+        jobs_writer = FileSystem.BatchWriter(pdbh, max_rows = config.PCAP_BATCH_ROWS,
+                                             max_bytes = config.PCAP_BATCH_SIZE,
+                                             before_flush = (connection_writer.flush,
+                                                             self.flush_bulk))
+        inode_ids = FileSystem.InodeIDAllocator(dbh)
+        self.batch_writers = (connection_writer, jobs_writer)
+        self.start_bulk()
+
         if scanners:
             scanner_string = ','.join(scanners)
 
@@ -171,15 +353,8 @@ class PCAPFS(DBFS):
 
                 ## Connection id have not been set yet:
                 if not connection.has_key('inode_id'):
-                    ## We insert a null value so we can get a valid
-                    ## autoincrement id.
-                    dbh.insert('inode', _inode_id='NULL', _fast=True)
-                    forward_inode_id = dbh.autoincrement()
-                    dbh.delete('inode', where='inode_id = %s' % forward_inode_id)
-
-                    dbh.insert('inode', _inode_id='NULL', _fast=True)
-                    reverse_inode_id = dbh.autoincrement()
-                    dbh.delete('inode', where='inode_id = %s' % reverse_inode_id)
+                    forward_inode_id = inode_ids.allocate()
+                    reverse_inode_id = inode_ids.allocate()
 
                     connection['inode_id'] = forward_inode_id;
                     connection['reverse']['inode_id'] = reverse_inode_id;
@@ -215,8 +390,8 @@ class PCAPFS(DBFS):
                 except KeyError:
                     pass
 
-                dbh.insert('connection_details',
-                           **args)
+                connection_writer.insert('connection_details',
+                                         **args)
 
                 ## This is where we write the data out
                 connection['data'] = CacheManager.MANAGER.create_cache_fd(
@@ -251,7 +426,7 @@ class PCAPFS(DBFS):
                 except KeyError:
                     args['seq'] = 0
                 
-                dbh.insert("connection", **args)
+                connection_writer.insert("connection", **args)
                 
                 if data: fd.write(data)
 
@@ -276,13 +451,13 @@ class PCAPFS(DBFS):
                             )
                         
                         if scanners:
-                            pdbh.insert("jobs",
-                                command = 'Scan',
-                                arg1 = self.case,
-                                arg2 = new_inode,
-                                arg3= scanner_string,
-                                cookie=cookie,
-                                )
+                            jobs_writer.insert("jobs",
+                                               command = 'Scan',
+                                               arg1 = self.case,
+                                               arg2 = new_inode,
+                                               arg3= scanner_string,
+                                               cookie=cookie,
+                                               )
 
                 except KeyError: pass
 
@@ -305,13 +480,13 @@ class PCAPFS(DBFS):
                             )
 
                         if scanners:
-                            pdbh.insert("jobs",
-                                command = 'Scan',
-                                arg1 = self.case,
-                                arg2 = new_inode,
-                                arg3= scanner_string,
-                                cookie=cookie,
-                                )
+                            jobs_writer.insert("jobs",
+                                               command = 'Scan',
+                                               arg1 = self.case,
+                                               arg2 = new_inode,
+                                               arg3= scanner_string,
+                                               cookie=cookie,
+                                               )
 
                 except KeyError: pass
 
@@ -329,6 +504,15 @@ class PCAPFS(DBFS):
         processor = reassembler.Reassembler(packet_callback = Callback)
         return cookie, processor
 
+    def flush_writers(self):
+        """ Writes all rows buffered by the processor (and the VFS
+        nodes of its streams)
+        """
+        connection_writer, jobs_writer = self.batch_writers
+        connection_writer.flush()
+        self.flush_bulk()
+        jobs_writer.flush()
+
     def load(self, mount_point, iosource_name,scanners = None):
         DBFS.load(self, mount_point, iosource_name)
         
@@ -345,18 +529,27 @@ class PCAPFS(DBFS):
 
         pcap_dbh.execute("select max(id) as m from pcap")
         max_id = pcap_dbh.fetch()['m'] or 0
-        cookie, processor = self.make_processor(iosource_name, scanners)
+
+        ## When loading in parallel we only index the packets here,
+        ## and the reassembly happens in the loaders:
+        if config.PCAP_LOADERS > 1:
+            loaders = PCAPLoaders(self, iosource_name, scanners,
+                                  pcap_file.offset(), max_id)
+            processor = loaders
+        else:
+            cookie, processor = self.make_processor(iosource_name, scanners)
 
         ## Process the file with it:
+        index = 0
         while 1:
             try:
-                packet = pcap_file.dissect()
+                packet = pcap_file.dissect(id=index)
+                index += 1
                 max_id += 1
 
-                ## FIXME - this is a bottleneck. For now we use mass
-                ## insert but this will break when we have multiple
-                ## concurrent loaders.  Record the packet in the pcap
-                ## table:
+                ## Record the packet in the pcap table. The pcap ids
+                ## are always allocated here so they are consistent
+                ## regardless of how many loaders we use:
                 args = dict(
                     iosource = iosource_name,
                     offset = packet.offset,
@@ -389,6 +582,10 @@ class PCAPFS(DBFS):
                 break
 
         processor.flush()
+        pcap_dbh.mass_insert_commit()
+        if config.PCAP_LOADERS <= 1:
+            self.flush_writers()
+            self.end_bulk()
 
         pcap_dbh.check_index("connection_details",'src_ip')
         pcap_dbh.check_index("connection_details",'src_port')
@@ -691,3 +888,75 @@ class NetworkingSummary(Reports.report):
                 )
         except DB.DBError,args:
             result.para("No networking tables found, you probably haven't run the correct scanners: %s" % args)
+
+## Unit tests:
+import unittest
+import pyflag.pyflagsh as pyflagsh
+
+class PCAPLoadersTest(unittest.TestCase):
+    """ Test that parallel PCAP loaders make the same VFS as a single loader """
+    test_file = "stdcapture_0.3.pcap"
+    loaders = 4
+
+    def load(self, case, loaders):
+        old = config.PCAP_LOADERS
+        config.PCAP_LOADERS = loaders
+        try:
+            try:
+                pyflagsh.shell_execv(command="execute",
+                                     argv=["Case Management.Remove case",'remove_case=%s' % case])
+            except: pass
+
+            pyflagsh.shell_execv(command="execute",
+                                 argv=["Case Management.Create new case",'create_case=%s' % case])
+            pyflagsh.shell_execv(command="execute",
+                                 argv=["Load Data.Load IO Data Source",'case=%s' % case,
+                                       "iosource=test",
+                                       "subsys=Advanced",
+                                       "filename=%s" % self.test_file,
+                                       ])
+            pyflagsh.shell_execv(command="execute",
+                                 argv=["Load Data.Load Filesystem image",'case=%s' % case,
+                                       "iosource=test",
+                                       "fstype=PCAP Filesystem",
+                                       "mount_point=/"])
+        finally:
+            config.PCAP_LOADERS = old
+
+    def tables(self, case):
+        """ Returns the rows of the file, inode and connection tables.
+
+        Loaders allocate inode_ids from their own blocks, so rows are
+        identified by their filename rather than their inode_id.
+        """
+        dbh = DB.DBO(case)
+        result = {}
+        dbh.execute("select path, name, mode, status from file "
+                    "order by path, name, mode, status")
+        result['file'] = [ (row['path'], row['name'], row['mode'], row['status'])
+                           for row in dbh ]
+
+        dbh.execute("select path, name, size, mtime from inode join file on "
+                    "file.inode_id = inode.inode_id order by path, name")
+        result['inode'] = [ (row['path'], row['name'], row['size'], row['mtime'])
+                            for row in dbh ]
+
+        dbh.execute("select path, name, packet_id, seq, connection.length as length, "
+                    "cache_offset from connection join file on "
+                    "file.inode_id = connection.inode_id "
+                    "order by path, name, packet_id")
+        result['connection'] = [ (row['path'], row['name'], row['packet_id'], row['seq'],
+                                  row['length'], row['cache_offset']) for row in dbh ]
+
+        return result
+
+    def test01SameAsSerial(self):
+        """ Test parallel loaders produce the same tables as the serial loader """
+        self.load("PyFlagSerialPCAP", 0)
+        self.load("PyFlagParallelPCAP", self.loaders)
+
+        serial = self.tables("PyFlagSerialPCAP")
+        parallel = self.tables("PyFlagParallelPCAP")
+        for table in ('file', 'inode', 'connection'):
+            self.assert_(serial[table])
+            self.assertEqual(serial[table], parallel[table])
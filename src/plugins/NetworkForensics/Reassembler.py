@@ -31,7 +31,7 @@ from pyflag.FileSystem import File
 import pyflag.IO as IO
 from pyflag.FlagFramework import query_type
 from NetworkScanner import *
-import struct,re,os,time
+import struct,re,os,time,array,bisect,tempfile
 import reassembler
 from pyflag.ColumnTypes import StringType, IntegerType, TimestampType
 from pyflag.ColumnTypes import InodeIDType, IPType, PCAPTime
@@ -63,6 +63,132 @@ class DataType(StringType):
         ui.text(data, sanitise='full', font='typewriter')
         return ui
 
+class PacketIndex:
+    """ Maps offsets in a stream to the packets they came from.
+
+    Packets are kept sorted by cache_offset (longest first). A lookup
+    returns the first packet which ends at or after the offset. As the
+    packets may overlap, we bisect on the largest end offset seen so
+    far, which gives the same packet as a linear search.
+
+    Timestamps are kept as indexes into a list of the distinct
+    timestamps in the stream (packets mostly share them).
+
+    File format (in machine byte order):
+
+      header: 'PFPI', number of packets, size of array items,
+              number of timestamps
+      packet ids, cache offsets, lengths, end offsets, timestamp indexes
+      timestamps seperated by new lines
+    """
+    MAGIC = "PFPI"
+    HEADER = struct.Struct("=4sIII")
+    TYPECODE = 'l'
+
+    def __init__(self, packets=(), filename=None):
+        """ packets is a sequence of (packet_id, cache_offset, length,
+        ts_sec).
+        """
+        if filename:
+            self.load(filename)
+            return
+
+        packets = sorted(packets, key = lambda p: (p[1], -p[2]))
+        self.timestamps = []
+        timestamp_ids = {}
+        for name in ("packet_id", "offset", "length", "end", "ts"):
+            setattr(self, name, array.array(self.TYPECODE))
+
+        end = -1
+        for packet_id, offset, length, ts_sec in packets:
+            if ts_sec is None:
+                ts = -1
+            else:
+                try:
+                    ts = timestamp_ids[ts_sec]
+                except KeyError:
+                    ts = timestamp_ids[ts_sec] = len(self.timestamps)
+                    self.timestamps.append(ts_sec)
+
+            end = max(end, offset + length)
+            self.packet_id.append(packet_id)
+            self.offset.append(offset)
+            self.length.append(length)
+            self.end.append(end)
+            self.ts.append(ts)
+
+    def __len__(self):
+        return len(self.packet_id)
+
+    def find(self, position):
+        """ Returns the index of the packet containing position, or
+        None if position is past the end of the stream.
+        """
+        i = bisect.bisect_left(self.end, position)
+        if i < len(self.end):
+            return i
+
+    def get_packet_id(self, position):
+        i = self.find(position)
+        if i is None: return 0
+
+        return self.packet_id[i]
+
+    def get_packet_ts(self, position):
+        i = self.find(position)
+        if i is None or self.ts[i] < 0: return None
+
+        return self.timestamps[self.ts[i]]
+
+    def packets(self):
+        """ Yields (packet_id, cache_offset, length) in stream order """
+        return zip(self.packet_id, self.offset, self.length)
+
+    def save(self, filename):
+        """ Writes the index to filename (atomically replacing it) """
+        ## Other processes may be saving the index of the same stream,
+        ## so we each write our own temporary file:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            fd = os.fdopen(fd, "wb")
+            try:
+                fd.write(self.HEADER.pack(self.MAGIC, len(self.packet_id),
+                                          self.packet_id.itemsize, len(self.timestamps)))
+                for a in (self.packet_id, self.offset, self.length, self.end, self.ts):
+                    a.tofile(fd)
+
+                fd.write("\n".join(self.timestamps))
+            finally:
+                fd.close()
+
+            os.rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def load(self, filename):
+        fd = open(filename, "rb")
+        try:
+            magic, count, itemsize, timestamps = self.HEADER.unpack(
+                fd.read(self.HEADER.size))
+            if magic != self.MAGIC or itemsize != array.array(self.TYPECODE).itemsize:
+                raise IOError("%s is not a packet index file" % filename)
+
+            for name in ("packet_id", "offset", "length", "end", "ts"):
+                a = array.array(self.TYPECODE)
+                try:
+                    a.fromfile(fd, count)
+                except EOFError:
+                    raise IOError("Packet index %s is truncated" % filename)
+
+                setattr(self, name, a)
+
+            self.timestamps = timestamps and fd.read().split("\n") or []
+            if len(self.timestamps) != timestamps:
+                raise IOError("Packet index %s is truncated" % filename)
+        finally:
+            fd.close()
+
 class StreamFile(File):
     """ A File like object to reassemble the stream from individual packets.
     
@@ -77,6 +203,9 @@ class StreamFile(File):
     """
     specifier = 'S'
 
+    ## The PacketIndex of this stream (loaded when first needed):
+    packet_index = None
+
     def __init__(self, case, fd, inode):
         File.__init__(self,case, fd, inode)
         dbh = DB.DBO(self.case)
@@ -107,10 +236,6 @@ class StreamFile(File):
         ## totally unrelated streams which happen at the same time.
         self.look_for_cached()
         self.read(0)
-        
-        ## This is a cache of packet lists that we keep so we do not
-        ## have to hit the db all the time.
-        self.packet_list = None
 
     def make_tabs(self):
         names, cbs = File.make_tabs(self)
@@ -181,8 +306,10 @@ class StreamFile(File):
 
         min_packet_id = sys.maxint
         
-        dbh.execute("select inode_id,seq,packet_id, length, cache_offset from `connection` where %s order by packet_id",(
-            " or ".join(["inode_id=%r" % a for a in stream_ids])
+        ## We build the packet index of the new stream as we go:
+        packets = []
+        dbh.execute("select `connection`.inode_id as inode_id, seq, packet_id, `connection`.length as length, cache_offset, ts_sec from `connection` left join pcap on pcap.id = `connection`.packet_id where %s order by packet_id",(
+            " or ".join(["`connection`.inode_id=%r" % a for a in stream_ids])
             ))
 
         dbh2.mass_insert_start("connection")
@@ -250,7 +377,12 @@ class StreamFile(File):
                 # packet came from
                 original_id = row['inode_id'])
 
+            packets.append((row['packet_id'], outfd_position, row['length'],
+                            row['ts_sec']))
+
         dbh2.mass_insert_commit()
+        self.packet_index = PacketIndex(packets)
+        self.save_packet_index()
 
         ## Close the output files, and the input files:
         out_fd.close()
@@ -290,42 +422,59 @@ class StreamFile(File):
         except DB.DBError, e:
             pyflaglog.log(pyflaglog.ERROR, "Failed to set the mtime for the combined stream %s" % self.inode)
 
+    def packet_index_filename(self):
+        """ The packet index is stored next to our cache file """
+        return CacheManager.make_cache_filename(
+            self.case, CacheManager.MANAGER.get_temp_path(self.case, self.inode) + ".packets")
+
+    def save_packet_index(self):
+        try:
+            self.packet_index.save(self.packet_index_filename())
+        except (IOError, OSError), e:
+            pyflaglog.log(pyflaglog.WARNING, "Unable to save the packet index of %s: %s" % (self.inode, e))
+
+    def get_packet_index(self):
+        """ Returns the PacketIndex of this stream. This is loaded from
+        the cache or built (with all the packet timestamps) in a
+        single query.
+        """
+        if self.packet_index is not None: return self.packet_index
+
+        try:
+            self.packet_index = PacketIndex(filename = self.packet_index_filename())
+            return self.packet_index
+        except (IOError, struct.error):
+            pass
+
+        dbh = DB.DBO(self.case)
+        dbh.execute("""select packet_id,cache_offset,`connection`.length as length,ts_sec from `connection` left join pcap on pcap.id = `connection`.packet_id where `connection`.inode_id = (select inode_id from inode where inode=%r limit 1)""",
+                    (self.inode))
+        self.packet_index = PacketIndex([ (row['packet_id'], row['cache_offset'],
+                                           row['length'], row['ts_sec']) for row in dbh ])
+        self.save_packet_index()
+
+        return self.packet_index
+
     def get_packet_id(self, position=None):
         """ Gets the current packet id (where the readptr is currently at) """
         if not position:
             position = self.tell()
 
-        if self.packet_list==None:
-            dbh = DB.DBO(self.case)
-            dbh.execute("""select packet_id,cache_offset,length from `connection` where inode_id = (select inode_id from inode where inode=%r limit 1) order by cache_offset asc, length desc """,
-                        (self.inode))
-            self.packet_list = [ (row['packet_id'],row['cache_offset'],row['length']) for row in dbh ]
-
-        ## Now try to find the packet_id in memory:
-        result = 0
-        for packet_id,cache_offset,length in self.packet_list:
-            #print self.inode_id, position, packet_id,cache_offset,length
-            if cache_offset + length >= position:
-                return packet_id
-
-        return 0
+        return self.get_packet_index().get_packet_id(position)
 
     def packet_data(self):
         """ A generator which generates a packet at a time """
-        self.get_packet_id(0)
-        for packet_id,cache_offset,length in self.packet_list:
+        for packet_id,cache_offset,length in self.get_packet_index().packets():
             self.seek(cache_offset)
             data = self.read(length)
             yield packet_id, cache_offset, data
 
     def get_packet_ts(self, position=None):
         """ Returns the timestamp of the current packet """
-        packet_id = self.get_packet_id(position)
-        dbh=DB.DBO(self.case)
-        dbh.execute("select ts_sec from pcap where id = %r" , packet_id)
-        row = dbh.fetch()
-        if row:
-            return row['ts_sec']
+        if not position:
+            position = self.tell()
+
+        return self.get_packet_index().get_packet_ts(position)
 
     def get_combined_fd(self):
         """ Returns an fd opened to the combined stream """
@@ -468,3 +617,52 @@ class NetworkForensicTests2(pyflag.tests.ScannerTest):
                              argv=["*",                   ## Inodes (All)
                                    "NetworkScanners",
                                    ])                   ## List of Scanners
+
+import unittest, random
+
+class PacketIndexTests(unittest.TestCase):
+    """ Packet index tests """
+    def linear_search(self, packets, position):
+        """ How get_packet_id used to find packets (packets must be
+        sorted by cache_offset and then longest first)
+        """
+        for packet_id, cache_offset, length, ts_sec in packets:
+            if cache_offset + length >= position:
+                return packet_id, ts_sec
+
+        return 0, None
+
+    def test01Lookup(self):
+        """ Test packet lookups against a linear search """
+        random.seed(1)
+        packets = []
+        offset = 0
+        for packet_id in range(1, 500):
+            ## Some packets are retransmitted and overlap:
+            if random.random() < 0.1:
+                start = max(0, offset - random.randint(0, 3000))
+            else:
+                start = offset
+
+            length = random.randint(0, 1500)
+            offset = max(offset, start + length)
+            packets.append((packet_id, start, length,
+                            random.choice(["2008-01-01 00:00:0%s" % i for i in range(3)] + [None])))
+
+        index = PacketIndex(packets)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            index.save(filename)
+            saved = PacketIndex(filename = filename)
+        finally:
+            os.unlink(filename)
+
+        packets.sort(key = lambda p: (p[1], -p[2]))
+        for position in range(0, offset + 100, 37):
+            expected = self.linear_search(packets, position)
+            for i in (index, saved):
+                self.assertEqual(i.get_packet_id(position), expected[0])
+                self.assertEqual(i.get_packet_ts(position), expected[1])
+
+        self.assertEqual(saved.packets(), index.packets())
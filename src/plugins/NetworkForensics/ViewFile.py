@@ -87,7 +87,7 @@ class ViewFile(Reports.report):
         try:
             if query['hint']: content_type=query['hint']
         except KeyError:      
-            m = Magic.MagicResolver()
+            m = Magic.get_resolver()
             type, content_type = m.find_inode_magic(self.case, inode_id)
 
         return content_type
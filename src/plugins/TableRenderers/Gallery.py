@@ -16,7 +16,7 @@ class GalleryRenderer(HTMLBundle.HTMLDirectoryRenderer):
     def render_cell(self, inode_id):
         """ Renders a single inode_id """
         filename, ct, fd = self.make_archive_filename(inode_id, directory = "thumbnails/")
-        image = Graph.Thumbnailer(fd, 200)
+        image = Graph.Thumbnailer(fd, Graph.THUMBNAIL_SIZE)
 
         inode_filename,ct, fd = self.make_archive_filename(inode_id)
         
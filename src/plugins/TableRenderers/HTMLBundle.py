@@ -40,6 +40,9 @@ import pyflag.HTMLUI as HTMLUI
 from pyflag.DB import expand
 import re
 
+## We change how InodeIDType renders when we are imported:
+eager = True
+
 config.add_option("REPORTING_DIR", default=config.RESULTDIR + "/Reports",
                   help = "Directory to emit reports into.")
 
@@ -441,7 +444,7 @@ class HTMLDirectoryRenderer(UI.TableRenderer):
         fsfd = FileSystem.DBFS(self.case)
         fd = fsfd.open(inode_id = inode_id)
 
-        m = Magic.MagicResolver()
+        m = Magic.get_resolver()
 
         ## Use the magic in the file:
         try:
@@ -100,21 +100,24 @@ class DBOTest(tests.ScannerTest):
         result = [ row['field1'] for row in dbh ]
         self.assertEqual(result, range(0,10))
 
-        ## Make sure we came from the cache:
-        cached_sql = dbh.cursor._last_executed
-        self.assert_('cache_' in cached_sql)
+        ## Make sure the second query comes from the cache:
+        dbh.execute("select 1")
+        dbh.cached_execute("select * from %s" % tablename)
+        self.assert_(dbh.cursor._last_executed.startswith("select table_name, generation"))
+        self.assertEqual([ row['field1'] for row in dbh ], result)
 
         ## Update the underlying table:
         dbh.insert(tablename, field1=1)
 
-        ## query the cache again:
+        ## query the cache again - we must see the new row:
         dbh.cached_execute("select * from %s" % tablename)
         result2 = [ row['field1'] for row in dbh ]
 
         self.assertEqual(result2, result + [1,])
 
-        ## Make sure we have a different cache entry
-        self.assert_(cached_sql != dbh.cursor._last_executed)
+        ## Paging within the cached window:
+        dbh.cached_execute("select * from %s" % tablename, limit=2, length=3)
+        self.assertEqual([ row['field1'] for row in dbh ], [2,3,4])
 
     def test07CaseExecuteRace(self):
         """ Test for race conditions in cache creation """
@@ -196,7 +199,39 @@ class DBOTest(tests.ScannerTest):
             row = dbh.fetch()
             self.assert_(row['binary_md5']==test_string,
                          "%r != %r" % (test_string, row['binary_md5']))
-            
+
+    def test11DeferredInvalidation(self):
+        """ Test that table generations are bumped per statement or per batch """
+        dbh = DB.DBO(self.test_case)
+        tablename = self.createTestTable(dbh)
+
+        def generation():
+            dbh.execute("select generation from table_generations where table_name=%r",
+                        tablename)
+            return dbh.fetch()['generation']
+
+        ## Single statements are seen by other processes at once:
+        old = generation()
+        dbh.insert(tablename, field1=10)
+        self.assertEqual(generation(), old + 1)
+
+        ## Batches only bump the generation when they are done:
+        old = generation()
+        dbh.mass_insert_start(tablename)
+        for i in range(10):
+            dbh.mass_insert(field1=i)
+
+        self.assertEqual(generation(), old)
+        dbh.mass_insert_commit()
+        self.assertEqual(generation(), old + 1)
+
+        ## Bumping the generation does not lose the insert id:
+        dbh.execute("create table %s_auto(id int auto_increment primary key, field1 int)",
+                    tablename)
+        dbh.insert(tablename + "_auto", field1=1)
+        dbh.insert(tablename + "_auto", field1=2)
+        self.assertEqual(dbh.autoincrement(), 2)
+        dbh.execute("drop table %s_auto", tablename)
 
 def print_stats():
     dbh = DB.DBO("mysql")
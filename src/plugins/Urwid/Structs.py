@@ -8,6 +8,9 @@ import pyflag.format as format
 urwid = Hexeditor.urwid
 import pyflag.FlagFramework as FlagFramework
 
+## We add urwid_output to DataType when we are imported:
+eager = True
+
 ## The default DataType action is to print itself as a text UI:
 def urwid_output(self, ui, offset):
     return urwid.Text(('body',self.__str__()))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Finds the signatures of many carvers in a single pass over the data.
+
+All signatures are compiled into the indexer's trie, so the cost of a
+pass does not depend much on the number of signatures. Each signature
+has a target (e.g. the carver which registered it), and we report
+hits as a sorted list of (offset, target).
+
+Signatures may be given in the indexer's regex syntax, or as python
+regular expressions. The indexer does not support groups or
+alternation, so for python regexes we give the indexer the longest
+prefix it understands and check its hits with the full regex.
+
+Data may be scanned in one go (scan_buffer()), from a file like
+object (scan()) or as a stream of blocks (stream()). Blocks overlap
+by OVERLAP bytes so we never miss signatures across block boundaries.
+"""
+import index, re
+
+## Signatures are checked within this many bytes:
+OVERLAP = 1024
+
+def indexer_prefix(regex):
+    """ Returns the longest prefix of the python regex which the
+    indexer understands (groups, alternation and anchors are not
+    supported).
+    """
+    prefix = None
+    depth = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            i += 2
+            continue
+
+        ## Character classes may contain anything:
+        if c == '[':
+            end = regex.find(']', i + 2)
+            if end < 0: return ''
+            i = end + 1
+            continue
+
+        if c in "()^$" and prefix is None:
+            prefix = regex[:i]
+
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+
+        ## With top level alternation no prefix is common to all
+        ## matches:
+        elif c == '|' and depth == 0:
+            return ''
+
+        i += 1
+
+    if prefix is None:
+        return regex
+
+    return prefix
+
+class CarveEngine:
+    """ A set of signatures matched in one pass """
+    def __init__(self):
+        self.indexer = index.Index()
+
+        ## A list of [target, python regex] for each signature id:
+        self.signatures = []
+
+        ## The signature ids of each word given to the indexer (the
+        ## same word may be used by many signatures):
+        self.words = {}
+        self.word_ids = []
+
+        ## Signatures we can not give to the indexer at all:
+        self.unindexed = []
+
+    def add(self, regex, target, python=False):
+        """ Adds the signature regex. Hits are reported with target.
+
+        If python is set, regex is a python regular expression,
+        otherwise it is in the indexer's syntax.
+        """
+        id = len(self.signatures)
+        if python:
+            cregex = re.compile(regex)
+            prefix = indexer_prefix(regex)
+        else:
+            cregex = None
+            prefix = regex
+
+        self.signatures.append([target, cregex])
+        if prefix:
+            try:
+                self.word_ids[self.words[prefix]].append(id)
+            except KeyError:
+                self.words[prefix] = len(self.word_ids)
+                self.word_ids.append([id])
+                self.indexer.add_word(prefix, self.words[prefix], index.WORD_EXTENDED)
+        else:
+            self.unindexed.append(id)
+
+    def scan_buffer(self, data, base=0, limit=None):
+        """ Returns the hits in data which start before limit.
+
+        base is the offset of data in the file.
+        """
+        if limit is None:
+            limit = len(data)
+
+        hits = set()
+        for offset, matches in self.indexer.index_buffer(data, unique=0):
+            if offset >= limit: continue
+
+            for word_id, length in matches:
+                for id in self.word_ids[word_id]:
+                    target, cregex = self.signatures[id]
+                    if cregex and not cregex.match(data, offset):
+                        continue
+
+                    hits.add((offset + base, id))
+
+        for id in self.unindexed:
+            target, cregex = self.signatures[id]
+            for m in cregex.finditer(data, 0, limit + OVERLAP):
+                if m.start() >= limit: break
+                hits.add((m.start() + base, id))
+
+        hits = list(hits)
+        hits.sort()
+
+        return [ (offset, self.signatures[id][0]) for offset, id in hits ]
+
+    def stream(self):
+        return SignatureStream(self)
+
+    def scan(self, fd, blocksize=1024*1024):
+        """ Returns all the hits in fd (read from its current position) """
+        stream = self.stream()
+        result = []
+        while 1:
+            data = fd.read(blocksize)
+            if not data: break
+
+            result.extend(stream.process(data))
+
+        result.extend(stream.finish())
+        return result
+
+class SignatureStream:
+    """ Finds hits in data given a block at the time """
+    def __init__(self, engine):
+        self.engine = engine
+        self.tail = ''
+        self.offset = 0
+
+    def process(self, data, final=False):
+        """ Returns the hits we are sure about so far """
+        data = self.tail + data
+        if final:
+            limit = len(data)
+        else:
+            limit = max(0, len(data) - OVERLAP)
+
+        hits = self.engine.scan_buffer(data, self.offset, limit)
+
+        ## Hits in the last OVERLAP bytes are reported with the next
+        ## block:
+        self.tail = data[limit:]
+        self.offset += limit
+
+        return hits
+
+    def finish(self):
+        return self.process('', final=True)
+
+## Unit tests:
+import unittest, random, cStringIO
+
+class CarveEngineTests(unittest.TestCase):
+    """ Single pass signature matching """
+    def test01Prefix(self):
+        """ Test python regex prefixes """
+        self.assertEqual(indexer_prefix("\\xff\\xd8....(JFIF|Exif)"), "\\xff\\xd8....")
+        self.assertEqual(indexer_prefix("GIF8[79]a"), "GIF8[79]a")
+        self.assertEqual(indexer_prefix("ab(c)?"), "ab")
+        self.assertEqual(indexer_prefix("ab[(|]c*"), "ab[(|]c*")
+        self.assertEqual(indexer_prefix("(a|b)"), "")
+        self.assertEqual(indexer_prefix("ab|cd"), "")
+
+    def test02Stream(self):
+        """ Test that hits across blocks are found once """
+        random.seed(1)
+        signatures = [ "PK\x03\x04", "GIF8[79]a", "%PDF-" ]
+        parts = []
+        expected = []
+        offset = 0
+        for i in range(300):
+            junk = "".join([ chr(random.randint(0x61, 0x7a)) for j in range(random.randint(0, 3000)) ])
+            word = random.choice([ "PK\x03\x04", "GIF87a", "GIF89a", "%PDF-" ])
+            parts.append(junk)
+            offset += len(junk)
+            expected.append((offset, word))
+            parts.append(word)
+            offset += len(word)
+
+        data = "".join(parts)
+        engine = CarveEngine()
+        for s in signatures:
+            engine.add(s, s)
+
+        ## A python regex, and one the indexer can not help with:
+        engine.add("GIF8(7|9)a", "python", python=True)
+        engine.add("(%PDF-)", "unindexed", python=True)
+        engine.add("GIF8[79]a", "again")
+
+        for blocksize in (100, 4096, len(data)):
+            hits = engine.scan(cStringIO.StringIO(data), blocksize)
+            for offset, word in expected:
+                if word.startswith("GIF"):
+                    self.assert_((offset, "GIF8[79]a") in hits)
+                    self.assert_((offset, "python") in hits)
+                    self.assert_((offset, "again") in hits)
+                elif word.startswith("%PDF"):
+                    self.assert_((offset, "unindexed") in hits)
+                    self.assert_((offset, word) in hits)
+                else:
+                    self.assert_((offset, word) in hits)
+
+            self.assertEqual(len(hits), len(expected) + \
+                             len([ w for o, w in expected if w[0] == "%" ]) + \
+                             2 * len([ w for o, w in expected if w[0] == "G" ]))
@@ -403,6 +403,7 @@ class Reassembler:
             self.add_point(p, c.mapping[p], c.comments[p])
 
 from optparse import OptionParser
+import pyflag.CarveEngine as CarveEngine
 
 class CarverFramework:
     """ This base class is the framework for building advanced
@@ -450,34 +451,24 @@ class CarverFramework:
 
         self.parser = parser
 
-    cregexs = {}
     regexs = {}
     
     def build_index(self, index_file):
         hits = {}
-        ## Compile the res
+        ## All the regexes are searched for in a single pass:
+        engine = CarveEngine.CarveEngine()
         for k,v in self.regexs.items():
-            self.cregexs[k] = re.compile(v)
-
-        BLOCK_SIZE = 4096
+            engine.add(v, k, python=True)
 
         p = pickle.Pickler(open(index_file,'w'))
 
-        offset = 0
         fd = open(self.args[0],'r')
-        while 1:
-            data = fd.read(BLOCK_SIZE)
-            if len(data)==0: break
-
-            for k,v in self.cregexs.items():
-                for m in v.finditer(data):
-                    print "Found %s in %s" % (k, offset + m.start())
-                    try:
-                        hits[k].append(offset + m.start())
-                    except KeyError:
-                        hits[k] = [ offset + m.start(), ]
-
-            offset += len(data)
+        for offset, k in engine.scan(fd):
+            print "Found %s in %s" % (k, offset)
+            try:
+                hits[k].append(offset)
+            except KeyError:
+                hits[k] = [ offset, ]
 
         ## Serialise the hits into a file:
         p.dump(hits)
@@ -41,7 +41,7 @@ import pyflag.TypeCheck as TypeCheck
 import pyflag.FileSystem as FileSystem
 import socket,re
 import pyflag.Time as Time
-import time, textwrap
+import time, textwrap, inspect
 import pyflag.Registry as Registry
 import re,struct, textwrap
 import pyflag.TableActions as TableActions
@@ -400,6 +400,44 @@ class ColumnType:
         """
         return self.column, value
 
+    ## Log files may be bulk loaded (see LogFile.Log.load), in which
+    ## case values are written to a file which the database loads
+    ## directly, so they can not be sql expressions.
+    def load_value(self, value):
+        """ Returns the value to write into the bulk load file (None
+        for NULL).
+
+        Column types which insert() sql expressions must override this
+        and load_set().
+        """
+        result = self.insert(value)
+        if not result: return None
+
+        key, value = result
+        if key.startswith("_"):
+            raise RuntimeError("Column type %s can not be bulk loaded" % self.__class__.__name__)
+
+        return value
+
+    def load_set(self, variable):
+        """ Returns the sql expression which sets this column from
+        the user variable loaded from the file, or None to load the
+        column directly.
+        """
+        return None
+
+    def bulk_loadable(self):
+        """ Returns True if this column can be bulk loaded.
+
+        Column types which override insert() may insert sql
+        expressions, so they must also override load_value().
+        """
+        for cls in inspect.getmro(self.__class__):
+            if 'load_value' in cls.__dict__: return True
+            if 'insert' in cls.__dict__: return False
+
+        return True
+
     def select(self):
         """ Returns the SQL required for selecting from the table. """
         return self.escape_column_name(self.column)
@@ -932,6 +970,12 @@ class IPType(ColumnType, LogParserMixin):
     def insert(self,value):
         return "_"+self.column, DB.expand("inet_aton(%r)", value.strip())
 
+    def load_value(self, value):
+        return value.strip()
+
+    def load_set(self, variable):
+        return "inet_aton(%s)" % variable
+
     display_hooks = IntegerType.display_hooks[:]
 
 class InodeType(StringType):
@@ -1381,3 +1425,21 @@ class ColumnTypeTests(pyflag.tests.ScannerTest):
         self.assertEqual(self.generate_sql("InodeIDType contains 'Z|' and TimestampType after 2005-10-10"),
                          "(1) and ((`inode`.`inode_id` in (select inode_id from inode where inode like '%Z|%')) and `timestamp` > '2005-10-10 00:00:00')")
 
+
+    def test06BulkLoadable(self):
+        """ Test which column types can be bulk loaded """
+        for e in self.elements:
+            self.assert_(e.bulk_loadable(), "%s should be bulk loadable" % e.__class__.__name__)
+
+        class ExpressionType(StringType):
+            def insert(self, value):
+                return "_"+self.column, DB.expand("upper(%r)", value)
+
+        self.assertFalse(ExpressionType('Expression', 'expression').bulk_loadable())
+
+        ## Overriding insert() in a bulk loadable type is not enough:
+        class HexIPType(IPType):
+            def insert(self, value):
+                return "_"+self.column, DB.expand("conv(%r,16,10)", value)
+
+        self.assertFalse(HexIPType('HexIP', 'hex_ip').bulk_loadable())
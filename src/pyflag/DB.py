@@ -35,7 +35,7 @@ import pyflag.conf
 config = pyflag.conf.ConfObject()
 
 import pyflag.pyflaglog as pyflaglog
-import time,types
+import time,types,atexit
 from Queue import Queue, Full, Empty
 from MySQLdb.constants import FIELD_TYPE, FLAG
 import threading
@@ -71,7 +71,7 @@ config.add_option("DBUNIXSOCKET", default="/var/run/mysqld/mysqld.sock",
                 help="path to mysql socket")
 
 config.add_option("DBCACHE_AGE", default=60, type='int',
-                help="The length of time table searches remain cached")
+                help="The length of time (in minutes) table searches remain cached")
 
 config.add_option("DBCACHE_LENGTH", default=1024, type='int',
                 help="Number of rows to cache for table searches")
@@ -83,12 +83,15 @@ config.add_option("TABLE_QUERY_TIMEOUT", default=10, type='int',
                   help="The table widget will timeout queries after this many seconds")
 
 config.add_option("SQL_CACHE_MODE", default="realtime",
-                  help="The SQL Cache mode (can be realtime, periodic, all) see the wiki page for explaination")
+                  help="The SQL Cache mode. In realtime mode cached table searches are invalidated when their tables change, otherwise they are only refreshed after DBCACHE_AGE minutes")
 
 config.add_option("DB_SS_CURSOR", default=False,
                   action='store_true',
                   help = "Enable server side database cursors")
 
+config.add_option("DB_STATEMENT_CACHE", default=1000, type='int',
+                  help = "Number of parsed query statements to keep")
+
 import types
 import MySQLdb.converters
 
@@ -115,6 +118,13 @@ def escape(result, quote='\''):
 
     return result
 
+def load_escape(value):
+    """ Escapes value for a file loaded by PooledDBO.load_data() """
+    if value is None:
+        return "\\N"
+
+    return escape(force_string(value), quote='')
+
 def glob2re(glob):
     """ Convert a shell wildcard to a mysql compatible regex for use with rlike """
     # special chars are *, ? which are replaced by ".*" and "." respectively (if not escaped)
@@ -191,6 +201,89 @@ def expand(format, params):
 
     return result
 
+class Statement:
+    """ A parsed query format string.
+
+    The format string is split into its literal parts and its
+    %r, %s and %b format sequences once, so expanding the same query
+    for different parameters does not need to parse it again. Use
+    prepare() to get statements from the statement cache.
+    """
+    def __init__(self, sql):
+        self.sql = sql
+        parts = expand_re.split(sql)
+        self.literals = parts[0::2]
+        self.formats = parts[1::2]
+
+    def expand(self, params):
+        if isinstance(params, basestring):
+            params = (params,)
+
+        try:
+            params[0]
+        except:
+            params = (params,)
+
+        literals = self.literals
+        result = [ literals[0] ]
+        i = 0
+        for f in self.formats:
+            x = params[i]
+            if f=='s':
+                result.append(force_string(x))
+
+            ## Raw escaping
+            elif f=='r':
+                result.append("'%s'" % escape(force_string(x), quote="'"))
+
+            ## This needs to be binary escaped:
+            else:
+                result.append("_binary'%s'" % escape(x))
+
+            i += 1
+            result.append(literals[i])
+
+        return ''.join(result)
+
+## Parsed statements keyed by their format string:
+STATEMENTS = {}
+
+## Counts how many statements were parsed and how many were reused
+## from the cache:
+STATEMENT_STATS = dict(parsed = 0, reused = 0)
+
+def prepare(sql):
+    """ Returns a Statement for the sql format string.
+
+    Statements are parsed once and then reused from the cache. Very
+    long strings (e.g. mass inserts) are not cached since they are
+    unlikely to recur.
+    """
+    sql = str(sql)
+    try:
+        result = STATEMENTS[sql]
+        STATEMENT_STATS['reused'] += 1
+        return result
+    except KeyError:
+        pass
+
+    result = Statement(sql)
+    STATEMENT_STATS['parsed'] += 1
+    if len(sql) < 1024:
+        if len(STATEMENTS) >= config.DB_STATEMENT_CACHE:
+            STATEMENTS.clear()
+
+        STATEMENTS[sql] = result
+
+    return result
+
+def statement_stats():
+    """ Returns a copy of the statement cache counters """
+    result = STATEMENT_STATS.copy()
+    result['cached'] = len(STATEMENTS)
+
+    return result
+
 def db_expand(sql, params):
     """ A utility function for interpolating into the query string.
     
@@ -209,46 +302,28 @@ def db_expand(sql, params):
     to utf8 when sending to the server and the binary data will be
     corrupted.
     """
-    sql = str(sql)
-    d = dict(count = 0)
-
-    if isinstance(params, basestring):
-        params = (params,)
-
-    try:
-        params[0]
-    except:
-        params = (params,)
-
-    def cb(m):
-        x = params[d['count']]
-        
-        if m.group(1)=="s":
-            #result = u"%s" % (force_unicode(params[d['count']]))
-            result = force_string(x)
-            
-        ## Raw escaping
-        elif m.group(1)=='r':
-            result = force_string(x)
-            result = "'%s'" % escape(result, quote="'")
-            #result = u"'%s'" % escape(force_unicode(params[d['count']]), quote="'")
-            #result = u"'%s'" % escape(force_unicode(params[d['count']]))
-
-        ## This needs to be binary escaped:
-        elif m.group(1)=='b':
-            #data = params[d['count']].decode("latin1")
-            data = params[d['count']]
-            #data = ''.join(r"\\x%02X" % ord(x) for x in params[d['count']])
-            #data = params[d['count']]
-            result = "_binary'%s'" % escape(data)
-            #print result.encode("ascii","ignore")
+    return prepare(sql).expand(params)
 
-        d['count'] +=1
-        return result
+## Matches insert statements with a values clause which executemany()
+## can send as one multi row insert:
+insert_values_re = re.compile(r"^(\s*(?:insert|replace)\b.+?\bvalues\s*)(\(.*)$",
+                              re.I | re.S)
 
-    result = expand_re.sub(cb,sql)
+def group_end(sql):
+    """ Returns the index just past the parenthesised group sql starts
+    with (e.g. the values of '(...) on duplicate key update
+    x=values(x)'), or -1 if the group is not closed.
+    """
+    depth = 0
+    for i in range(len(sql)):
+        if sql[i]=='(':
+            depth += 1
+        elif sql[i]==')':
+            depth -= 1
+            if depth==0:
+                return i + 1
 
-    return result
+    return -1
 
 class PyFlagDirectCursor(MySQLdb.cursors.DictCursor):
     ignore_warnings = False
@@ -367,14 +442,20 @@ class PyFlagCursor(MySQLdb.cursors.SSDictCursor):
 
             self.py_row_cache.extend(results)
 
-def mysql_connect(case):
-    """ Connect specified case and return a new connection handle """
+def mysql_connect(case, local_infile=False):
+    """ Connect specified case and return a new connection handle
+
+    @arg local_infile: Allow LOAD DATA LOCAL INFILE on this connection
+    (see load_data()). This lets the server read any file we can read,
+    so it is only enabled on the connections which need it.
+    """
     global db_connections, mysql_connection_args
 
     ## If we already know the connection args we just go for it
     if mysql_connection_args:
         mysql_connection_args['db'] = case
-        dbh=MySQLdb.Connection(**mysql_connection_args)
+        dbh=MySQLdb.Connection(local_infile=int(local_infile),
+                               **mysql_connection_args)
         dbh.autocommit(True)
         return dbh
 
@@ -384,7 +465,7 @@ def mysql_connect(case):
                 port=config.DBPORT,
                 conv = conv,
                 use_unicode = True,
-                charset='utf8'
+                charset='utf8',
                 )
 
     if config.DBPASSWD:
@@ -401,14 +482,16 @@ def mysql_connect(case):
         
     try:
         #Try to connect over TCP
-        dbh = MySQLdb.Connect(**mysql_connection_args)
+        dbh = MySQLdb.Connect(local_infile=int(local_infile),
+                              **mysql_connection_args)
     except Exception,e:
         ## or maybe over the socket?
         mysql_connection_args['unix_socket'] = config.DBUNIXSOCKET
         del mysql_connection_args['host']
         del mysql_connection_args['port']
 
-        dbh = MySQLdb.Connect(**mysql_connection_args)
+        dbh = MySQLdb.Connect(local_infile=int(local_infile),
+                              **mysql_connection_args)
 
     dbh.autocommit(True)
 
@@ -467,7 +550,9 @@ class Pool(Queue):
         """Get an object from the pool or a new one if empty."""
         try:
             try:
-                result=self.empty() and mysql_connect(self.case) or Queue.get(self, block)
+                ## Do not wait for a handle when the pool is empty - its
+                ## quicker to make a new one:
+                result = Queue.get(self, False)
 
                 pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Getting dbh from pool %s" % self.case)
             except Empty:
@@ -528,6 +613,7 @@ class PooledDBO:
         self.case = case
         self.cursor = self.dbh.cursor()
         self.tranaction = False
+        self.insert_id = None
 
     def start_transaction(self):
         self.execute("start transaction")
@@ -557,8 +643,10 @@ class PooledDBO:
         except (AttributeError,IndexError):
             pass
 
+        self.cached_rows = None
+        self.insert_id = None
         if params:
-            string = db_expand(query_str, params)
+            string = prepare(query_str).expand(params)
         else: string = query_str
         try:
             self.cursor.execute(string)
@@ -597,156 +685,177 @@ class PooledDBO:
             elif not str.startswith('Records'):
                 raise DBError(e)
 
-    def expire_cache(self):
-        """ Expires the cache if needed """
-        ## Expire the cache if needed
-        self.start_transaction()
-        try:
-            self.execute("select * from sql_cache where timestamp < date_sub(now(), interval %r minute) for update", config.DBCACHE_AGE)
-            ## Make a copy to maintain the cursor
-            tables = [ row['id'] for row in self ]
-            for table_id in tables:
-                self.execute("delete from sql_cache where id = %r" , table_id)
-                self.execute("delete from sql_cache_tables where sql_id = %r" , table_id)
-                self.execute("drop table if exists `cache_%s`" , table_id)
-                
-        finally:
-            self.end_transaction()
-            
+    def executemany(self, query_str, seq_of_params):
+        """ Executes the same query for each set of parameters.
+
+        The query is only parsed once. Insert statements with a single
+        values clause are sent as multi row inserts of at most
+        MASS_INSERT_THRESHOLD rows, other statements are executed one
+        at a time. Anything following the values clause (e.g. an on
+        duplicate key update clause) may not contain format sequences.
+
+        >>> a.executemany("insert into %s values (%r,%r)",
+        ...               [ ('table', 1, 'a'), ('table', 2, 'b') ])
+
+        Note that unlike insert() this does not invalidate the cache,
+        callers must call invalidate() on the tables they touch.
+        """
+        m = insert_values_re.match(str(query_str))
+        if m:
+            end = group_end(m.group(2))
+            suffix = m.group(2)[end:]
+
+        if not m or end < 0 or expand_re.search(suffix):
+            for params in seq_of_params:
+                self.execute(query_str, params)
+
+            return
+
+        prefix = prepare(m.group(1))
+        values = prepare(m.group(2)[:end])
+        count = len(prefix.formats)
+        rows = []
+        first = None
+        for params in seq_of_params:
+            params = tuple(params)
+            ## The prefix may also contain format sequences (e.g. the
+            ## table name) - these must be the same for all rows since
+            ## they are sent in the same statement:
+            if first is None:
+                first = params[:count]
+                sql = prefix.expand(first)
+            elif params[:count] != first:
+                raise DBError("executemany: row %r does not match the statement prefix %r" % (params, first))
+
+            if len(params) != count + len(values.formats):
+                raise DBError("executemany: row %r has %s parameters, expected %s" % (
+                    params, len(params), count + len(values.formats)))
+
+            rows.append(values.expand(params[count:]))
+            if len(rows) >= config.MASS_INSERT_THRESHOLD:
+                self.execute(sql + ",".join(rows) + suffix)
+                rows = []
+
+        if rows:
+            self.execute(sql + ",".join(rows) + suffix)
+
     def cached_execute(self, sql, limit=0, length=50):
-        """ Executes the sql statement using the cache.
+        """ Executes the sql statement using the result cache.
 
-        strategy: Check the sql_cache table for the row, if it does not exist, make it
-        if its in progress, spin for a while
-        if its cached return it.
-        
+        We cache a window of DBCACHE_LENGTH rows centered on the
+        required range - this allows quick paging forward and
+        backwards. The rows are then returned by fetch() just as if we
+        executed the query.
         """
-        if config.SQL_CACHE_MODE=="realtime":
-            self.expire_cache()
-            
-        self.execute("""select * from sql_cache where query = %r and `limit` <= %r and `limit` + `length` >= %r order by id limit 1 for update""", (sql, limit, limit + length))
-        row = self.fetch()
-        if not row:
-            ## Row does not exist - make it
-            return self._make_sql_cache_entry(sql, limit, length)
-        elif row['status'] == 'dirty':
-            if config.SQL_CACHE_MODE == "realtime":
-                ## Row is dirty - make it
-                self._make_sql_cache_entry(sql, limit, length)
-            else:
-                ## We dont care about dirty rows now
-                return self.execute("select * from cache_%s limit %s,%s",
-                                    (row['id'], limit - row['limit'], length))
-            
-        elif row['status'] == 'cached':
-            return self.execute("select * from cache_%s limit %s,%s",
-                                (row['id'], limit - row['limit'], length))
-        elif row['status'] == 'progress':
-            ## Spin until its ready
-            count = config.TABLE_QUERY_TIMEOUT
-            while count > 0:
-                self.execute("select * from sql_cache where id=%r and status!='progress' limit 1", row['id'])
-                row2=self.fetch()
-                if row2:
-                    return self.execute("select * from cache_%s limit %s,%s",
-                                        (row['id'], limit - row['limit'], length))
-
-                time.sleep(1)
-                count -= 1
-                pyflaglog.log(pyflaglog.DEBUG,"Waiting for query to complete for %u" % count)
-            raise DBError("Query still executing - try again soon")
-
-    def _make_sql_cache_entry(self, sql, limit, length):
-        ## Query is not in cache - create a new cache entry: We create
-        ## the cache centered on the required range - this allows
-        ## quick paging forward and backwards.
-        lower_limit = max(limit - config.DBCACHE_LENGTH/2,0)
+        import pyflag.ResultCache as ResultCache
 
-        ## Determine which tables are involved:
-        self.execute("explain %s", sql)
-        tables = [ row['table'] for row in self if row['table'] ]
-            
+        tables = self.query_tables(sql)
         if not tables:
             ## Should not happen - the query does not affect any tables??
             return self.execute("%s limit %s,%s",sql, limit, length)
 
-        self.insert('sql_cache',
-                    query = sql, _timestamp='now()',
-                    limit = lower_limit,
-                    length = config.DBCACHE_LENGTH,
-                    status = 'progress',
-                    _fast = True
-                    )
+        lower_limit = max(limit - config.DBCACHE_LENGTH/2,0)
+        key = ResultCache.make_key(self.case, sql, lower_limit,
+                                   config.DBCACHE_LENGTH,
+                                   self.table_generations(tables))
+        cache = ResultCache.get_cache()
+        try:
+            rows = cache.get(key)
+        except KeyError:
+            self.execute("%s limit %s,%s", (sql, lower_limit, config.DBCACHE_LENGTH))
+            rows = [ row for row in self ]
+            cache.put(key, rows)
 
-        ## Create the new table
-        id = self.autoincrement()
-            
-        ## Store the tables in the sql_cache_tables:
-        for t in tables:
-            self.insert('sql_cache_tables',
-                        sql_id = id,
-                        table_name = t,
-                        _fast = True)
-            
-        ## Now comes the tricky part
-        def run_query():
-            dbh = DBO(self.case)
-            dbh.discard = True
-            try:
-                dbh.execute("create table cache_%s %s limit %s,%s",
-                            (id,sql, lower_limit, config.DBCACHE_LENGTH))
-                for row in dbh: pass
-                dbh.execute("update sql_cache set status='cached' where id=%r" , id)
-                dbh.execute("commit")
-            except Exception,e:
-                ## Make sure we remove the progress status from the
-                ## table
-                dbh.execute("delete from sql_cache where id=%r", id)
-                raise
-            
-        ## We start by launching a worker thread
-        worker = threading.Thread(target=run_query)
-        worker.start()
+        self.cached_rows = iter(rows[limit - lower_limit:limit - lower_limit + length])
 
-        ## Wait for the worker to finish
-        worker.join(config.TABLE_QUERY_TIMEOUT)
-        if worker.isAlive():
-            raise DBError("Query still executing - try again soon")
+    def query_tables(self, sql):
+        """ Returns the tables the select statement sql reads from """
+        import pyflag.ResultCache as ResultCache
 
-        for i in range(config.TABLE_QUERY_TIMEOUT):
-            try:
-                return self.execute("select * from cache_%s limit %s,%s",
-                                    (id,limit - lower_limit,length))
-            except DBError,e:
-                ## Sometimes it takes a while for the table to be
-                ## available to the two threads. (Is this normal -
-                ## this seems like a weird race?)
-                if "doesn't exist" in e.__str__():
-                    time.sleep(1)
-                else:
-                    break
+        cache_key = "%s|%s" % (self.case, ResultCache.normalise(sql))
+        try:
+            return ResultCache.TABLES.get(cache_key)
+        except KeyError:
+            self.execute("explain %s", sql)
+            tables = [ row['table'] for row in self if row['table'] ]
+            ResultCache.TABLES.put(tables, key=cache_key)
+
+        return tables
+
+    def table_generations(self, tables):
+        """ Returns a list of (table, generation) for the tables.
 
-        raise e
+        A table's generation changes every time it is invalidated.
+        """
+        ## Make sure we see our own writes:
+        self.commit_invalidations()
+
+        result = dict([ (t, 0) for t in tables ])
+        try:
+            self.execute("select table_name, generation from table_generations where table_name in (%s)",
+                         ",".join([ db_expand("%r", t) for t in result.keys() ]))
+        except DBError:
+            ## The table does not exist yet, so nothing was invalidated:
+            return result.items()
+
+        for row in self:
+            result[row['table_name']] = row['generation']
+
+        return result.items()
             
     def __iter__(self):
         return self
 
     def invalidate(self,table):
-        """ Invalidate all copies of the cache which relate to this table """
+        """ Invalidate all copies of the cache which relate to this table
+
+        We just bump the table's generation - cached results are keyed
+        by the generations of their tables so they will not be found
+        again (see ResultCache).
+
+        The table is only remembered here and its generation is
+        bumped by commit_invalidations(). insert(), update(), delete()
+        and drop() call it straight after their statement so other
+        processes see the change at once. Bumping the generation for
+        every row of a batch would make all writers contend for the
+        same rows, so batches only call it when they are done
+        (mass_insert_commit(), load_data(), BatchWriter.flush() and
+        Scanner.flush_scanner_cache()). It is also called before this
+        process reads the generations and when the process exits.
+        """
         if config.SQL_CACHE_MODE=='realtime':
-            self.execute("start transaction")
+            INVALIDATION_LOCK.acquire()
             try:
-                try:
-                    self.execute("select sql_id from sql_cache_tables where `table_name`=%r for update", table)
-                except Exception, e:
-                    pass
-                ids = [row['sql_id'] for row in self]
-                for id in ids:
-                    self.execute("delete from sql_cache where id=%r", id)
-                    self.execute("delete from sql_cache_tables where sql_id=%r", id)
-                    self.execute("drop table if exists cache_%s", id)
+                PENDING_INVALIDATIONS.setdefault(self.case, set()).add(table)
             finally:
-                self.end_transaction()
+                INVALIDATION_LOCK.release()
+
+    def commit_invalidations(self):
+        """ Bumps the generations of the tables in our case which were
+        invalidated by this process.
+        """
+        INVALIDATION_LOCK.acquire()
+        try:
+            tables = PENDING_INVALIDATIONS.pop(self.case, None)
+        finally:
+            INVALIDATION_LOCK.release()
+
+        if not tables: return
+
+        ## Bumping the generations resets the insert id of the
+        ## statement before us, but autoincrement() still needs it:
+        insert_id = self.cursor.connection.insert_id()
+
+        sql = "insert into table_generations (table_name, generation) values (%r, 1) on duplicate key update generation=generation+1"
+        rows = [ (t,) for t in tables ]
+        try:
+            self.executemany(sql, rows)
+        except DBError:
+            ## Older cases do not have the table yet:
+            create_table_generations(self)
+            self.executemany(sql, rows)
+
+        self.insert_id = insert_id
 
     def _calculate_set(self, **fields):
         """ Calculates the required set clause from the fields provided """
@@ -773,17 +882,22 @@ class PooledDBO:
         if not _fast:
             self.invalidate(table)
         self.execute(sql, [table,] + args + [where,])
+        if not _fast:
+            self.commit_invalidations()
 
     def drop(self, table):
         self.invalidate(table)
         self.execute("drop table if exists `%s`", table)
+        self.commit_invalidations()
 
     def delete(self, table, where='0', _fast=False):
         sql = "delete from %s where %s"
         ## We are about to invalidate the table:
         if not _fast:
             self.invalidate(table)
-        self.execute(sql, (table, where))        
+        self.execute(sql, (table, where))
+        if not _fast:
+            self.commit_invalidations()
 
     def insert(self, table, _fast=False, **fields):
         """ A helper function to make inserting a little more
@@ -804,6 +918,8 @@ class PooledDBO:
         if not _fast:
             self.invalidate(table)
         self.execute(sql, [table,]+args)
+        if not _fast:
+            self.commit_invalidations()
                     
     def mass_insert_start(self, table, _fast=False):
         self.mass_insert_cache = {}
@@ -822,6 +938,7 @@ class PooledDBO:
                 v=db_expand("%b", (v,))
                 k=k[2:]
             elif k.startswith('_'):
+                v=force_string(v)
                 k=k[1:]
             else:
                 v=db_expand("%r", (v,))
@@ -845,31 +962,70 @@ class PooledDBO:
 
         if len(keys)==0: return
         
-        args = []
+        ## The values were already escaped by mass_insert() so we join
+        ## them directly rather than building (and parsing) a huge
+        ## format string:
         values = []
         for i in range(self.mass_insert_row_count):
+            row = []
             for k in keys:
                 try:
-                    args.append(self.mass_insert_cache[k][i])
+                    row.append(self.mass_insert_cache[k][i])
                 except KeyError:
-                    args.append('NULL')
+                    row.append('NULL')
 
-            values.append(",".join(["%s"] * len(keys)))
+            values.append(",".join(row))
 
         sql = "insert ignore into `%s` (%s) values (%s)" % (self.mass_insert_table,
                                                    ','.join(["`%s`" % c for c in keys]),
                                                    "),(".join(values))
+        self.execute(sql)
         if not self.mass_insert_fast:
             self.invalidate(self.mass_insert_table)
-            
-        self.execute(sql,*args)
+            self.commit_invalidations()
 
         ## Ensure the cache is now empty:
         self.mass_insert_start(self.mass_insert_table,
                                _fast=self.mass_insert_fast)
 
+    def load_data(self, table, filename, columns, sets=None, _fast=False):
+        """ Loads the rows in filename into table using LOAD DATA LOCAL
+        INFILE. This is much faster than inserting them.
+
+        The file is in mysql's default format: Fields are seperated by
+        tabs and rows by new lines, values are escaped using
+        load_escape() (None is written as \\N).
+
+        The connection must allow local files (see LoadDataDBO), and
+        the server may still refuse them (if local_infile is disabled
+        there), in which case we raise a DBError.
+
+        @arg columns: The columns in the file. Names starting with @
+        are user variables which can be used by the sets.
+        @arg sets: A list of (column, sql expression) for columns which
+        are calculated from user variables.
+        """
+        sql = "load data local infile %r ignore into table `%s` character set utf8 (%s)"
+        args = [filename, table, ",".join([ c.startswith("@") and c or "`%s`" % c
+                                            for c in columns ])]
+        if sets:
+            sql += " set " + ",".join([ "`%s`=%s" ] * len(sets))
+            for column, expression in sets:
+                args.extend([column, expression])
+
+        self.execute(sql, args)
+        if not _fast:
+            self.invalidate(table)
+            self.commit_invalidations()
+
+    ## Rows returned by cached_execute():
+    cached_rows = None
+
     def autoincrement(self):
         """ Returns the value of the last autoincremented key """
+        if self.insert_id is not None:
+            return self.insert_id
+
         return self.cursor.connection.insert_id()
 
     def next(self):
@@ -885,6 +1041,12 @@ class PooledDBO:
         """ Returns the next cursor row as a dictionary.
 
         It is encouraged to use this function over cursor.fetchone to ensure that if columns get reordered in the future code does not break. The result of this function is a dictionary with keys being the column names and values being the values """
+        if self.cached_rows:
+            try:
+                return self.cached_rows.next()
+            except StopIteration:
+                return None
+
         return self.cursor.fetchone()
     
     def check_index(self, table, key, length=None):
@@ -1007,13 +1169,37 @@ class PooledDBO:
             
             print FlagFramework.get_bt_string(e)
 
+## Tables invalidated by this process whose generations still need to
+## be bumped, keyed by case (see PooledDBO.invalidate):
+PENDING_INVALIDATIONS = {}
+INVALIDATION_LOCK = threading.Lock()
+
+def commit_invalidations(case=None):
+    """ Bumps the generations of all tables invalidated by this
+    process (only those in case if specified).
+    """
+    if case:
+        cases = [ case ]
+    else:
+        cases = PENDING_INVALIDATIONS.keys()
+
+    for case in cases:
+        if PENDING_INVALIDATIONS.get(case):
+            try:
+                DBO(case).commit_invalidations()
+            except DBError, e:
+                pyflaglog.log(pyflaglog.WARNINGS, "Unable to invalidate tables in %s: %s" % (case, e))
+
+atexit.register(commit_invalidations)
+
 class DirectDBO(PooledDBO):
     """ A class which just makes a new connection for each handle """
     dbh = None
+    local_infile = False
     
     def get_dbh(self, case):
         try:
-            self.dbh = mysql_connect(case)
+            self.dbh = mysql_connect(case, self.local_infile)
         except Exception,e:
             ## We just failed to connect - i bet the cached variables
             ## are totally wrong - invalidate the cache:
@@ -1034,6 +1220,15 @@ class DirectDBO(PooledDBO):
         if self.dbh:
             self.dbh.close()
 
+class LoadDataDBO(DirectDBO):
+    """ A handle which may use load_data().
+
+    Its connection is never returned to a pool, so other handles do
+    not get LOAD DATA LOCAL INFILE enabled.
+    """
+    local_infile = True
+    discard = True
+
 config.add_option("DB_CONNECTION_TYPE", default="direct",
                   help="Type of database connections (direct, pooled)")
 
@@ -1042,6 +1237,15 @@ if config.DB_CONNECTION_TYPE == 'pooled':
     print "You have selected pooled"
     DBO = PooledDBO
 
+def create_table_generations(dbh):
+    """ Creates the table which holds the generation of each table
+    (see PooledDBO.invalidate).
+    """
+    dbh.execute("""create table if not exists `table_generations` (
+    `table_name` varchar(250) not null primary key,
+    `generation` int unsigned not null default 0
+    )""")
+
 def escape_column_name(name):
     """ This is a handy utility to properly escape column names taking
     into account possible table names.
@@ -1080,55 +1284,3 @@ def convert_to_unicode(case, table):
             dbh.execute("alter table %s convert to charset 'utf8'", table)
     except:
         pass
-
-if __name__=="__main__":
-    config.set_usage(usage = "PyFlag Database Cache manager."
-                     " (You must run this if you choose periodic caching).")
-
-    config.add_option("period", default=60, type='int',
-                      help = "Number of minutes to wait between cache refreshes")
-
-    config.parse_options()
-
-    while 1:
-        pdbh = DBO()
-        pdbh.execute("select value from meta where property='flag_db'")
-        for row in pdbh:
-            try:
-                case = row['value']
-                dbh = DBO(case)
-                dbh2 = DBO(case)
-                dbh.execute("select * from sql_cache")
-                for row in dbh:
-                    pyflaglog.log(pyflaglog.DEBUG, expand("Refreshing cache for %s %s: %s",
-                                                          (case, row['timestamp'], row['query'])))
-                    dbh2.insert("sql_cache",
-                                query = row['query'],
-                                status = 'progress',
-                                limit = row['limit'],
-                                length = row['length'],
-                                _fast = True)
-                    new_id = dbh2.autoincrement()
-                    dbh2.execute("create table cache_%s %s limit %s,%s", (new_id, row['query'],
-                                 row['limit'], row['length']))
-                    dbh2.execute("update sql_cache set status='cached' where id=%r" , new_id)
-                    dbh2.delete("sql_cache",
-                                where = "id = %s" % row['id'])
-                    dbh2.execute("commit")
-
-                ## Now prune any cache tables
-                dbh.execute("show tables")
-                for row in dbh:
-                    table = row.values()[0]
-                    m=re.match("cache_(\d+)", table)
-                    if m:
-                        dbh2.execute("select * from sql_cache where id=%r", m.group(1))
-                        if not dbh2.fetch():
-                            dbh2.execute("drop table %s" % table)
-                            pyflaglog.log(pyflaglog.DEBUG, "Dropping expired table %s" % table)
-                    
-            except Exception,e:
-                pyflaglog.log(pyflaglog.ERROR, "Error: %s" % e)
-
-        pyflaglog.log(pyflaglog.DEBUG, "Waiting for %s minutes" % config.PERIOD)
-        time.sleep(config.PERIOD * 60)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Random access to deflate compressed streams (gzip, zlib and raw deflate).
+
+Deflate streams can only be decompressed from the start. To seek
+within them without decompressing everything before the read, we
+take checkpoints as we decompress: every DEFLATE_CHECKPOINT_INTERVAL
+bytes of output we remember the compressed and uncompressed offsets,
+and keep a copy of the decompressor (which holds the 32kb window
+needed to continue from there).
+
+Later reads resume decompression from the nearest checkpoint before
+them, so memory use is bounded and the cost of a random read is at
+most decompressing one checkpoint interval.
+
+Checkpoint offsets are kept for each stream in STREAMS. The
+decompressor copies are large, so they are kept in the separate
+WINDOWS store which bounds their total number across all streams. If
+a window is evicted we fall back to an earlier checkpoint, and take
+the checkpoint again when we pass it next.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Store as Store
+import pyflag.pyflaglog as pyflaglog
+import zlib, bisect, sys
+
+config.add_option("DEFLATE_CHECKPOINT_INTERVAL", default=4*1024*1024, type='int',
+                  help="Take a checkpoint every this many bytes when decompressing gzip, deflate and zip streams")
+
+config.add_option("DEFLATE_CHECKPOINTS", default=200, type='int',
+                  help="Maximum number of decompression checkpoints kept in memory (each uses about 40kb)")
+
+## Window bits for the different stream formats:
+RAW = -zlib.MAX_WBITS
+ZLIB = zlib.MAX_WBITS
+GZIP = 16 + zlib.MAX_WBITS
+
+class StreamIndex:
+    """ The checkpoints of a stream """
+    def __init__(self):
+        ## A sorted list of uncompressed offsets, and the compressed
+        ## offset for each:
+        self.offsets = []
+        self.coffsets = {}
+
+        ## The uncompressed size once we know it:
+        self.size = None
+
+    def add(self, uoffset, coffset):
+        bisect.insort(self.offsets, uoffset)
+        self.coffsets[uoffset] = coffset
+
+STREAMS = Store.Store(max_size=1000, age=3600)
+WINDOWS = None
+
+def get_windows():
+    global WINDOWS
+
+    if not WINDOWS:
+        WINDOWS = Store.Store(max_size=config.DEFLATE_CHECKPOINTS, age=3600)
+
+    return WINDOWS
+
+class InflateReader:
+    """ A seekable file like object decompressing a stream read from fd.
+
+    The compressed stream starts at offset within fd and extends for
+    length bytes (or to the end of fd). key identifies the stream for
+    sharing checkpoints between readers (e.g. case:inode). interval
+    defaults to DEFLATE_CHECKPOINT_INTERVAL.
+    """
+    blocksize = 64 * 1024
+
+    def __init__(self, fd, key, wbits=RAW, offset=0, length=None, interval=None):
+        self.fd = fd
+        self.interval = interval or config.DEFLATE_CHECKPOINT_INTERVAL
+        self.key = key
+        self.wbits = wbits
+        self.offset = offset
+        self.length = length
+        self.readptr = 0
+
+        try:
+            self.index = STREAMS.get(key)
+        except KeyError:
+            self.index = StreamIndex()
+            STREAMS.put(self.index, key=key)
+
+        self.restart()
+
+    def restart(self, uoffset=0, coffset=0, d=None):
+        """ Resets the decompressor to the given checkpoint """
+        self.upos = uoffset
+        self.coffset = coffset
+        self.d = d or zlib.decompressobj(self.wbits)
+
+        ## Decompressed data starting at self.upos:
+        self.buffer = ''
+        self.eof = False
+
+    def window_key(self, uoffset):
+        return "%s@%s" % (self.key, uoffset)
+
+    def nearest(self, target, minimum=0):
+        """ Restarts from the latest checkpoint at or before target
+        (and after minimum). Returns True if we found one.
+        """
+        offsets = self.index.offsets
+        i = bisect.bisect_right(offsets, target)
+        windows = get_windows()
+        while i > 0:
+            i -= 1
+            uoffset = offsets[i]
+            if uoffset <= minimum:
+                break
+
+            try:
+                d = windows.get(self.window_key(uoffset))
+            except KeyError:
+                continue
+
+            self.restart(uoffset, self.index.coffsets[uoffset], d.copy())
+            return True
+
+        return False
+
+    def decompress(self, cdata):
+        """ Decompresses as much of cdata as possible """
+        result = []
+        while cdata:
+            result.append(self.d.decompress(cdata))
+            cdata = self.d.unused_data
+
+            ## Another gzip member follows:
+            if cdata and self.wbits == GZIP:
+                self.d = zlib.decompressobj(self.wbits)
+
+            ## Trailing data after the end of the stream:
+            elif cdata:
+                self.eof = True
+                break
+
+        return ''.join(result)
+
+    def decode(self):
+        """ Decompresses the next block into the buffer. Returns False
+        at the end of the stream.
+        """
+        if self.eof:
+            return False
+
+        size = self.blocksize
+        if self.length is not None:
+            size = max(0, min(size, self.length - self.coffset))
+
+        cdata = ''
+        if size:
+            self.fd.seek(self.offset + self.coffset)
+            cdata = self.fd.read(size)
+
+        if not cdata:
+            self.eof = True
+            self.index.size = self.upos + len(self.buffer)
+            return False
+
+        self.coffset += len(cdata)
+        saved = self.d.copy()
+        try:
+            data = self.decompress(cdata)
+        except zlib.error, e:
+            ## Salvage as much as we can of this block before the
+            ## error (e.g. a bad checksum at the end of the stream):
+            pyflaglog.log(pyflaglog.DEBUG, "Error decompressing %s at offset %s: %s" % (self.key, self.coffset, e))
+            self.d = saved
+            result = []
+            for i in range(0, len(cdata), 64):
+                try:
+                    result.append(self.decompress(cdata[i:i+64]))
+                except zlib.error:
+                    break
+
+            data = ''.join(result)
+            self.eof = True
+
+        self.buffer += data
+        end = self.upos + len(self.buffer)
+        if self.eof:
+            self.index.size = end
+        else:
+            self.checkpoint(end)
+
+        return True
+
+    def checkpoint(self, end):
+        """ Takes a checkpoint if we are a whole interval past the last
+        one, or retakes a checkpoint whose window was evicted.
+        """
+        index = self.index
+        windows = get_windows()
+        if index.coffsets.get(end) == self.coffset:
+            key = self.window_key(end)
+            try:
+                windows.get(key)
+            except KeyError:
+                windows.put(self.d.copy(), key=key)
+
+        elif end >= (index.offsets and index.offsets[-1] or 0) + self.interval:
+            index.add(end, self.coffset)
+            windows.put(self.d.copy(), key=self.window_key(end))
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            self.readptr += offset
+        elif whence == 2:
+            self.readptr = self.get_size() + offset
+        else:
+            self.readptr = offset
+
+        if self.readptr < 0:
+            raise IOError("Invalid Arguement")
+
+    def tell(self):
+        return self.readptr
+
+    def position(self, target):
+        """ Positions the decompressor so the buffer starts at target """
+        end = self.upos + len(self.buffer)
+
+        ## Go back to a checkpoint if we need to, or skip ahead to one
+        ## if that is closer:
+        if target < self.upos:
+            if not self.nearest(target):
+                self.restart()
+        elif target > end:
+            self.nearest(target, minimum = end)
+
+        while self.upos + len(self.buffer) < target:
+            self.upos += len(self.buffer)
+            self.buffer = ''
+            if not self.decode():
+                return
+
+        self.buffer = self.buffer[target - self.upos:]
+        self.upos = target
+
+    def read(self, length=None):
+        if length is None:
+            length = sys.maxint
+
+        self.position(self.readptr)
+        while len(self.buffer) < length and self.decode():
+            pass
+
+        data = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        self.upos += len(data)
+        self.readptr += len(data)
+
+        return data
+
+    def get_size(self):
+        """ Returns the uncompressed size (decompressing to the end
+        if we need to)
+        """
+        if self.index.size is None:
+            if self.index.offsets:
+                self.position(self.index.offsets[-1])
+
+            while self.decode():
+                self.upos += len(self.buffer)
+                self.buffer = ''
+
+        return self.index.size
+
+## Unit tests:
+import unittest, random, gzip, StringIO
+
+class InflateReaderTests(unittest.TestCase):
+    """ Random access to compressed streams """
+    def setUp(self):
+        global WINDOWS
+
+        STREAMS.flush()
+        WINDOWS = None
+
+        random.seed(1)
+        words = [ "%x" % random.randint(0, 1 << 20) for i in range(1000) ]
+        self.data = " ".join([ random.choice(words) for i in range(200000) ])
+
+    def check_random_reads(self, reader, data):
+        self.assertEqual(reader.get_size(), len(data))
+        for i in range(200):
+            offset = random.randint(0, len(data) + 10)
+            length = random.randint(0, 50000)
+            reader.seek(offset)
+            self.assertEqual(reader.read(length), data[offset:offset+length])
+            self.assertEqual(reader.tell(), min(len(data), offset + length))
+
+        ## We should have taken checkpoints along the way:
+        self.assert_(len(reader.index.offsets) > 5)
+        reader.seek(-100, 2)
+        self.assertEqual(reader.read(), data[-100:])
+
+    def test01Gzip(self):
+        """ Test random reads in a multi member gzip file """
+        fd = StringIO.StringIO()
+        half = len(self.data) / 2
+        for part in (self.data[:half], self.data[half:]):
+            gz = gzip.GzipFile(fileobj=fd, mode='w')
+            gz.write(part)
+            gz.close()
+
+        reader = InflateReader(fd, "gzip", wbits=GZIP, interval=100000)
+        self.check_random_reads(reader, self.data)
+
+    def test02Deflate(self):
+        """ Test random reads in a raw deflate stream with a prefix """
+        c = zlib.compressobj(9, zlib.DEFLATED, RAW)
+        cdata = c.compress(self.data) + c.flush()
+        fd = StringIO.StringIO("garbage" + cdata + "trailer")
+
+        reader = InflateReader(fd, "deflate", offset = 7, length = len(cdata),
+                               interval = 100000)
+        self.check_random_reads(reader, self.data)
+
+    def test03Truncated(self):
+        """ Test that we read as much as possible of corrupted streams """
+        cdata = zlib.compress(self.data)
+        reader = InflateReader(StringIO.StringIO(cdata[:-1]), "truncated", wbits=ZLIB)
+        self.assertEqual(reader.read(), self.data)
+
+        reader = InflateReader(StringIO.StringIO(cdata[:len(cdata)/2]), "half", wbits=ZLIB)
+        data = reader.read()
+        self.assert_(len(data) > len(self.data) / 4)
+        self.assertEqual(data, self.data[:len(data)])
@@ -151,36 +151,62 @@ add_definition(dict(
     ))
 
 def add_definition(i):
+    global ENGINE
+
     i["CStartRE"]=re.compile(i["StartRE"])
     try:
         i["CEndRE"]=re.compile(i["EndRE"])
     except: pass
 
     definitions.append(i)
+    ENGINE = None
 
 import pyflag.IO as IO
+import pyflag.CarveEngine as CarveEngine
+
+## All the definitions are searched for in a single pass:
+ENGINE = None
+
+def get_engine():
+    global ENGINE
+
+    if not ENGINE:
+        ENGINE = CarveEngine.CarveEngine()
+        for cut in definitions:
+            ENGINE.add(cut['StartRE'], cut, python=True)
+
+    return ENGINE
 
 def process_string(string,extension=None):
     """ This is just like process except it operates on a string """
-    for cut in definitions:
-        offset=0
+    for offset, cut in get_engine().scan_buffer(string):
+        if extension and cut['Extension'] not in extension: continue
+        length=cut['MaxLength']
+        ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
+        if cut.has_key('CEndRE'):
+            end_match=cut['CEndRE'].search(string,offset)
+            if end_match:
+                length=end_match.end()-offset
+
+        yield({'offset':offset,'length':length,'type':cut['Extension']})
+
+def cut_hits(io, hits, extension):
+    for offset, cut in hits:
         if extension and cut['Extension'] not in extension: continue
-        while 1:
-            match=cut['CStartRE'].search(string,offset)
-            if match:
-                offset=match.start()
-                length=cut['MaxLength']
-                ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
-                if cut.has_key('CEndRE'):
-                    end_match=cut['CEndRE'].search(string,offset)
-                    if end_match:
-                        length=end_match.end()-offset
-
-                yield({'offset':offset,'length':length,'type':cut['Extension']})
-                offset+=1
-            else:
-                break
-    
+        length=cut['MaxLength']
+        ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
+        if cut.has_key('CEndRE'):
+            tell=io.tell()
+            io.seek(offset)
+            file_data=io.read(length)
+            io.seek(tell)
+
+            end_match=cut['CEndRE'].search(file_data,0)
+            if end_match:
+                length=end_match.end()
+
+        yield({'offset':offset,'length':length,'type':cut['Extension']})
+
 def process(case,subsys,extension=None):
     """ A generator to produce all the recoverable files within the io object identified by identifier
 
@@ -193,47 +219,23 @@ def process(case,subsys,extension=None):
         io=subsys
         
     blocksize=1024*1024*10
-    windowsize=100
-    count=0
     bytes_read=0
-    window=''
+
+    ## The stream takes care of signatures split across blocks:
+    stream = get_engine().stream()
     while(1):
-        ## This implements a sliding window of window bytes to ensure
-        ## we do not miss a signature that was split across blocksize:
         try:
             data=io.read(blocksize)
             if not len(data): break
         except IOError:
             break
         
-        f=window+data
         bytes_read+=len(data)
         pyflaglog.log(pyflaglog.INFO,"Processed %u Mb" % (bytes_read/1024/1024))
-        for cut in definitions:
-            if extension and cut['Extension'] not in extension: continue
-            pos=0
-            while pos<blocksize:
-                match=cut['CStartRE'].search(f,pos)
-                if match:
-                    offset=match.start()+count-len(window)
-                    length=cut['MaxLength']
-                    ## If there is an end RE, we try to read the entire length in, and then look for the end to we can adjust the length acurately. This is essential for certain file types which do not tolerate garbage at the end of the file, e.g. pdfs.
-                    if cut.has_key('CEndRE'):
-                        tell=io.tell()
-                        io.seek(offset)
-                        file_data=io.read(length)
-                        io.seek(tell)
-
-                        end_match=cut['CEndRE'].search(file_data,0)
-                        if end_match:
-                            length=end_match.end()
-                  
-                    yield({'offset':offset,'length':length,'type':cut['Extension']})
-                    pos=match.start()+1
-                else:
-                    pos=blocksize
-
-        window=f[-windowsize:]
-        count+=blocksize
-        
+        for hit in cut_hits(io, stream.process(data), extension):
+            yield hit
+
+    for hit in cut_hits(io, stream.finish(), extension):
+        yield hit
+
     io.close()
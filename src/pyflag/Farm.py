@@ -107,10 +107,20 @@ requirements in the following ways:
 
 == Database model ==
   
-Threads periodically poll the `jobs` table in FLAGDB to see if new
-jobs are available. When jobs are scheduled, they are inserted into
-that table by the scheduling thread. All other threads will pick up
-jobs from that table, deleting them as they are completed.
+When jobs are scheduled, they are inserted into the `jobs` table in
+FLAGDB by the scheduling thread, which then wakes the workers through
+their wakeup sockets (see wake_workers). Workers also poll the table
+every JOB_QUEUE_POLL seconds in case they missed a wakeup.
+
+A worker claims a batch of jobs by leasing them with a single update
+statement which tags the rows with a unique lease id and an expiry
+time - so no table locks are needed. A heartbeat thread renews the
+lease while the jobs run, so long jobs are not taken over by other
+workers. Completed jobs are deleted as they finish (short jobs are
+grouped for up to JOB_ACK_INTERVAL seconds, see worker_run). If a
+worker dies while holding a lease, the lease expires after
+JOB_LEASE_TIME seconds and the jobs are returned to the pending
+state for other workers to pick up.
 
 == Scanners ==
 
@@ -177,7 +187,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__),".."))
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.pyflaglog as pyflaglog
-import atexit,os,signal,time
+import atexit,os,signal,time,threading
+import socket,glob,errno
 import pyflag.DB as DB
 import pyflag.Registry as Registry
 import pyflag.Store as Store
@@ -317,6 +328,168 @@ def nanny(cb, keepalive=None, *args, **kwargs):
             cb(keepalive=w, *args, **kwargs)
             os._exit(0)
 
+config.add_option("JOB_LEASE_TIME", default=600, type='int',
+                  help='Number of seconds a worker may hold a batch of jobs '
+                  'before they are handed to another worker')
+
+config.add_option("JOB_ACK_INTERVAL", default=5, type='int',
+                  help='Number of seconds completed jobs may wait before '
+                  'their results are flushed and they are removed from the queue')
+
+## The tables workers take jobs from in order of priority:
+JOB_TABLES = ('high_priority_jobs', 'jobs')
+
+LEASE_COUNT = 0
+
+def new_lease_id():
+    """ Returns an identifier unique to this lease across all
+    workers on all machines.
+    """
+    global LEASE_COUNT
+    LEASE_COUNT += 1
+    return "%s:%s:%s:%s" % (socket.gethostname(), os.getpid(),
+                            int(time.time()), LEASE_COUNT)
+
+def reclaim_expired_leases(dbh, table):
+    """ Return jobs whose lease expired to the pending state.
+
+    This happens when a worker crashed (or was killed by its nanny)
+    before acknowledging the jobs it claimed.
+    """
+    dbh.execute("update %s set state='pending', lease_id=NULL, lease_expiry=0 "
+                "where state='processing' and lease_expiry > 0 and "
+                "lease_expiry < unix_timestamp()", table)
+
+def claim_jobs(dbh, table, limit, broadcast_id=None):
+    """ Leases a batch of up to limit pending jobs from table.
+
+    The jobs are claimed with a single update statement so we do not
+    need to lock the table - the database guarantees that each job is
+    only leased to one worker. If broadcast_id is given, broadcasts
+    newer than it are also returned.
+
+    Returns the lease id and a list of rows.
+    """
+    lease_id = new_lease_id()
+    dbh.execute("update %s set state='processing', pid=%r, lease_id=%r, "
+                "lease_expiry=unix_timestamp() + %r "
+                "where state='pending' and when_valid <= now() "
+                "order by id limit %r",
+                (table, os.getpid(), lease_id, config.JOB_LEASE_TIME, limit))
+
+    dbh.execute("select * from %s where lease_id=%r", (table, lease_id))
+    jobs = [ row for row in dbh ]
+
+    if broadcast_id is not None:
+        dbh.execute("select * from %s where state='broadcast' and id>%r order by id",
+                    (table, broadcast_id))
+        jobs.extend([ row for row in dbh ])
+
+    return lease_id, jobs
+
+def renew_lease(dbh, table, lease_id):
+    """ Extends the lease on jobs we are still working on """
+    dbh.execute("update %s set lease_expiry=unix_timestamp() + %r where lease_id=%r",
+                (table, config.JOB_LEASE_TIME, lease_id))
+
+class LeaseHeartbeat:
+    """ Renews a lease from a thread for as long as the jobs it covers
+    are running.
+    """
+    def __init__(self, table, lease_id):
+        self.table = table
+        self.lease_id = lease_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="LeaseHeartbeat")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        ## Renew well before the lease expires:
+        interval = max(1, config.JOB_LEASE_TIME / 3)
+        while 1:
+            self.stopped.wait(interval)
+            if self.stopped.isSet(): break
+
+            try:
+                renew_lease(DB.DBO(), self.table, self.lease_id)
+            except Exception,e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to renew lease %s: %s" % (self.lease_id, e))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def acknowledge_jobs(dbh, table, ids):
+    """ Removes the completed jobs in a single statement """
+    if not ids: return
+    
+    dbh.execute("delete from %s where id in (%s)",
+                (table, ",".join([ str(int(x)) for x in ids ])))
+
+## Workers wait for new jobs on a unix domain socket in the
+## RESULTDIR. Anyone scheduling jobs on this machine may wake them by
+## sending a datagram to the socket.
+WAKEUP_SOCKET_PREFIX = "pyflag_worker_"
+
+def wakeup_socket_path(pid):
+    return os.path.join(config.RESULTDIR, "%s%s.sock" % (WAKEUP_SOCKET_PREFIX, pid))
+
+def make_wakeup_socket():
+    """ Creates the socket we get woken up on. Returns None if unix
+    domain sockets are not supported.
+    """
+    try:
+        path = wakeup_socket_path(os.getpid())
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        atexit.register(remove_wakeup_socket, path)
+        return sock
+    except (AttributeError, socket.error), e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to create wakeup socket: %s" % e)
+        return None
+
+def remove_wakeup_socket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def wait_for_jobs(sock):
+    """ Wait until we are woken up or until JOB_QUEUE_POLL seconds
+    pass (some jobs only become valid in the future, and leases expire
+    without anyone telling us).
+    """
+    try:
+        r = win32event.WaitForMultipleObjects([SyncEvent, TerminateEvent], False,
+                                              config.JOB_QUEUE_POLL * 1000)
+        if r==1:
+            ## TerminateEvent signaled
+            sys.exit(0)
+
+        return
+    except (NameError,AttributeError),e:
+        pass
+
+    if not sock:
+        time.sleep(config.JOB_QUEUE_POLL)
+        return
+
+    try:
+        fds = select.select([sock], [], [], config.JOB_QUEUE_POLL)
+    except select.error:
+        return
+
+    ## Drain all pending wakeups - one is enough:
+    while fds[0]:
+        sock.recv(1024)
+        fds = select.select([sock], [], [], 0)
+
 def worker_run(keepalive=None):
      """ The main loop of the worker """
      ## It is an error to fork with db connections
@@ -333,7 +506,7 @@ def worker_run(keepalive=None):
      ## These are all the methods we support
      jobs = []
 
-     my_pid = os.getpid()
+     wakeup = make_wakeup_socket()
 
      ## This is the last broadcast message we handled. We will
      ## only handle broadcasts newer than this.
@@ -359,88 +532,85 @@ def worker_run(keepalive=None):
          check_mem(os._exit,0)
          ## Check for new tasks:
          if not jobs:
-             try:
-                 r = win32event.WaitForMultipleObjects([SyncEvent, TerminateEvent], False, 10000)
-                 if r==1:
-                     ## TerminateEvent signaled
-                     sys.exit(0)
-                 
-             except (NameError,AttributeError),e:
-                 time.sleep(config.JOB_QUEUE_POLL)
+             wait_for_jobs(wakeup)
 
          dbh = None
+         jobs = []
          try:
              dbh = DB.DBO()
-             try:
-                 ## See if there are any high priority jobs to do:
-                 dbh.execute("lock tables high_priority_jobs write")
-                 dbh.execute("select * from high_priority_jobs where "
-                             "when_valid <= now() and state='pending' limit %s", config.JOB_QUEUE)
-                 jobs = [ row for row in dbh ]                 
-                 
-                 ## Ensure the jobs are marked as processing so other jobs dont touch them:
-                 if jobs:
-                     for row in jobs:
-                         if row['state'] == 'pending':
-                             dbh.execute("update high_priority_jobs set state='processing', pid=%r where id=%r",
-                                         my_pid,
-                                         row['id'])                             
+             ## Higher priority jobs take precendence over lower
+             ## priority jobs. We only want jobs which are valid now
+             ## (jobs can be set in the future). We assume that we
+             ## actually can process all jobs (all workers must have
+             ## all the same plugins).
+             for table in JOB_TABLES:
+                 reclaim_expired_leases(dbh, table)
+                 if table == 'jobs':
+                     lease_id, jobs = claim_jobs(dbh, table, config.JOB_QUEUE,
+                                                 broadcast_id)
                  else:
-                     dbh.execute("unlock tables")
-                     dbh.execute("lock tables jobs write")
-                     ## Higher priority jobs take precendence over lower
-                     ## priority jobs. We only want jobs which are valid
-                     ## now (jobs can be set in the future). We assume
-                     ## that we actually can process all jobs (all workers
-                     ## must have all the same plugins).
-                     dbh.execute("select * from jobs where ((state='pending') "
-                                 "or (state='broadcast' and id>%r)) limit %s",
-                                 (broadcast_id, config.JOB_QUEUE))
-                     jobs = [ row for row in dbh ]
-
-                     if not jobs:
-                         continue
+                     lease_id, jobs = claim_jobs(dbh, table, config.JOB_QUEUE)
 
-                     ## Ensure the jobs are marked as processing so other jobs dont touch them:
-                     for row in jobs:
-                         if row['state'] == 'pending':
-                             dbh.execute("update jobs set state='processing', pid=%r where id=%r",
-                                         my_pid,
-                                         row['id'])
-                         elif row['state'] == 'broadcast':
-                             broadcast_id = row['id']
-             finally:
-                 if dbh:
-                     dbh.execute("unlock tables")
+                 if jobs: break
          except Exception,e:
              print e
              continue
 
-         ## Now do the jobs
-         for row in jobs:
-             try:
-                 try:
-                     task = Registry.TASKS.dispatch(row['command'])
-                 except:
-                     pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % row['command'])
-                     continue
+         if not jobs: continue
 
+         ## Now do the jobs
+         heartbeat = LeaseHeartbeat(table, lease_id)
+         completed = []
+         last_ack = time.time()
+         try:
+             for row in jobs:
                  try:
-                     task = task()
-                     task.run(row['arg1'], row['arg2'], row['arg3'])
-                 except Exception,e:
-                     pyflaglog.log(pyflaglog.ERRORS, "Error %s(%s,%s,%s) %s" % (task.__class__.__name__,row['arg1'], row['arg2'],row['arg3'],e))
+                     try:
+                         task = Registry.TASKS.dispatch(row['command'])
+                     except:
+                         pyflaglog.log(pyflaglog.DEBUG, "Dont know how to process job %s" % row['command'])
+                         continue
 
-             finally:
-                 try:
-                     if keepalive:
-                         os.write(keepalive, " ".join(row))
-                 except:
-                     pyflaglog.log(pyflaglog.WARNING,"Our nanny died - quitting")
-                     os._exit(1)
-                 if row['state'] != 'broadcast':
-                     dbh.execute("delete from jobs where id=%r", row['id'])
+                     try:
+                         task = task()
+                         task.run(row['arg1'], row['arg2'], row['arg3'])
+                     except Exception,e:
+                         pyflaglog.log(pyflaglog.ERRORS, "Error %s(%s,%s,%s) %s" % (task.__class__.__name__,row['arg1'], row['arg2'],row['arg3'],e))
+
+                 finally:
+                     try:
+                         if keepalive:
+                             os.write(keepalive, " ".join(row))
+                     except:
+                         pyflaglog.log(pyflaglog.WARNING,"Our nanny died - quitting")
+                         os._exit(1)
+                     if row['state'] == 'broadcast':
+                         broadcast_id = max(broadcast_id, row['id'])
+                     else:
+                         completed.append(row['id'])
+
+                 ## Remove completed jobs from the queue, so they are not
+                 ## run again if we die. Scanners batch their
+                 ## scanner_cache updates so these must be committed
+                 ## first. Short jobs are acknowledged together so we do
+                 ## not lose the batching:
+                 if completed and time.time() - last_ack >= config.JOB_ACK_INTERVAL:
+                     acknowledge_batch(dbh, table, completed)
+                     completed = []
+                     last_ack = time.time()
+         finally:
+             heartbeat.stop()
+
+         acknowledge_batch(dbh, table, completed)
+
+def acknowledge_batch(dbh, table, ids):
+    """ Commits the results of the completed jobs and removes them
+    from the queue.
+    """
+    import pyflag.Scanner as Scanner
+    Scanner.flush_scanner_cache()
 
+    acknowledge_jobs(dbh, table, ids)
 
 def start_workers():
     if config.FLUSH:
@@ -529,7 +699,6 @@ def wake_workers():
     """ Try to wake workers if possible. If we fail we must wait until
     the worker polls next, so its not a big deal.
     """
-    print "Waking workers %s" % (children,)
     try:
         for i in range(config.WORKERS):
             win32event.PulseEvent(SyncEvent)
@@ -538,11 +707,21 @@ def wake_workers():
     except AttributeError,e:
         pass
 
-    ## A Signal should interrupt the children's sleep
-    for pid in children:
+    ## Send a datagram to every worker on this machine:
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    except (AttributeError, socket.error):
+        return
+
+    for path in glob.glob(wakeup_socket_path("*")):
         try:
-            os.kill(pid, signal.SIGUSR1)
-        except AttributeError: pass
+            sock.sendto("wake", path)
+        except socket.error, e:
+            if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                ## The worker is gone - remove its socket:
+                remove_wakeup_socket(path)
+
+    sock.close()
 
 config.add_option("FLUSH", default=False, action='store_true',
                   help='There are no workers currently processing, flush job queue.')
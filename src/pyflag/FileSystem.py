@@ -131,6 +131,9 @@ class FileSystem:
 
         This object can then be used to read data from the specified file.
         @note: Only files may be opened, not directories."""
+        ## Make sure buffered nodes are in the database:
+        self.flush_bulk()
+        
         if path:
             path, inode, inode_id = self.lookup(path=path)
         elif inode_id:
@@ -169,6 +172,9 @@ class FileSystem:
         """ return a dict with information (istat) for the given inode or path. """
         pass
 
+    def flush_bulk(self):
+        """ Flushes any VFS nodes buffered by a bulk load """
+
     def isdir(self,directory):
         """ Returns 1 if directory is a directory, 0 otherwise """
         pass
@@ -202,7 +208,7 @@ class FileSystem:
             data = fd.read(10240)
             if data:
                 import pyflag.Magic as Magic
-                magic = Magic.MagicResolver()
+                magic = Magic.get_resolver()
                 result.ruler()
                 sig, ct = magic.get_type(data)
                 result.row("Magic identifies this file as: %s" % sig,**{'colspan':50,'class':'hilight'})
@@ -278,6 +284,12 @@ class DBFS(FileSystem):
     def VFSCreate(self,root_inode,inode,new_filename,directory=False ,gid=0, uid=0, mode=100777,
                   _fast=False, inode_id=None, update_only=False,
                   **properties):
+        ## When a bulk load is in progress the writer does the work:
+        if self.bulk_writer and not update_only:
+            return self.bulk_writer.VFSCreate(root_inode, inode, new_filename,
+                                              directory=directory, _fast=_fast,
+                                              inode_id=inode_id, **properties)
+        
         ## Basically this is how this function works - if root_inode
         ## is provided we make the new inode inherit the root inodes
         ## path and inode string.
@@ -317,6 +329,28 @@ class DBFS(FileSystem):
         ## not be specifically inserted.
         #if directory: return
 
+        inode_properties = self._inode_properties(inode, inode_id, _fast, properties)
+
+        if inode_id and update_only:
+            dbh.update('inode', where="inode_id=%s" % inode_id,
+                       **inode_properties)
+        else:
+            dbh.insert('inode', **inode_properties)
+            inode_id = dbh.autoincrement()
+
+        if not new_filename:
+            return inode_id
+
+        ## Now add to the file and inode tables:
+        file_props = self._file_properties(inode, inode_id, new_filename,
+                                           directory_string, _fast, properties)
+
+        dbh.insert('file',**file_props)
+
+        return inode_id
+
+    def _inode_properties(self, inode, inode_id, _fast, properties):
+        """ Returns the columns of the inode table row for VFSCreate """
         inode_properties = dict(status="alloc", mode=40755, links=4, _fast=_fast,
                                 size=0)
         try:
@@ -343,17 +377,11 @@ class DBFS(FileSystem):
             elif properties.get(t):
                     inode_properties[t] = properties[t]
 
-        if inode_id and update_only:
-            dbh.update('inode', where="inode_id=%s" % inode_id,
-                       **inode_properties)
-        else:
-            dbh.insert('inode', **inode_properties)
-            inode_id = dbh.autoincrement()
+        return inode_properties
 
-        if not new_filename:
-            return inode_id
-
-        ## Now add to the file and inode tables:
+    def _file_properties(self, inode, inode_id, new_filename, directory_string,
+                         _fast, properties):
+        """ Returns the columns of the file table row for VFSCreate """
         file_props = dict(path = FlagFramework.normpath(posixpath.dirname(new_filename)+"/"),
                           name = posixpath.basename(new_filename),
                           status = 'alloc',
@@ -368,9 +396,38 @@ class DBFS(FileSystem):
         except KeyError:
             pass
 
-        dbh.insert('file',**file_props)
+        return file_props
 
-        return inode_id
+    ## The VFSWriter used while a bulk load is in progress:
+    bulk_writer = None
+    bulk_depth = 0
+
+    def start_bulk(self):
+        """ Starts buffering VFSCreate calls on this filesystem object.
+
+        New inodes are not visible in the database until end_bulk() (or
+        a lookup through this object) flushes them. Calls may be
+        nested, the buffer is only flushed by the outermost end_bulk().
+        """
+        if not self.bulk_writer:
+            self.bulk_writer = VFSWriter(self)
+
+        self.bulk_depth += 1
+        return self.bulk_writer
+
+    def end_bulk(self):
+        """ Flushes all buffered VFS nodes to the database """
+        self.bulk_depth -= 1
+        if self.bulk_depth <= 0 and self.bulk_writer:
+            writer = self.bulk_writer
+            self.bulk_writer = None
+            self.bulk_depth = 0
+            writer.flush()
+
+    def flush_bulk(self):
+        """ Makes buffered VFS nodes visible without ending the bulk load """
+        if self.bulk_writer:
+            self.bulk_writer.flush()
 
     def longls(self,path='/', dirs = None):
         dbh=DB.DBO(self.case)
@@ -419,6 +476,9 @@ class DBFS(FileSystem):
         #    yield(i)
 
     def lookup(self, path=None,inode=None, inode_id=None):
+        ## Make sure buffered nodes can be found:
+        self.flush_bulk()
+        
         dbh=DB.DBO(self.case)
         if path:
             dir,name = posixpath.split(path)
@@ -528,6 +588,8 @@ class DBFS(FileSystem):
             except Exception,e:
                 pyflaglog.log(pyflaglog.ERRORS,"%r: %s" % (e,e))
                 continue
+
+        Scanner.flush_scanner_cache(self.case)
         
         for c in scanners:
             c.destroy()
@@ -575,6 +637,248 @@ class DBFS(FileSystem):
         return self.ls(path)
  
 ## These are some of the default views that will be seen in View File
+config.add_option("VFS_INODE_BLOCK", default=1000, type='int',
+                  help="Number of inode_ids the bulk VFS writer reserves at once")
+
+config.add_option("VFS_BULK_ROWS", default=1000, type='int',
+                  help="Number of rows the bulk VFS writer buffers before flushing")
+
+def reserve_inode_ids(dbh, count):
+    """ Reserves a block of count consecutive inode_ids.
+
+    We insert placeholder rows at both ends of the block and delete
+    them again, which moves the auto_increment counter past the
+    block. The table lock ensures no other loader allocates an id in
+    between. Returns the first id of the block.
+    """
+    dbh.execute("lock tables inode write")
+    try:
+        dbh.insert('inode', _inode_id='NULL', _fast=True)
+        first = dbh.autoincrement()
+        if count > 1:
+            dbh.insert('inode', inode_id = first + count - 1, _fast=True)
+
+        dbh.delete('inode', where='inode_id >= %s and inode_id < %s' % (first, first + count),
+                   _fast=True)
+    finally:
+        dbh.execute("unlock tables")
+
+    return first
+
+class InodeIDAllocator:
+    """ Hands out inode_ids from blocks reserved with reserve_inode_ids """
+    def __init__(self, dbh, block_size=None):
+        self.dbh = dbh
+        self.block_size = block_size or config.VFS_INODE_BLOCK
+        self.next_id = self.last_id = 0
+
+    def allocate(self):
+        if self.next_id >= self.last_id:
+            self.next_id = reserve_inode_ids(self.dbh, self.block_size)
+            self.last_id = self.next_id + self.block_size
+
+        result = self.next_id
+        self.next_id += 1
+        return result
+
+class BatchWriter:
+    """ Buffers rows for a number of tables and writes them with multi
+    row inserts.
+
+    Rows are given in the same way as DBO.insert() (i.e. columns
+    starting with _ are not escaped). Rows with different columns are
+    buffered seperately so we never insert NULL into columns the
+    caller did not set. The buffer is flushed when it holds more than
+    max_rows rows or max_bytes bytes.
+
+    before_flush is a list of callables which are called before we
+    write our rows. This is used when our rows refer to rows buffered
+    elsewhere (e.g. jobs which refer to VFS inodes).
+    """
+    def __init__(self, dbh, max_rows=None, max_bytes=512*1024, order=(),
+                 before_flush=()):
+        self.dbh = dbh
+        self.max_rows = max_rows or config.VFS_BULK_ROWS
+        self.max_bytes = max_bytes
+        self.before_flush = before_flush
+        ## Tables are flushed in this order (others follow):
+        self.order = list(order)
+        self.rows = {}
+        self.invalidate = set()
+        self.row_count = 0
+        self.size = 0
+
+    def insert(self, table, _fast=False, **fields):
+        columns = []
+        values = []
+        for k in sorted(fields.keys()):
+            v = fields[k]
+            if k.startswith("__"):
+                v = DB.db_expand("%b", (v,))
+                k = k[2:]
+            elif k.startswith("_"):
+                k = k[1:]
+                v = "%s" % v
+            else:
+                v = DB.db_expand("%r", (v,))
+
+            columns.append(k)
+            values.append(v)
+            self.size += len(v)
+
+        if table not in self.order:
+            self.order.append(table)
+
+        self.rows.setdefault(table, {}).setdefault(tuple(columns), []).append(
+            "(%s)" % ",".join(values))
+
+        if not _fast:
+            self.invalidate.add(table)
+
+        self.row_count += 1
+        if self.row_count >= self.max_rows or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        ## Rows buffered elsewhere are flushed even if we have none,
+        ## since callers rely on flush() to make them visible:
+        for cb in self.before_flush:
+            cb()
+
+        if not self.row_count: return
+
+        for table in self.order:
+            for columns, values in self.rows.get(table, {}).items():
+                self.dbh.execute("insert into `%s` (%s) values %s",
+                                 (table, ",".join([ "`%s`" % c for c in columns ]),
+                                  ",".join(values)))
+
+            if table in self.invalidate:
+                self.dbh.invalidate(table)
+
+        self.dbh.commit_invalidations()
+        self.rows = {}
+        self.invalidate = set()
+        self.row_count = 0
+        self.size = 0
+
+class VFSWriter:
+    """ Buffers VFS nodes created during a bulk load.
+
+    This is used by DBFS.VFSCreate between start_bulk() and
+    end_bulk(). We keep a cache of the directories known to exist,
+    allocate inode_ids from reserved blocks and write the inode and
+    file rows with multi row inserts. Indexes are only checked once
+    when the writer is created.
+
+    If shared is set, other processes are creating nodes in the same
+    directories at the same time (e.g. the PCAP loaders). They can not
+    see the directories we buffer, so directories are created straight
+    away while holding a lock.
+    """
+    shared = False
+
+    def __init__(self, fsfd):
+        self.fsfd = fsfd
+        self.case = fsfd.case
+        self.dbh = DB.DBO(self.case)
+        self.dbh.check_index('file','path', 200)
+        self.dbh.check_index('file','name', 200)
+        self.ids = InodeIDAllocator(self.dbh)
+        self.writer = BatchWriter(self.dbh, order=('inode', 'file'))
+
+        ## Directories (path, name) we know to exist:
+        self.directories = set()
+        
+        ## Inode strings created by us which may not be flushed yet -
+        ## values are the path:
+        self.pending = {}
+
+    def make_directories(self, new_filename):
+        """ Makes sure that all intermediate dirs exist """
+        dirs = posixpath.dirname(new_filename).split("/")
+        for d in range(len(dirs)-1,0,-1):
+            path = "/".join(dirs[:d])+"/"
+            path = FlagFramework.normpath(path)
+            key = (path, dirs[d])
+            if key in self.directories: break
+
+            self.directories.add(key)
+            if self.shared:
+                if not self.make_shared_directory(path, dirs[d]): break
+                continue
+
+            self.dbh.execute("select * from file where path=%r and name=%r and mode='d/d' limit 1", key)
+            if self.dbh.fetch(): break
+            
+            self.writer.insert('file', inode='', path=path, name=dirs[d],
+                               status='alloc', mode='d/d', _fast=True)
+
+    def make_shared_directory(self, path, name):
+        """ Creates the directory unless another process already has.
+
+        Returns True if we created it.
+        """
+        lock = "pyflag_vfs_%s" % self.case
+        self.dbh.execute("select get_lock(%r, 60)", lock)
+        try:
+            self.dbh.execute("select * from file where path=%r and name=%r and mode='d/d' limit 1",
+                             (path, name))
+            if self.dbh.fetch(): return False
+
+            self.dbh.insert('file', inode='', path=path, name=name,
+                            status='alloc', mode='d/d', _fast=True)
+            return True
+        finally:
+            self.dbh.execute("select release_lock(%r)", lock)
+
+    def VFSCreate(self, root_inode, inode, new_filename, directory=False,
+                  _fast=False, inode_id=None, **properties):
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, DB.expand("Creating new VFS node %s at %s", (inode, new_filename)))
+        if root_inode:
+            try:
+                path = self.pending[root_inode]
+            except KeyError:
+                try:
+                    path, root_inode, tmp_inode_id = self.fsfd.lookup(inode = root_inode)
+                    path = path + "/" + new_filename
+                except:
+                    path = "/" + new_filename
+            else:
+                path = path + "/" + new_filename
+
+            new_filename = path
+            inode = "%s|%s" % (root_inode,inode)
+
+        if directory:
+            directory_string = "d/d"
+        else:
+            directory_string = "r/r"
+
+        if new_filename:
+            new_filename = posixpath.normpath(new_filename)
+            self.make_directories(new_filename)
+
+        if not inode_id:
+            inode_id = self.ids.allocate()
+
+        self.writer.insert('inode', **self.fsfd._inode_properties(inode, inode_id,
+                                                                  _fast, properties))
+        if not new_filename:
+            return inode_id
+
+        self.writer.insert('file', **self.fsfd._file_properties(
+            inode, inode_id, new_filename, directory_string, _fast, properties))
+
+        if inode:
+            self.pending[inode] = new_filename
+
+        return inode_id
+
+    def flush(self):
+        self.writer.flush()
+        self.pending = {}
+
 def goto_page_cb(query,result,variable):
     try:
         limit = query[variable]
@@ -1182,3 +1486,36 @@ class VFSTests(unittest.TestCase):
         #dbh.execute("select count(*) from file where path='/toplevel/somedir/somefile/' and name='foobar' and inode='TestInode1|TestInode2'")
         #self.assert_(dbh.fetch())
         
+
+    def test02BulkVFSCreate(self):
+        """ Test VFSCreate in bulk mode """
+        vfs = DBFS(self.test_case)
+        dbh = DB.DBO(self.test_case)
+
+        vfs.start_bulk()
+        ids = []
+        for i in range(0,10):
+            ids.append(vfs.VFSCreate(None, "TestBulk%s" % i,
+                                     "/bulk/somedir/file%s" % i, size=i))
+
+        ## Nodes based on nodes which are not flushed yet:
+        vfs.VFSCreate("TestBulk0", "TestBulkChild", "child")
+
+        ## Nothing is written until the bulk load ends:
+        dbh.execute("select * from file where path='/bulk/somedir/'")
+        self.assertEqual(dbh.fetch(), None)
+        vfs.end_bulk()
+
+        ## The inode_ids were allocated from a reserved block:
+        for i in range(0,10):
+            dbh.execute("select * from inode where inode_id=%r", ids[i])
+            row = dbh.fetch()
+            self.assertEqual(row['inode'], "TestBulk%s" % i)
+            self.assertEqual(row['size'], i)
+
+        ## Directories are created only once:
+        dbh.execute("select count(*) as c from file where path='/bulk/' and name='somedir'")
+        self.assertEqual(dbh.fetch()['c'], 1)
+
+        dbh.execute("select * from file where path='/bulk/somedir/file0/' and name='child' and inode='TestBulk0|TestBulkChild'")
+        self.assert_(dbh.fetch())
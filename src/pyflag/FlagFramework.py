@@ -325,6 +325,9 @@ class query_type:
 
 import pyflag.DB as DB
 import threading
+
+## Held while deciding whether to start a report's analysis:
+ANALYSIS_LOCK = threading.Lock()
 import re,cgi
 import conf
 
@@ -480,18 +483,33 @@ class Flag:
                     result.refresh(1,query)
                     return 
 
-                #Check to see if the report is cached in the database
-                if self.is_cached(query):
+                ## Concurrent requests for the same report must not
+                ## start the analysis twice:
+                ANALYSIS_LOCK.acquire()
+                try:
+                    #Check to see if the report is cached in the database
+                    if self.is_cached(query):
+                        cached = True
+                    else:
+                        cached = False
+
+                        #Are we currently executing the report?
+                        progress_result = self.check_progress(report,query, result)
+
+                        #OK - we run the analysis method in a seperate thread
+                        if not progress_result:
+                            t = threading.Thread(target=self.run_analysis,args=(report,query, result))
+                            ## Note that we are executing before we let go of the lock:
+                            report.executing[t.getName()]={'query': canonical_query, 'error': None}
+                finally:
+                    ANALYSIS_LOCK.release()
+
+                if cached:
                     report.display(query,result)
                     return 
                 
-                #Are we currently executing the report?
-                progress_result = self.check_progress(report,query, result)
-                
-                #OK - we run the analysis method in a seperate thread
                 if not progress_result:
                    #Start a new thread and run the analysis in it.
-                   t = threading.Thread(target=self.run_analysis,args=(report,query, result))
                    t.start()
                    import time
 
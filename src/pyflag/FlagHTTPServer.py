@@ -42,6 +42,23 @@ import re,time,sys,socket
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 import pyflag.Theme
+import pyflag.Store as Store
+import threading, Queue, calendar
+from hashlib import md5
+
+config.add_option("HTTPSERVER_THREADS", default=10, type='int',
+                  help="Number of threads serving http requests (0 serves one request at the time)")
+
+config.add_option("HTTPSERVER_QUEUE", default=50, type='int',
+                  help="Number of http connections which may wait for a free thread")
+
+config.add_option("HTTPSERVER_KEEPALIVE", default=15, type='int',
+                  help="Number of seconds idle keep-alive connections are kept open")
+
+config.add_option("HTTPSERVER_GZIP_TYPES",
+                  default="text/html,text/css,text/javascript,text/plain,text/xml,"
+                  "application/xml,application/x-javascript",
+                  help="Comma seperated list of content types we gzip for browsers which accept it")
 
 def compressBuf(buf):
     zbuf = cStringIO.StringIO()
@@ -50,6 +67,13 @@ def compressBuf(buf):
     zfile.close()
     return zbuf.getvalue()
 
+## Static files (compressed if required) keyed by path, modification
+## time and encoding:
+STATIC_CACHE = Store.Store(max_size=200)
+
+## Static files larger than this are not cached:
+MAX_CACHED_STATIC = 1024 * 1024
+
 class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework.Flag):
     """ Main flag webserver handler.
 
@@ -162,19 +186,133 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
         return s
 
     def parse_date_time_string(self, s):
-        return time.mktime(time.strptime(s, "%a, %d %b %Y %H:%M:%S %Z"))
+        """ Returns the time since the epoch of a http date """
+        return calendar.timegm(time.strptime(s, "%a, %d %b %Y %H:%M:%S GMT"))
+
+    def accepts_gzip(self):
+        return "gzip" in self.headers.get("Accept-Encoding","")
+
+    def accepts_chunked(self):
+        return self.request_version == 'HTTP/1.1' and \
+               self.protocol_version == 'HTTP/1.1'
+
+    def compressible(self, content_type):
+        """ Should we gzip content of this type? """
+        content_type = content_type.split(";")[0].strip()
+        return content_type in config.HTTPSERVER_GZIP_TYPES.split(",")
+
+    def not_modified(self, etag, mtime=None):
+        """ Checks the conditional request headers to see if the
+        browser already has the current version.
+        """
+        etags = self.headers.get("If-None-Match")
+        if etags:
+            etags = [ x.strip() for x in etags.split(",") ]
+            return etag in etags or "*" in etags
+
+        if mtime is not None:
+            try:
+                return int(mtime) <= self.parse_date_time_string(
+                    self.headers.get('If-Modified-Since',''))
+            except ValueError:
+                pass
+
+        return False
+
+    def send_not_modified(self, etag, headers = {}):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        for k,v in headers.items():
+            self.send_header(k,v)
+
+        self.send_header("Content-Length", 0)
+        self.end_headers()
+
+    def send_body(self, data, content_type, headers = {}, etag = None):
+        """ Sends a complete response, compressing it if we can and
+        honouring conditional requests.
+
+        If etag is None we make a weak one from the data.
+        """
+        if isinstance(data, unicode):
+            data = data.encode("utf8")
+
+        if etag is None:
+            etag = 'W/"%s"' % md5(data).hexdigest()
+
+        if self.not_modified(etag):
+            self.send_not_modified(etag, headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("ETag", etag)
+        for k,v in headers.items():
+            self.send_header(k,v)
+
+        if len(data) > 1024 and self.accepts_gzip() and self.compressible(content_type):
+            data = compressBuf(data)
+            self.send_header("Content-Encoding", "gzip")
+
+        self.send_header("Content-Length", len(data))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_static(self, path, ct):
+        """ Sends the static file at path """
+        ## Check if there is a compressed version of this file:
+        content_encoding = None
+        if self.accepts_gzip():
+            if os.access(path + ".gz", os.F_OK):
+                path = path+".gz"
+                content_encoding = "gzip"
+            elif self.compressible(ct):
+                content_encoding = "gzip"
+
+        s = os.stat(path)
+        etag = '"%x-%x-%x%s"' % (s.st_ino, s.st_size, int(s.st_mtime),
+                                 content_encoding and "-gz" or "")
+        headers = {"Expires": "Sun, 17 Jan 2038 19:14:07 GMT",
+                   "Last-Modified": self.format_date_time_string(s.st_mtime)}
+
+        if self.not_modified(etag, s.st_mtime):
+            self.send_not_modified(etag, headers)
+            return
+
+        key = "%s:%s:%s" % (path, s.st_mtime, content_encoding)
+        try:
+            f = STATIC_CACHE.get(key)
+        except KeyError:
+            fd = open(path, "rb")
+            f = fd.read()
+            fd.close()
+
+            if content_encoding and not path.endswith(".gz"):
+                f = compressBuf(f)
+
+            if len(f) < MAX_CACHED_STATIC:
+                STATIC_CACHE.put(f, key=key)
+
+        self.send_response(200)
+        self.send_header("Content-Type",ct)
+        self.send_header("ETag", etag)
+        for k,v in headers.items():
+            self.send_header(k,v)
+
+        if content_encoding:
+            self.send_header("Content-Encoding",content_encoding)
+
+        self.send_header("Content-Length", "%s" % len(f))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(f)
 
     def do_POST(self):
         self.do_GET()
 
     def do_HEAD(self):
-        headers = {}
-        headers['Expires']='-1'
-        for k,v in headers.items():
-            try:
-                self.send_header(k,v)
-            except socket.error:
-                pass
+        self.do_GET()
     
     def do_GET(self):
         try:
@@ -184,15 +322,15 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
         
     def handle_request(self):
         headers = {}
-	accept_gzip_encoding = self.server_version.endswith("1.1") and \
-                               "gzip" in self.headers.get("Accept-Encoding","")
-
-        accept_chunked_encoding = self.server_version.endswith("1.1")
 
         ## Calculate the query from the request.
         query=self.parse_query()
 
         result = UI.UI(query=query, initial=True)
+
+        ## Allow tables to render their rows as we send the page:
+        if config.TABLE_STREAM:
+            result.generator.deferred = {}
         
         ## Work out if the request was for a static object
         ct=''
@@ -218,78 +356,21 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
             ct="audio/mpeg"
 
         if ct:
-            try:
-                import sys
-                path = os.path.normpath(config.DATADIR + query.base)
-                if path.startswith(os.path.normpath(config.DATADIR)):
-                    ## Check if there is a compressed version of this file:
-                    if accept_gzip_encoding and os.access(path + ".gz", os.F_OK):
-                        path = path+".gz"
-                        content_encoding = "gzip"
-                    else:
-                        content_encoding = None
-
-                    s = os.stat(path)
-
-                    try:
-                        ## This is the last modified time the browser
-                        ## is asking for in local time (not GMT)
-                        last_time = self.parse_date_time_string(
-                            self.headers.get('If-Modified-Since','')
-                            )-time.timezone
-
-                        #print last_time, s.st_mtime, path
-
-                        ## If the browsers idea of the modified time
-                        ## is different that ours, we cant say it was
-                        ## not modified and to be safe we return the
-                        ## current version.
-                        if int(last_time) == int(s.st_mtime):
-                            self.send_response(304)
-                            self.send_header("Expires","Sun, 17 Jan 2038 19:14:07 GMT")
-                            self.send_header("Content-Length", 0)
-                            self.end_headers()
-                            return
-                        
-                    except ValueError:
-                        pass
-                        #print self.headers.get('If-Modified-Since','')
-                    
-                    self.send_response(200)
-                    self.send_header("Content-Type",ct)                        
-                    self.send_header("Last-Modified",self.format_date_time_string(s.st_mtime))
-                    self.send_header("Etag",s.st_ino)
-                    self.send_header("Expires","Sun, 17 Jan 2038 19:14:07 GMT")                
-                    fd = open(path, "rb")
-                    f = fd.read()
-                    
-                    if content_encoding and content_encoding in self.headers.get("Accept-Encoding",""):
-                        self.send_header("Content-Encoding",content_encoding)
-                    elif len(f)>1024 and accept_gzip_encoding:
-                        f = compressBuf(f)
-                        self.send_header("Content-Encoding",'gzip')
-                        
-                    self.send_header("Content-Length", "%s" % len(f))
-                    self.end_headers()
-                    self.wfile.write(f)
-                    fd.close()
-                    return
-                else: raise TypeError("Forbidden")
-            except (TypeError,OSError),e:
-                self.wfile.write("File not found: %s"%e)
-                self.wfile.close()
-                raise
+            path = os.path.normpath(config.DATADIR + query.base)
+            if not path.startswith(os.path.normpath(config.DATADIR)):
+                self.send_error(403, "Forbidden")
                 return
 
+            try:
+                self.send_static(path, ct)
+            except (IOError, OSError),e:
+                self.send_error(404, "File not found: %s" % e)
+
+            return
+
         #We need to check the configuration and if it is incorrect, we prompt the user
         if self.check_config(result,query):
-            self.send_response(200)
-            self.send_header("Content-type",result.type)
-            result = result.display()
-            self.send_header("Content-Length", len(result))
-            self.end_headers()
-
-            self.wfile.write(result)
+            self.send_body(result.display(), result.type)
             return
 
         # Did the user asked for a complete render of the window?
@@ -369,6 +450,8 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
                               result = e.result.display()
                           except (IndexError, AttributeError):
                               result = "<html><body>Authentication Required for this page</body></html>"
+                          if isinstance(result, unicode):
+                              result = result.encode("utf8")
                           self.send_header("Content-Length", len(result))
                           self.end_headers()
                           self.wfile.write(result)
@@ -395,69 +478,69 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
                   result.pre(a.read())
                   a.close()
                   
+        ## If parts of the page are rendered as we go we send it in chunks:
+        if result.generator and result.generator.deferred and not result.generator.generator:
+            result.generator.stream(result)
+
         ## If the UI has some headers, we send those as well:
-        self.send_response(200)
-        for k,v in headers.items():
-            self.send_header(k,v)
-        
         if result.generator and result.generator.generator:
-            self.send_header("Content-Type", result.generator.content_type)
+            self.send_response(200)
+            for k,v in headers.items():
+                self.send_header(k,v)
+
+            content_type = result.generator.content_type
+            self.send_header("Content-Type", content_type)
             
             for i in result.generator.headers:
                 self.send_header(i[0],i[1])
 
-            ## Implement chunked transfer:
-            if accept_chunked_encoding:
-                self.send_header("Transfer-Encoding","chunked")
-            if accept_gzip_encoding:
-                   self.send_header("Content-Encoding","gzip")
-                   buf = cStringIO.StringIO()
-                   zfile = gzip.GzipFile(mode = "wb", fileobj = buf)
-            self.end_headers()
-
-            if not accept_chunked_encoding:
+            ## Without chunked transfer the end of the data is the
+            ## end of the connection:
+            if not self.accepts_chunked():
+                self.close_connection = 1
+                self.end_headers()
                 for data in result.generator.generator:
                     if isinstance(data, unicode):
                         data = data.encode("utf8")
                         
                     self.wfile.write(data)
 
-                self.wfile.close()
                 return
-            
+
+            ## Implement chunked transfer:
+            self.send_header("Transfer-Encoding","chunked")
+            zfile = None
+            if self.accepts_gzip() and self.compressible(content_type):
+                self.send_header("Content-Encoding","gzip")
+                buf = cStringIO.StringIO()
+                zfile = gzip.GzipFile(mode = "wb", fileobj = buf)
+
+            self.end_headers()
             for data in result.generator.generator:
-                if accept_gzip_encoding:
+                if isinstance(data, unicode):
+                    data = data.encode("utf8")
+
+                if zfile:
                     zfile.write(data)
                     data = buf.getvalue()
+                    buf.truncate(0)
+
                 if len(data)>0:
                     self.wfile.write("%x\r\n" % (len(data)))
                     self.wfile.write(data+"\r\n")
-                if accept_gzip_encoding:
-                    buf.truncate(0)
 
             ## Write the last chunk:
-            if accept_gzip_encoding:
-                zfile.flush()
+            if zfile:
+                zfile.close()
                 data = buf.getvalue()
                 if len(data)>0:
                     self.wfile.write("%x\r\n" % len(data))
                     self.wfile.write(data+"\r\n")
+
             self.wfile.write("0\r\n\r\n")
             return
 
-        self.send_header("Content-type", result.type)
-        result =result.display()
-        if isinstance(result, unicode):
-            result = result.encode("utf8")
-
-        if len(result)>1024 * 10 and accept_gzip_encoding:
-            self.send_header("Content-Encoding","gzip")
-            old_length = len(result)
-            result = compressBuf(result)
-
-        self.send_header("Content-Length", len(result))
-        self.end_headers()
-        self.wfile.write(result)
+        self.send_body(result.display(), result.type, headers)
             
         return
 
@@ -467,18 +550,53 @@ class FlagServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler, FlagFramework
                        self.log_date_time_string(),
                        format%args))
         
-#class FlagHTTPServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-#    pass
+class ThreadPoolMixIn:
+    """ Serves requests using a fixed pool of threads.
+
+    Connections wait in a queue of HTTPSERVER_QUEUE for a free
+    thread. When the queue is full we stop accepting new connections
+    until a thread frees up.
+    """
+    threads = 0
+    
+    def start_threads(self, threads):
+        self.threads = threads
+        self.requests = Queue.Queue(config.HTTPSERVER_QUEUE)
+        for i in range(threads):
+            t = threading.Thread(target = self.serve_requests,
+                                 name = "HTTPServer-%s" % i)
+            t.setDaemon(True)
+            t.start()
+
+    def serve_requests(self):
+        while 1:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.threads:
+            return BaseHTTPServer.HTTPServer.process_request(self, request, client_address)
 
-class FlagHTTPServer( BaseHTTPServer.HTTPServer):
+        self.requests.put((request, client_address))
+
+class FlagHTTPServer(ThreadPoolMixIn, BaseHTTPServer.HTTPServer):
     pass
 
 def Server(HandlerClass = FlagServerHandler,
-           ServerClass = FlagHTTPServer, protocol="HTTP/1.0"):
+           ServerClass = FlagHTTPServer, protocol="HTTP/1.1"):
     server_address = (config.HTTPSERVER_BINDIF,config.HTTPSERVER_PORT)
 
     HandlerClass.protocol_version = protocol
+
+    ## Idle keep-alive connections are closed after this long:
+    HandlerClass.timeout = config.HTTPSERVER_KEEPALIVE
     httpd = ServerClass(server_address, HandlerClass)
+    httpd.start_threads(config.HTTPSERVER_THREADS)
     #httpd.socket.settimeout(1.0)
     sa = list(httpd.socket.getsockname())
     pyflaglog.log(pyflaglog.INFO, "Serving PyFlag requests on http://%s:%s" % (sa[0],sa[1]))
@@ -38,7 +38,15 @@ import re,cStringIO
 config.add_option("IMAGEDIR", default=config.DATADIR + "/images/",
                   help="Directory for all images/thumbnails")
 
-import os,pipes
+config.add_option("THUMBNAIL_CACHE", default=True, action="store_false",
+                  help="Keep thumbnails in the case's result directory so "
+                  "they are only made once")
+
+import os,pipes,tempfile
+import pyflag.CacheManager as CacheManager
+
+## The width of thumbnails in tables and galleries:
+THUMBNAIL_SIZE = 200
 
 class GraphException(Exception): pass
 
@@ -63,7 +71,7 @@ class Image:
         """
         import pyflag.Magic as Magic
 
-        magic = Magic.MagicResolver()
+        magic = Magic.get_resolver()
         return magic.estimate_type(self.display(), None, None)[0][1].mime_str()
     
     def SetFormat(self,format):
@@ -109,6 +117,68 @@ Graph = GenericGraph
 ## We use the python imaging library to manipulate all the images:
 import PIL.Image
 
+def thumbnail_filename(case, inode_id, size_x):
+    """ Thumbnails are stored in the case's result directory by
+    inode_id and size (inodes never change so this is all we need)
+    """
+    return CacheManager.make_cache_filename(
+        case, os.path.join("thumbnails", "%s_%s" % (inode_id, size_x)))
+
+def get_thumbnail(case, inode_id, size_x):
+    """ Returns the cached (content_type, width, height, magic, data)
+    of the thumbnail. Raises IOError if it is not cached.
+    """
+    if not config.THUMBNAIL_CACHE:
+        raise IOError("Thumbnail cache disabled")
+
+    fd = open(thumbnail_filename(case, inode_id, size_x), 'rb')
+    try:
+        content_type, width, height, magic = fd.readline()[:-1].split("\t", 3)
+        return content_type, int(width), int(height), magic, fd.read()
+    finally:
+        fd.close()
+
+def put_thumbnail(case, inode_id, size_x, content_type, width, height, magic, data):
+    """ Stores a thumbnail in the cache """
+    if not config.THUMBNAIL_CACHE: return
+
+    filename = thumbnail_filename(case, inode_id, size_x)
+    dirname = os.path.dirname(filename)
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        pass
+
+    ## We write a new file and rename it, so readers never see half a
+    ## thumbnail:
+    try:
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+    except OSError:
+        return
+
+    try:
+        os.write(fd, "%s\t%s\t%s\t%s\n" % (content_type, width, height,
+                                          re.sub("[\r\n]", " ", magic or '')))
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp, filename)
+    except OSError:
+        os.unlink(tmp)
+
+def thumbnail_size(width, height, size_x):
+    """ The dimensions of the thumbnail of a width by height image
+    (thumbnails are never larger than the image)
+    """
+    if width > height:
+        dimensions = ( size_x, int(size_x * height / width))
+    else:
+        dimensions = ( int(size_x * width / height), size_x)
+
+    if dimensions[0] > width or dimensions[1] > height:
+        return width, height
+
+    return dimensions
+
 class Thumbnailer(Image):
     """ An image class to display thumbnails files.
     
@@ -126,10 +196,32 @@ class Thumbnailer(Image):
         self.width = 0
         self.height = 0
 
+        inode_id = self.fd.lookup_id()
+        try:
+            self.content_type, self.width, self.height, self.magic, data = \
+                               get_thumbnail(self.fd.case, inode_id, size_x)
+            self.thumbnail = cStringIO.StringIO(data)
+            return
+        except (IOError, ValueError):
+            pass
+
+        self.make_thumbnail()
+
+        ## Keep the thumbnail for next time:
+        try:
+            data = self.display()
+        except AttributeError:
+            return
+
+        self.thumbnail = cStringIO.StringIO(data)
+        put_thumbnail(self.fd.case, inode_id, size_x, self.content_type,
+                      self.width, self.height, self.magic, data)
+
+    def make_thumbnail(self):
         ## Calculate the magic of this file:
         import pyflag.Magic as Magic
 
-        magic = Magic.MagicResolver()
+        magic = Magic.get_resolver()
         self.magic, self.content_type = magic.find_inode_magic(self.fd.case,
                                                                inode_id = self.fd.lookup_id())
 
@@ -214,11 +306,7 @@ class Thumbnailer(Image):
         self.width, self.height = self.image.size
         self.owidth, self.oheight = self.image.size
 
-        ## Calculate the ratio
-        if self.width > self.height:
-            dimensions = ( self.size_x, int(self.size_x * self.height / self.width))
-        else:
-            dimensions = ( int(self.size_x * self.width / self.height), self.size_x)
+        dimensions = thumbnail_size(self.width, self.height, self.size_x)
 
         self.thumbnail = cStringIO.StringIO()
         try:
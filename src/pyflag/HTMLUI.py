@@ -55,12 +55,49 @@ def quote_quotes(string):
 class HTMLException(Exception):
     """ An exception raised within the UI - should not escape from this module """
 
+## Matches the markers left in pages by HTTPObject.defer():
+DEFERRED_RE = re.compile("(<!-- deferred \\d+-\\d+ -->)")
+
 class HTTPObject:
+    ## Parts of the page which are rendered as it is sent (see
+    ## defer()). This is None if pages are not streamed.
+    deferred = None
+    
     def __init__(self):
         self.content_type=None
         self.generator=None
         self.headers=[]
 
+    def defer(self, generator):
+        """ Returns a marker to place in the page instead of the data
+        from generator, which is only rendered as the page is sent.
+
+        Returns None if we do not stream pages.
+        """
+        if self.deferred is None: return None
+
+        marker = "<!-- deferred %s-%s -->" % (id(self), len(self.deferred))
+        self.deferred[marker] = generator
+        return marker
+
+    def stream(self, ui):
+        """ Sends the page of ui through our generator, filling in
+        the deferred parts as we go.
+        """
+        self.content_type = ui.type
+        self.generator = self.generate(ui.display())
+
+    def generate(self, page):
+        for part in DEFERRED_RE.split(page):
+            try:
+                generator = self.deferred.pop(part)
+            except KeyError:
+                yield part
+                continue
+
+            for data in generator:
+                yield data
+
 class HTMLUI(UI.GenericUI):
     """ A HTML UI implementation.
 
@@ -205,7 +242,7 @@ class HTMLUI(UI.GenericUI):
         """
         import pyflag.Magic as Magic
         
-        magic=Magic.MagicResolver()
+        magic=Magic.get_resolver()
         file.seek(0)
         data=file.read(1000)
         type, self.generator.content_type = magic.get_type(data)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A compact set of binary hashes (e.g. the NSRL MD5s) on disk.
+
+The set is a file of sorted fixed size digests, optionally preceded
+by a bloom filter. The file is memory mapped read only, so membership
+tests need no database connection, and all processes which open the
+same file share its pages in the OS page cache.
+
+Lookups first check the bloom filter (if there is one), which rejects
+most misses by touching a few pages, and then binary search the
+sorted digests.
+
+File format:
+
+  header: 'PFHS', digest size, number of digests, bloom filter bits,
+          number of bloom hash functions
+  bloom filter bits (rounded up to whole bytes)
+  sorted digests
+"""
+import os, mmap, struct, tempfile
+
+MAGIC = "PFHS"
+HEADER = struct.Struct("<4sIQQI")
+
+def bloom_positions(digest, bits, k):
+    """ Returns the bloom filter bit positions of the digest.
+
+    Digests are cryptographic hashes, so we derive all the bloom hash
+    functions from the digest itself by double hashing.
+    """
+    h1, h2 = struct.unpack("<QQ", digest[:16].ljust(16, "\x00"))
+    h2 |= 1
+    return [ (h1 + i * h2) % bits for i in range(k) ]
+
+def write_hashset(filename, digests, count, bits_per_digest=10, digest_size=16):
+    """ Writes the hash set file.
+
+    digests must be an iterator of digests in sorted order without
+    duplicates. count is the number of digests (an upper bound is ok -
+    it is only used to size the bloom filter). If bits_per_digest is
+    0, no bloom filter is written.
+    """
+    bits = count * bits_per_digest
+    ## About 0.7 bits per digest per hash function is optimal:
+    k = max(1, int(bits_per_digest * 0.69))
+    bloom = bits and bytearray((bits + 7) / 8) or bytearray()
+
+    ## We do not know the real count until we have seen all the
+    ## digests, so we write them to a temporary file first:
+    directory = os.path.dirname(os.path.abspath(filename))
+    tmp_fd, tmp_name = tempfile.mkstemp(dir = directory)
+    tmp = os.fdopen(tmp_fd, "w+b")
+    try:
+        written = 0
+        last = None
+        for digest in digests:
+            if len(digest) != digest_size:
+                raise ValueError("Digest %r is not %s bytes" % (digest, digest_size))
+
+            if last is not None and digest <= last:
+                raise ValueError("Digests must be sorted and unique")
+
+            last = digest
+            tmp.write(digest)
+            written += 1
+            if bits:
+                for position in bloom_positions(digest, bits, k):
+                    bloom[position >> 3] |= 1 << (position & 7)
+
+        tmp.seek(0)
+        ## Another load may be writing the same set, so we each write
+        ## our own file and rename it into place:
+        fd, out_name = tempfile.mkstemp(dir = directory)
+        try:
+            fd = os.fdopen(fd, "wb")
+            try:
+                fd.write(HEADER.pack(MAGIC, digest_size, written, bits, k))
+                fd.write(str(bloom))
+                while 1:
+                    data = tmp.read(1024 * 1024)
+                    if not data: break
+                    fd.write(data)
+            finally:
+                fd.close()
+
+            os.rename(out_name, filename)
+        except:
+            os.unlink(out_name)
+            raise
+    finally:
+        tmp.close()
+        os.unlink(tmp_name)
+
+    return written
+
+class HashSet:
+    """ A read only hash set file """
+    def __init__(self, filename):
+        self.filename = filename
+        fd = open(filename, "rb")
+        try:
+            self.mtime = os.fstat(fd.fileno()).st_mtime
+            magic, self.digest_size, self.count, self.bits, self.k = \
+                   HEADER.unpack(fd.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError("%s is not a hash set file" % filename)
+
+            self.map = mmap.mmap(fd.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            fd.close()
+
+        self.bloom_offset = HEADER.size
+        self.offset = self.bloom_offset + (self.bits + 7) / 8
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        m = self.map
+        if self.bits:
+            for position in bloom_positions(digest, self.bits, self.k):
+                if not ord(m[self.bloom_offset + (position >> 3)]) & (1 << (position & 7)):
+                    return False
+
+        size = self.digest_size
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            offset = self.offset + mid * size
+            value = m[offset:offset + size]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+
+        return False
+
+    def close(self):
+        self.map.close()
+
+## Unit tests:
+import unittest
+from hashlib import md5
+
+class HashSetTests(unittest.TestCase):
+    """ Hash set file tests """
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test01Lookup(self):
+        """ Test hash set membership """
+        digests = [ md5(str(i)).digest() for i in range(1000) ]
+        present = digests[:500]
+        present.sort()
+
+        for bits in (0, 10):
+            write_hashset(self.filename, iter(present), len(present), bits)
+            hashset = HashSet(self.filename)
+            self.assertEqual(len(hashset), 500)
+            for digest in digests[:500]:
+                self.assert_(digest in hashset)
+
+            for digest in digests[500:]:
+                self.assert_(digest not in hashset)
+
+            hashset.close()
+
+    def test02Unsorted(self):
+        """ Test that unsorted digests are rejected """
+        self.assertRaises(ValueError, write_hashset, self.filename,
+                          iter(["b" * 16, "a" * 16]), 2)
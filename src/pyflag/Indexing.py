@@ -49,9 +49,12 @@ inode_upto_date() to see when the indexing job has been completed.
 
 """
 import index
+import pyflag.conf
+config=pyflag.conf.ConfObject()
 import pyflag.DB as DB
 import time
 import pyflag.Farm as Farm
+import pyflag.PostingIndex as PostingIndex
 
 def inode_upto_date(case, inode_id, unique = False):
     return inode_upto_date_sql(case, "inode_id = '%s'" % inode_id, unique)
@@ -237,7 +240,10 @@ def schedule_inode_index_sql(case, sql, word_id, cookie='', unique=True):
 
 def list_hits(case, inode_id, word, start=None, end=None):
     """ Returns a generator of hits of the word within the inode
-    between offset start and end (these are inode offsets."""
+    between offset start and end (these are inode offsets.
+
+    Each hit is a dict with offset and length keys.
+    """
     dbh = DB.DBO(case)
     pdbh = DB.DBO()
     pdbh.execute("select id from dictionary where word = %r limit 1" , word)
@@ -253,6 +259,11 @@ def list_hits(case, inode_id, word, start=None, end=None):
         ranges += DB.expand("and offset < %r", (end,))
         
     id = row['id']
+    if config.INDEX_BACKEND == 'posting':
+        index = PostingIndex.get_index(case)
+        return [ dict(offset=offset, length=length) for offset, length in
+                 index.list_hits(inode_id, id, start, end) ]
+
     dbh.execute("select offset,length from LogicalIndexOffsets where "
                 "inode_id = %r and word_id = %r %s order by offset", inode_id, id, ranges)
 
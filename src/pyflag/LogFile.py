@@ -43,6 +43,16 @@ import pyflag.Registry as Registry
 import pyflag.IO as IO
 import cStringIO
 import pyflag.code_parser as code_parser
+import tempfile, os
+
+config.add_option("LOG_MASS_INSERT", default=False, action='store_true',
+                  help = "Load log files using insert statements instead of bulk loading them with LOAD DATA LOCAL INFILE")
+
+config.add_option("LOG_BULK_ROWS", default=100000, type='int',
+                  help = "Number of log rows to bulk load at the time (the load is checkpointed after each)")
+
+config.add_option("LOG_READ_SIZE", default=1024*1024, type='int',
+                  help = "Size of the blocks read from log files")
 
 def get_file(query,result):
     result.row("Select a sample log file for the previewer",stretch=False)
@@ -161,30 +171,21 @@ class Log:
             fd = IO.open_URL(file)
             buffer = ''
             while 1:
-                if len(buffer) < 1024:
-                    data = fd.read(1024)
-                    buffer = buffer + data
-
-                tmp = buffer.split("\n",1)
-                if len(tmp) == 0: break
-
-                line = tmp[0]
-               
-                try:
-                    buffer = tmp[1]
-                except:
-                    data = fd.read(1024)
-                    if len(data) == 0:
-                        break
-                    buffer = line + data
-                    continue
-                
-                if blank.match(line) or not line:
-                    continue
-                if line.startswith('#') and ignore_comment:
-                    continue
-                else:
-                    yield line
+                data = fd.read(config.LOG_READ_SIZE)
+
+                ## An unterminated last line is ignored:
+                if not data: break
+
+                lines = (buffer + data).split("\n")
+                buffer = lines.pop()
+
+                for line in lines:
+                    if not line or blank.match(line):
+                        continue
+                    if line.startswith('#') and ignore_comment:
+                        continue
+                    else:
+                        yield line
 
     def get_fields(self):
         """ A generator that returns all the columns in a log file.
@@ -198,16 +199,22 @@ class Log:
         ## By default we dont split the row
         return [self.read_record(),]
     
-    def load(self,name, rows = None, deleteExisting=None, filter=None):
+    def load(self,name, rows = None, deleteExisting=None, filter=None, bulk=None):
         """ Loads the specified number of rows into the database.
 
         __NOTE__ We assume this generator will run to
         completion... This is a generator just in order to provide a
         running progress indication - maybe this should change?
 
+        When bulk loading, rows are written to a file which is loaded
+        using LOAD DATA LOCAL INFILE every LOG_BULK_ROWS rows. We
+        checkpoint after each of these, so if the load is interrupted,
+        loading the same table again resumes from the last checkpoint.
+
         @arg table_name: A table name to use
         @arg rows: number of rows to upload - if None , we upload them all
         @arg deleteExisting: If this is anything but none, tablename will first be dropped
+        @arg bulk: Bulk load the rows (unless LOG_MASS_INSERT is set). Previews (which only load a few rows) are never bulk loaded.
         @return: A generator that represents the current progress indication.
         """
         ## We append _log to tablename to prevent name clashes in the
@@ -254,14 +261,36 @@ class Log:
         else:
             filter_parser = None
 
+        if bulk is None:
+            bulk = not config.LOG_MASS_INSERT
+
+        loader = None
+        skip = 0
+        if bulk and not rows:
+            ## Only columns which are in the table (e.g. not padding)
+            ## are loaded:
+            loader = BulkLoader(self.case, tablename,
+                                [ f for f in fields if f.create() and not f.ignore ])
+            if not loader.check():
+                loader = None
+
+        if loader:
+            skip = loader.resume()
+            if skip:
+                yield "Resuming after %s rows" % skip
+
         ## Now insert into the table:
         count = 0
         for fields in self.get_fields():
             count += 1
+            if count <= skip: continue
+            
             args = None
+            values = None
             columns = {}
             if isinstance(fields, list):
                 args = dict()
+                values = dict()
                 ## Iterate on the shortest of fields (The fields array
                 ## returned from parsing this line) and self.fields
                 ## (The total number of fields we expect)
@@ -273,20 +302,33 @@ class Log:
                         v = fields[i]
                         columns[c.column] = v
 
-                        ## Ask the columns to format their own insert statements
-                        key, value = c.insert(v)
-                        args[str(key)] = value
+                        if loader:
+                            if c.column in loader.known:
+                                values[c.column] = c.load_value(v)
+                        else:
+                            ## Ask the columns to format their own insert statements
+                            key, value = c.insert(v)
+                            args[str(key)] = value
                     except (IndexError,AttributeError),e:
                         pyflaglog.log(pyflaglog.WARNING, "Attribute or Index Error when inserting value into field: %r" % e)
             elif isinstance(fields, dict):
                 args = fields
                 columns = fields
+
+                ## Rows with sql expressions can not be bulk loaded:
+                if loader and loader.can_load(fields):
+                    values = fields
+                    args = None
                 
             ## If the filter does not match, we ignore this row:
             if filter_parser:
                 if not filter_parser(columns): continue
 
-            if args:
+            if values:
+                loader.add(values, count)
+            elif args and loader:
+                loader.insert(args, count)
+            elif args:
                 dbh.mass_insert(args)
             
             if rows and count > rows:
@@ -296,6 +338,9 @@ class Log:
                 yield "Loaded %s rows" % count
 
         dbh.mass_insert_commit()
+        if loader:
+            loader.commit(count)
+
         ## Now create indexes on the required fields
         for i in self.fields:
             try:
@@ -306,6 +351,9 @@ class Log:
             except AttributeError:
                 pass
 
+        if loader:
+            loader.finish()
+
         return
 
     def restore(self, name):
@@ -351,6 +399,155 @@ class Log:
 
         return result
 
+class BulkLoader:
+    """ Loads rows into a log table using LOAD DATA LOCAL INFILE.
+
+    Rows are written to a temporary file in mysql's tab seperated
+    format, which is loaded every LOG_BULK_ROWS rows. After each load
+    we store a checkpoint in the meta table with the number of records
+    read from the log and the number of rows in the table, so that an
+    interrupted load can be resumed.
+
+    Rows which can not be bulk loaded are given to insert() and are
+    inserted just before the next load, so the checkpoint counts them
+    too.
+
+    Call check() first - if it fails the table must be loaded with
+    mass inserts instead.
+    """
+    def __init__(self, case, tablename, columns):
+        ## Only our own handle may load local files:
+        self.dbh = DB.LoadDataDBO(case)
+        self.tablename = tablename
+        self.fields = columns
+        self.columns = [ c.column for c in columns ]
+        self.known = dict.fromkeys(self.columns)
+        self.property = "log_load_%s" % tablename
+
+        ## The file has a user variable for columns which are set
+        ## from sql expressions:
+        self.file_columns = []
+        self.sets = []
+        for c in columns:
+            expression = c.load_set("@%s" % c.column)
+            if expression:
+                self.file_columns.append("@%s" % c.column)
+                self.sets.append((c.column, expression))
+            else:
+                self.file_columns.append(c.column)
+
+        self.loaded = 0
+        self.start_file()
+
+    def check(self):
+        """ Returns True if we can bulk load the table.
+
+        All columns must be bulk loadable and the server must allow
+        LOAD DATA LOCAL INFILE. If not we clean up and return False.
+        """
+        for c in self.fields:
+            if not c.bulk_loadable():
+                pyflaglog.log(pyflaglog.DEBUG, "Column type %s can not be bulk loaded - using mass insert for %s" % (
+                    c.__class__.__name__, self.tablename))
+                break
+        else:
+            ## Try to load our (still empty) file:
+            try:
+                self.dbh.load_data(self.tablename, self.filename, self.file_columns,
+                                   self.sets, _fast=True)
+                return True
+            except DB.DBError, e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to bulk load %s (%s) - using mass insert" % (
+                    self.tablename, e))
+
+        self.fd.close()
+        os.unlink(self.filename)
+        return False
+
+    def start_file(self):
+        fd, self.filename = tempfile.mkstemp(prefix="log_load_", dir=config.RESULTDIR)
+        self.fd = os.fdopen(fd, "wb")
+        self.rows = 0
+        self.inserts = []
+
+    def resume(self):
+        """ Returns the number of records to skip to resume a previous
+        load of this table.
+        """
+        checkpoint = self.dbh.get_meta(self.property)
+        if not checkpoint: return 0
+
+        records, loaded = [ int(x) for x in checkpoint.split(",") ]
+        self.dbh.execute("select count(*) as count from `%s`", self.tablename)
+        count = self.dbh.fetch()['count']
+
+        ## MyISAM can not roll back a partially loaded file, so if
+        ## that happened we need to start again:
+        if count != loaded:
+            pyflaglog.log(pyflaglog.WARNING, "Table %s was not loaded cleanly - starting again" % self.tablename)
+            self.dbh.delete(self.tablename, where="1", _fast=True)
+            return 0
+
+        self.loaded = loaded
+        return records
+
+    def can_load(self, row):
+        for k in row.keys():
+            if k not in self.known:
+                return False
+
+        return True
+
+    def add(self, values, records):
+        """ Adds a row of values (a dict keyed by column).
+
+        records is the number of records read from the log so far.
+        """
+        self.fd.write("\t".join([ DB.load_escape(values.get(c)) for c in self.columns ]))
+        self.fd.write("\n")
+        self.rows += 1
+        if self.rows + len(self.inserts) >= config.LOG_BULK_ROWS:
+            self.commit(records)
+
+    def insert(self, args, records):
+        """ Adds a row which can not be bulk loaded (e.g. because it
+        has sql expressions) - it is mass inserted instead.
+        """
+        self.inserts.append(args)
+        if self.rows + len(self.inserts) >= config.LOG_BULK_ROWS:
+            self.commit(records)
+
+    def commit(self, records):
+        """ Loads the rows written so far and records the checkpoint """
+        self.fd.close()
+        try:
+            if self.inserts:
+                self.dbh.mass_insert_start(self.tablename, _fast=True)
+                for args in self.inserts:
+                    self.dbh.mass_insert(args)
+
+                self.dbh.mass_insert_commit()
+
+            if self.rows:
+                self.dbh.load_data(self.tablename, self.filename, self.file_columns,
+                                   self.sets, _fast=True)
+
+            if self.rows or self.inserts:
+                self.loaded += self.rows + len(self.inserts)
+                self.dbh.set_meta(self.property, "%s,%s" % (records, self.loaded))
+        finally:
+            os.unlink(self.filename)
+
+        self.start_file()
+
+    def finish(self):
+        """ Called when the table is completely loaded """
+        self.fd.close()
+        os.unlink(self.filename)
+        self.dbh.delete("meta", where=DB.expand("property=%r", self.property), _fast=True)
+        self.dbh.invalidate(self.tablename)
+        self.dbh.commit_invalidations()
+
 ## The following methods unify manipulation and access of log presets.
 ## The presets are stored in FLAGDB.log_presets and the table names
 ## are stored in casedb.log_tables. The names specified in the
@@ -12,60 +12,71 @@ automatically. Otherwise the highest score wins.
 The usual tests include a set of regexs to be run over the file
 header, but other tests are also possible.
 """
-import index
+import index, threading
 import pyflag.Registry as Registry
 import pyflag.DB as DB
 import pyflag.FileSystem as FileSystem
 import pyflag.pyflaglog as pyflaglog
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+
+config.add_option("MAGIC_HEADER_SIZE", default=1024, type='int',
+                  help="Number of bytes at the start of a file which the "
+                  "magic signatures are matched against")
+
+config.add_option("MAGIC_COMMIT_BATCH", default=100, type='int',
+                  help="Number of file types found by the scanners which "
+                  "are written to the type table at once")
 
 class MagicResolver:
-    """ This is a highlander class to manage access to all the resolvers """
-    indexer = None
-    index_map = {}
-    rule_map = {}
-    count = 0
-    magic_handlers = []
+    """ This is a highlander class to manage access to all the
+    resolvers. Use get_resolver() rather than making new ones.
+
+    Files are classified in two steps. The signatures of all handlers
+    are compiled into one index which is run over the header of the
+    file. Most files are decided by that alone. Only if no handler is
+    certain (scores 100) do we ask each handler to score() the data,
+    which may be expensive (e.g. libmagic or database lookups).
+    """
+    ## Set this to always score() the data with every handler:
+    two_tier = True
 
     def __init__(self):
         """ We keep a record of all magic handlers and instantiate them all.
         """
-        if not MagicResolver.indexer:
-            MagicResolver.indexer = index.Index()
-            for cls in Registry.MAGIC_HANDLERS.classes:
-                cls = cls()
-                MagicResolver.magic_handlers.append(cls)
-                for rule in cls.regex_rules:
-                    MagicResolver.indexer.add_word(rule[0], MagicResolver.count, index.WORD_EXTENDED)
-                    MagicResolver.index_map[MagicResolver.count] = cls
-                    MagicResolver.rule_map[MagicResolver.count] = rule
-                    MagicResolver.count += 1
-
-                for rule in cls.literal_rules:
-                    MagicResolver.indexer.add_word(rule[0], MagicResolver.count, index.WORD_ENGLISH)
-                    MagicResolver.index_map[MagicResolver.count] = cls
-                    MagicResolver.rule_map[MagicResolver.count] = rule
-                    MagicResolver.count += 1
-
-            pyflaglog.log(pyflaglog.DEBUG,"Loaded %s signatures into Magic engine" % MagicResolver.count)
+        self.indexer = index.Index()
+        self.index_map = {}
+        self.rule_map = {}
+        self.count = 0
+        self.magic_handlers = []
+
+        for cls in Registry.MAGIC_HANDLERS.classes:
+            cls = cls()
+            self.magic_handlers.append(cls)
+            for rule in cls.regex_rules:
+                self.indexer.add_word(rule[0], self.count, index.WORD_EXTENDED)
+                self.index_map[self.count] = cls
+                self.rule_map[self.count] = rule
+                self.count += 1
+
+            for rule in cls.literal_rules:
+                self.indexer.add_word(rule[0], self.count, index.WORD_ENGLISH)
+                self.index_map[self.count] = cls
+                self.rule_map[self.count] = rule
+                self.count += 1
+
+        pyflaglog.log(pyflaglog.DEBUG,"Loaded %s signatures into Magic engine" % self.count)
             
     def get_type(self, data, case=None, inode_id=None):
         max_score, scores = self.estimate_type(data, case, inode_id)
         return max_score[1].type_str(), max_score[1].mime_str()
 
-    def estimate_type(self,data, case, inode_id):
-        """ Given the data we guess the best type determination. 
+    def score_header(self, data, scores, max_score):
+        """ Adds the scores of all signatures found in data to scores.
+
+        Returns the new max_score.
         """
-        scores = {}
-        max_score = [0, None]
         pending = set(self.rule_map.keys())
-        
-        ## Give all handlers a chance to rate the data
-        for cls in self.magic_handlers:
-            scores[cls] = cls.score(data, case, inode_id)
-            
-            ## Maintain the higher score in the list:
-            if scores[cls] > max_score[0]:
-                max_score = [ scores[cls], cls]
 
         ## Index the data using the indexer:
         for offset, matches in self.indexer.index_buffer(data, unique=0):
@@ -93,12 +104,36 @@ class MagicResolver:
 
                 ## When one of the scores is big enough we quit:
                 if max_score[0] >= 100:
-                    break
+                    return max_score
 
+        return max_score
+
+    def estimate_type(self,data, case, inode_id):
+        """ Given the data we guess the best type determination. 
+        """
+        scores = {}
+        max_score = [0, None]
+        for cls in self.magic_handlers:
+            scores[cls] = 0
+
+        if self.two_tier:
+            max_score = self.score_header(data[:config.MAGIC_HEADER_SIZE],
+                                          scores, max_score)
             if max_score[0] >= 100:
-                break
+                return max_score, scores
 
+        ## Give all handlers a chance to rate the data
+        for cls in self.magic_handlers:
+            scores[cls] += cls.score(data, case, inode_id)
             
+            ## Maintain the higher score in the list:
+            if scores[cls] > max_score[0]:
+                max_score = [ scores[cls], cls]
+
+        if not self.two_tier and max_score[0] < 100:
+            max_score = self.score_header(data[:config.MAGIC_HEADER_SIZE],
+                                          scores, max_score)
+
         ## Return the highest score:
         return max_score, scores
 
@@ -114,6 +149,12 @@ class MagicResolver:
             row = dbh.fetch()
             inode_id = row['inode_id']
 
+        ## Types found by the scanners may not be written yet:
+        try:
+            return TYPES.pending_type(case, inode_id)
+        except KeyError:
+            pass
+
         ## Is it already in the type table?
         try:
             dbh.execute("select mime,type from type where inode_id=%r limit 1",inode_id)
@@ -126,19 +167,27 @@ class MagicResolver:
                 fd = fsfd.open(inode_id = inode_id)
                 ## We could not find it in the mime table - lets do magic
                 ## ourselves:
-                data = fd.read(1024)
+                data = fd.read(config.MAGIC_HEADER_SIZE)
                 fd.seek(0)
                 
             type, content_type = self.cache_type(case, inode_id, data)
 
         return type, content_type
 
-    def cache_type(self, case, inode_id, data):
-        """ Performs a type lookup of data and caches it in the inode_id """
-        dbh = DB.DBO(case)
+    def cache_type(self, case, inode_id, data, batch=False):
+        """ Performs a type lookup of data and caches it in the inode_id
+
+        If batch is set the type is written with the next batch (see
+        TypeWriter), otherwise it is written now.
+        """
         type, content_type = self.get_type(data, case, inode_id)
 
         ## Store it in the db for next time:
+        if batch:
+            TYPES.add(case, inode_id, type, content_type)
+            return type, content_type
+
+        dbh = DB.DBO(case)
         try:
             dbh.insert("type",
                        inode_id = inode_id,
@@ -147,6 +196,88 @@ class MagicResolver:
         except: pass
 
         return type, content_type
+
+## The resolver shared by the whole process:
+RESOLVER = None
+RESOLVER_LOCK = threading.Lock()
+
+def get_resolver():
+    """ Returns the process wide MagicResolver (which is built the first
+    time we are called)
+    """
+    global RESOLVER
+
+    if not RESOLVER:
+        RESOLVER_LOCK.acquire()
+        try:
+            if not RESOLVER:
+                RESOLVER = MagicResolver()
+        finally:
+            RESOLVER_LOCK.release()
+
+    return RESOLVER
+
+class TypeWriter:
+    """ Batches the rows the scanners write into the type table.
+
+    This is one of the Scanner.BATCH_WRITERS, so it is flushed when
+    scanning is complete.
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        ## Keyed by case, then by inode_id - values are (type, mime)
+        self.pending = {}
+        self.count = 0
+
+    def add(self, case, inode_id, type, mime):
+        self.mutex.acquire()
+        try:
+            self.pending.setdefault(case, {})[inode_id] = (type, mime)
+            self.count += 1
+        finally:
+            self.mutex.release()
+
+        if self.count >= config.MAGIC_COMMIT_BATCH:
+            self.flush()
+
+    def pending_type(self, case, inode_id):
+        """ Returns the (type, mime) of inode_id if it is not written
+        yet. Raises KeyError otherwise.
+        """
+        self.mutex.acquire()
+        try:
+            return self.pending[case][inode_id]
+        finally:
+            self.mutex.release()
+
+    def flush(self, case=None):
+        """ Writes all pending rows (for case only if specified) """
+        self.mutex.acquire()
+        try:
+            if case:
+                cases = { case: self.pending.pop(case, {}) }
+            else:
+                cases = self.pending
+                self.pending = {}
+
+            self.count = sum([ len(rows) for rows in self.pending.values() ])
+        finally:
+            self.mutex.release()
+
+        for case, rows in cases.items():
+            if not rows: continue
+
+            dbh = DB.DBO(case)
+            dbh.mass_insert_start("type")
+            for inode_id, (type, mime) in rows.items():
+                dbh.mass_insert(inode_id = inode_id, mime = mime, type = type)
+
+            try:
+                dbh.mass_insert_commit()
+            except DB.DBError,e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to write file types: %s" % e)
+
+TYPES = TypeWriter()
     
 class Magic:
     """ This is the base class for all Magic handlers. """
@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" An inverted index of keyword hits stored as posting lists.
+
+This is an alternative to storing every keyword hit as a row in the
+LogicalIndexOffsets table (selected with INDEX_BACKEND=posting). The
+hits of each word within each inode are stored as a posting list -
+the hit offsets are delta encoded as varints together with the hit
+lengths.
+
+Posting lists are written to immutable segment files in the case's
+result directory. Each segment also records all the inodes which were
+indexed when it was made (even those without hits). When an inode is
+indexed again its hits are taken from the newest segment which
+covers it, so older hits are superseded without rewriting old
+segments.
+
+Segments are merged in the background once there are more than
+INDEX_MERGE_FACTOR of them. Only adjacent segments are merged and the
+merged segment takes the place of the newest one, so that superseded
+hits remain superseded.
+
+Segment file format:
+
+  'PFPL'
+  posting lists...
+  directory: count, count * (word_id, inode_id, offset, hits, size)
+  covered inodes: count, count * inode_id
+  trailer: directory offset, covered inodes offset, 'PFPL'
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.pyflaglog as pyflaglog
+import os, struct, time, array, threading, fcntl
+
+config.add_option("INDEX_BACKEND", default='table',
+                  help="Where detailed keyword hits are stored (table or posting)")
+
+config.add_option("INDEX_SEGMENT_HITS", default=1000000, type='int',
+                  help="Number of keyword hits buffered before writing an index segment")
+
+config.add_option("INDEX_MERGE_FACTOR", default=8, type='int',
+                  help="Number of index segments merged at once")
+
+MAGIC = "PFPL"
+DIRECTORY_ENTRY = struct.Struct("<IIQII")
+TRAILER = struct.Struct("<QQ4s")
+COUNT = struct.Struct("<I")
+
+def encode_hits(hits):
+    """ Encodes a sorted list of (offset, length) """
+    result = []
+    last = 0
+    for offset, length in hits:
+        value = offset - last
+        while value >= 0x80:
+            result.append(chr(value & 0x7f | 0x80))
+            value >>= 7
+        result.append(chr(value))
+
+        while length >= 0x80:
+            result.append(chr(length & 0x7f | 0x80))
+            length >>= 7
+        result.append(chr(length))
+
+        last = offset
+
+    return ''.join(result)
+
+def decode_hits(data):
+    """ Returns a list of (offset, length) from an encoded posting list """
+    result = []
+    values = []
+    value = shift = 0
+    for c in data:
+        c = ord(c)
+        value |= (c & 0x7f) << shift
+        if c & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+
+    offset = 0
+    for i in range(0, len(values), 2):
+        offset += values[i]
+        result.append((offset, values[i+1]))
+
+    return result
+
+def index_directory(case):
+    return os.path.join(config.RESULTDIR, "case_%s" % case, "posting_index")
+
+class SegmentWriter:
+    """ Writes a new segment file.
+
+    The segment only becomes visible when it is closed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename + ".tmp", "wb")
+        self.fd.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.directory = []
+        self.covered = []
+
+    def add(self, word_id, inode_id, hits):
+        hits.sort()
+        self.add_encoded(word_id, inode_id, len(hits), encode_hits(hits))
+
+    def add_encoded(self, word_id, inode_id, count, data):
+        self.fd.write(data)
+        self.directory.append((word_id, inode_id, self.offset, count, len(data)))
+        self.offset += len(data)
+
+    def cover(self, inode_ids):
+        """ Records that inode_ids were indexed in this segment """
+        self.covered.extend(inode_ids)
+
+    def close(self):
+        self.directory.sort()
+        directory_offset = self.offset
+        self.fd.write(COUNT.pack(len(self.directory)))
+        for entry in self.directory:
+            self.fd.write(DIRECTORY_ENTRY.pack(*entry))
+
+        covered_offset = directory_offset + COUNT.size + \
+                         len(self.directory) * DIRECTORY_ENTRY.size
+        covered = array.array('I', self.covered)
+        self.fd.write(COUNT.pack(len(covered)))
+        self.fd.write(covered.tostring())
+
+        self.fd.write(TRAILER.pack(directory_offset, covered_offset, MAGIC))
+        self.fd.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+class Segment:
+    """ Reads a segment file """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, "rb")
+        self.lock = threading.Lock()
+        self.size = os.path.getsize(filename)
+
+        self.fd.seek(-TRAILER.size, 2)
+        directory_offset, covered_offset, magic = TRAILER.unpack(self.fd.read(TRAILER.size))
+        if magic != MAGIC:
+            raise IOError("%s is not an index segment" % filename)
+
+        self.fd.seek(directory_offset)
+        count = COUNT.unpack(self.fd.read(COUNT.size))[0]
+        data = self.fd.read(count * DIRECTORY_ENTRY.size)
+
+        ## Maps (word_id, inode_id) to (offset, hits, size):
+        self.entries = {}
+
+        ## Maps word_id to a list of inode_ids with hits:
+        self.words = {}
+        for i in range(count):
+            word_id, inode_id, offset, hits, size = DIRECTORY_ENTRY.unpack_from(
+                data, i * DIRECTORY_ENTRY.size)
+            self.entries[(word_id, inode_id)] = (offset, hits, size)
+            self.words.setdefault(word_id, []).append(inode_id)
+
+        count = COUNT.unpack(self.fd.read(COUNT.size))[0]
+        covered = array.array('I')
+        covered.fromstring(self.fd.read(count * covered.itemsize))
+        self.covered = set(covered)
+
+    def raw(self, word_id, inode_id):
+        """ Returns the hit count and encoded posting list """
+        try:
+            offset, hits, size = self.entries[(word_id, inode_id)]
+        except KeyError:
+            return 0, ''
+
+        self.lock.acquire()
+        try:
+            self.fd.seek(offset)
+            return hits, self.fd.read(size)
+        finally:
+            self.lock.release()
+
+    def hits(self, word_id, inode_id):
+        return decode_hits(self.raw(word_id, inode_id)[1])
+
+    def close(self):
+        self.fd.close()
+
+class PostingIndex:
+    """ The posting index of a single case """
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ Loads new segments and forgets removed ones """
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.mtime: return
+
+        self.lock.acquire()
+        try:
+            names = [ x for x in os.listdir(self.directory) if x.endswith(".seg") ]
+            names.sort()
+            old = dict([ (os.path.basename(s.filename), s) for s in self.segments ])
+            segments = []
+            for name in names:
+                try:
+                    segments.append(old.pop(name))
+                except KeyError:
+                    try:
+                        segments.append(Segment(os.path.join(self.directory, name)))
+                    except (IOError, OSError), e:
+                        ## It might have been merged away already:
+                        pyflaglog.log(pyflaglog.DEBUG, "Unable to open index segment %s: %s" % (name, e))
+
+            self.segments = segments
+            self.mtime = mtime
+            for s in old.values():
+                s.close()
+        finally:
+            self.lock.release()
+
+    def list_hits(self, inode_id, word_id, start=None, end=None):
+        """ Returns a list of (offset, length) of the word's hits in
+        the inode. Only hits starting between start and end are returned.
+        """
+        self.refresh()
+        inode_id = int(inode_id)
+        for segment in self.segments[::-1]:
+            if inode_id in segment.covered:
+                result = []
+                for offset, length in segment.hits(int(word_id), inode_id):
+                    if start != None and offset < start: continue
+                    if end != None and offset >= end: break
+                    result.append((offset, length))
+
+                return result
+
+        return []
+
+    def inodes(self, word_id):
+        """ Returns a list of all inodes which contain the word """
+        self.refresh()
+        result = set()
+        seen = set()
+        for segment in self.segments[::-1]:
+            for inode_id in segment.words.get(word_id, ()):
+                if inode_id not in seen:
+                    result.add(inode_id)
+
+            seen.update(segment.covered)
+
+        return list(result)
+
+    def size(self):
+        """ The total size of all segments in bytes """
+        self.refresh()
+        return sum([ s.size for s in self.segments ])
+
+    def choose_merge(self):
+        """ Returns the adjacent segments with the smallest total size """
+        factor = max(config.INDEX_MERGE_FACTOR, 2)
+        if len(self.segments) <= factor: return []
+
+        best = None
+        for i in range(len(self.segments) - factor + 1):
+            size = sum([ s.size for s in self.segments[i:i+factor] ])
+            if best is None or size < best[0]:
+                best = (size, i)
+
+        return self.segments[best[1]:best[1] + factor]
+
+    def merge(self):
+        """ Merges segments if there are too many of them.
+
+        Only one process merges a case at a time. Returns True if we
+        merged anything.
+        """
+        self.refresh()
+        try:
+            lock = open(os.path.join(self.directory, "merge.lock"), "w")
+        except IOError:
+            return False
+
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return False
+
+        try:
+            ## Someone else might have merged while we waited:
+            self.mtime = None
+            self.refresh()
+            segments = self.choose_merge()
+            if not segments: return False
+
+            ## Each inode is taken from the newest segment covering it:
+            newest = {}
+            for i in range(len(segments)):
+                for inode_id in segments[i].covered:
+                    newest[inode_id] = i
+
+            ## The merged segment takes the place of the newest one:
+            filename = segments[-1].filename[:-len(".seg")] + "-m.seg"
+            writer = SegmentWriter(filename)
+            for i in range(len(segments)):
+                for word_id, inode_id in segments[i].entries.keys():
+                    if newest.get(inode_id) == i:
+                        count, data = segments[i].raw(word_id, inode_id)
+                        writer.add_encoded(word_id, inode_id, count, data)
+
+            writer.cover(newest.keys())
+            writer.close()
+
+            for s in segments:
+                os.unlink(s.filename)
+
+            pyflaglog.log(pyflaglog.DEBUG, "Merged %s index segments into %s" % (len(segments), filename))
+            return True
+        finally:
+            lock.close()
+
+## The PostingIndex of each case:
+INDEXES = {}
+
+def get_index(case):
+    try:
+        return INDEXES[case]
+    except KeyError:
+        result = INDEXES[case] = PostingIndex(index_directory(case))
+        return result
+
+class PostingWriter:
+    """ Buffers hits for all cases and writes them out as segments.
+
+    Scanners must call start_inode() before adding the hits of an
+    inode - this supersedes hits from earlier indexing of the inode -
+    and end_inode() after adding its last hit. A segment must hold all
+    the hits of the inodes it covers, so flush() only writes finished
+    inodes. Inodes still being indexed stay buffered.
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        ## Number of buffered hits of finished inodes:
+        self.count = 0
+        self.id = 0
+        ## Keyed by case, then by inode_id, then word_id - values are
+        ## lists of hits:
+        self.pending = {}
+        ## The finished inode_ids of each case:
+        self.finished = {}
+        self.merging = {}
+
+    def start_inode(self, case, inode_id):
+        self.mutex.acquire()
+        try:
+            self.pending.setdefault(case, {})[int(inode_id)] = {}
+            self.finished.get(case, set()).discard(int(inode_id))
+        finally:
+            self.mutex.release()
+
+    def add(self, case, inode_id, word_id, offset, length):
+        self.mutex.acquire()
+        try:
+            words = self.pending[case][int(inode_id)]
+            words.setdefault(word_id, []).append((offset, length))
+        finally:
+            self.mutex.release()
+
+    def end_inode(self, case, inode_id):
+        """ Marks the inode as finished so it can be written out """
+        self.mutex.acquire()
+        try:
+            words = self.pending.get(case, {}).get(int(inode_id))
+            if words is None: return
+
+            self.finished.setdefault(case, set()).add(int(inode_id))
+            self.count += sum([ len(hits) for hits in words.values() ])
+        finally:
+            self.mutex.release()
+
+        if self.count >= config.INDEX_SEGMENT_HITS:
+            self.flush()
+
+    def flush(self, case=None):
+        """ Writes a segment of the finished inodes for each case (or
+        only case if specified)
+        """
+        self.mutex.acquire()
+        try:
+            if case:
+                names = [ case ]
+            else:
+                names = self.pending.keys()
+
+            cases = {}
+            for name in names:
+                inodes = self.pending.get(name, {})
+                cases[name] = dict([ (inode_id, inodes.pop(inode_id))
+                                     for inode_id in self.finished.pop(name, ())
+                                     if inode_id in inodes ])
+                if not inodes:
+                    self.pending.pop(name, None)
+
+            self.count = sum([ len(hits) for name, finished in self.finished.items()
+                               for inode_id in finished
+                               for hits in self.pending[name][inode_id].values() ])
+        finally:
+            self.mutex.release()
+
+        for case, inodes in cases.items():
+            if not inodes: continue
+            directory = index_directory(case)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            self.id += 1
+            filename = os.path.join(directory, "%016x-%08x-%04x.seg" % (
+                int(time.time() * 1e6), os.getpid(), self.id % 0x10000))
+
+            writer = SegmentWriter(filename)
+            for inode_id, words in inodes.items():
+                for word_id, hits in words.items():
+                    writer.add(word_id, inode_id, hits)
+
+            writer.cover(inodes.keys())
+            writer.close()
+
+            self.start_merge(case)
+
+    def start_merge(self, case):
+        """ Merges segments in a background thread """
+        thread = self.merging.get(case)
+        if thread and thread.isAlive(): return
+
+        def merge():
+            index = get_index(case)
+            try:
+                while index.merge(): pass
+            except Exception, e:
+                pyflaglog.log(pyflaglog.ERRORS, "Unable to merge index segments: %s" % e)
+
+        thread = threading.Thread(target = merge)
+        thread.setDaemon(True)
+        thread.start()
+        self.merging[case] = thread
+
+WRITER = PostingWriter()
+
+## Unit tests:
+import unittest, tempfile, shutil
+
+class PostingIndexTests(unittest.TestCase):
+    """ Posting list index tests """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_segment(self, name, inodes):
+        writer = SegmentWriter(os.path.join(self.directory, name))
+        for inode_id, words in inodes.items():
+            for word_id, hits in words.items():
+                writer.add(word_id, inode_id, hits)
+
+        writer.cover(inodes.keys())
+        writer.close()
+
+    def test01Encoding(self):
+        """ Test posting list encoding """
+        hits = [ (0, 5), (127, 128), (128, 3), (2**40, 1) ]
+        self.assertEqual(decode_hits(encode_hits(hits)), hits)
+
+    def test02Supersede(self):
+        """ Test that newer segments supersede older ones """
+        self.make_segment("1.seg", { 1: { 5: [(100, 3), (10, 3)] },
+                                     2: { 5: [(7, 3)] } })
+        self.make_segment("2.seg", { 1: { 6: [(1, 2)] } })
+
+        index = PostingIndex(self.directory)
+        ## Inode 1 was indexed again without word 5:
+        self.assertEqual(index.list_hits(1, 5), [])
+        self.assertEqual(index.list_hits(1, 6), [(1, 2)])
+        self.assertEqual(index.list_hits(2, 5), [(7, 3)])
+        self.assertEqual(index.list_hits(2, 5, start=8), [])
+        self.assertEqual(index.inodes(5), [2])
+
+    def test03Merge(self):
+        """ Test merging segments """
+        factor = config.INDEX_MERGE_FACTOR
+        config.INDEX_MERGE_FACTOR = 2
+        self.make_segment("1.seg", { 1: { 5: [(10, 3), (100, 3)] },
+                                     2: { 5: [(7, 3)] } })
+        self.make_segment("2.seg", { 1: { 6: [(1, 2)] } })
+        self.make_segment("3.seg", { 3: { 5: [(1, 4)] } })
+
+        index = PostingIndex(self.directory)
+        before = [ index.list_hits(i, w) for i in (1,2,3) for w in (5,6) ]
+        try:
+            while index.merge(): pass
+        finally:
+            config.INDEX_MERGE_FACTOR = factor
+
+        ## The two smallest segments were merged:
+        self.assertEqual(len([ x for x in os.listdir(self.directory) if x.endswith(".seg") ]), 2)
+        after = [ index.list_hits(i, w) for i in (1,2,3) for w in (5,6) ]
+        self.assertEqual(before, after)
+
+    def test04Writer(self):
+        """ Test that flushing keeps the hits of unfinished inodes """
+        resultdir, segment_hits = config.RESULTDIR, config.INDEX_SEGMENT_HITS
+        config.RESULTDIR = self.directory
+        config.INDEX_SEGMENT_HITS = 3
+        try:
+            directory = index_directory("test")
+            writer = PostingWriter()
+            writer.start_inode("test", 1)
+            writer.start_inode("test", 2)
+            writer.add("test", 2, 5, 0, 3)
+            for i in range(5):
+                writer.add("test", 1, 5, i * 10, 3)
+                ## Flushing part way through (e.g. from another thread):
+                if i == 1:
+                    writer.flush("test")
+
+            writer.end_inode("test", 1)
+            writer.flush()
+            for thread in writer.merging.values():
+                thread.join()
+        finally:
+            config.RESULTDIR, config.INDEX_SEGMENT_HITS = resultdir, segment_hits
+
+        index = PostingIndex(directory)
+        self.assertEqual(index.list_hits(1, 5), [ (i * 10, 3) for i in range(5) ])
+
+        ## Inode 2 is not finished yet:
+        self.assertEqual(index.list_hits(2, 5), [])
+        self.assertEqual(writer.pending["test"].keys(), [2])
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A compressed radix tree for longest prefix matching of IPv4 networks.
+
+Each node holds a network prefix (key and length), an optional value
+and two children for the next bit after the prefix. Nodes with a
+single child are not stored (the child's prefix may skip several
+bits), so a lookup visits at most one node per distinct prefix length
+on the path to the address.
+
+The nodes are stored in parallel arrays, which may be saved to a file.
+Saved trees are memory mapped copy on write, so loading is instant and
+all processes which open the same file share its pages.
+
+File format (in machine byte order):
+
+  header: 'PFRT', number of nodes
+  keys (uint32), values (int32), left children (int32),
+  right children (int32), prefix lengths (uint8)
+"""
+import os, mmap, struct, array, ctypes, tempfile
+
+MAGIC = "PFRT"
+HEADER = struct.Struct("=4sI")
+
+## Used for missing values and children:
+NONE = -1
+
+## The netmask for each prefix length:
+MASKS = [ int((0xFFFFFFFFL << (32 - i)) & 0xFFFFFFFFL) for i in range(33) ]
+LENGTHS = dict([ (m, i) for i, m in enumerate(MASKS) ])
+
+def prefix_length(netmask):
+    """ Returns the prefix length of netmask or None if its bits are
+    not contiguous.
+    """
+    return LENGTHS.get(netmask)
+
+class RadixTree:
+    """ Maps IPv4 addresses to the value of their longest matching prefix """
+    mtime = None
+    filename = None
+
+    def __init__(self, filename=None):
+        if filename:
+            self.load(filename)
+            return
+
+        ## The root is the 0.0.0.0/0 prefix:
+        self.key = array.array('I', [0])
+        self.value = array.array('i', [NONE])
+        self.left = array.array('i', [NONE])
+        self.right = array.array('i', [NONE])
+        self.length = array.array('B', [0])
+
+    def __len__(self):
+        return len(self.key)
+
+    def _new(self, key, length, value=NONE):
+        self.key.append(key)
+        self.value.append(value)
+        self.left.append(NONE)
+        self.right.append(NONE)
+        self.length.append(length)
+
+        return len(self.key) - 1
+
+    def _set_child(self, node, key, child):
+        """ Makes child the child of node on the side of key """
+        if (key >> (31 - self.length[node])) & 1:
+            self.right[node] = child
+        else:
+            self.left[node] = child
+
+    def add(self, network, length, value):
+        """ Adds the network prefix of the given length.
+
+        If the prefix is already present the first value added is
+        kept.
+        """
+        network = network & MASKS[length]
+        node = 0
+        while 1:
+            if self.length[node] == length:
+                if self.value[node] == NONE:
+                    self.value[node] = value
+                return
+
+            if (network >> (31 - self.length[node])) & 1:
+                child = self.right[node]
+            else:
+                child = self.left[node]
+
+            if child == NONE:
+                self._set_child(node, network, self._new(network, length, value))
+                return
+
+            ## How many leading bits do we share with the child?
+            child_length = self.length[child]
+            common = min(child_length, length,
+                         32 - (self.key[child] ^ network).bit_length())
+            if common == child_length:
+                node = child
+                continue
+
+            ## We need a new node where we branch off from the child:
+            middle = self._new(network & MASKS[common], common)
+            self._set_child(node, network, middle)
+            self._set_child(middle, self.key[child], child)
+            if common == length:
+                self.value[middle] = value
+            else:
+                self._set_child(middle, network, self._new(network, length, value))
+
+            return
+
+    def lookup(self, ip):
+        """ Returns the value of the longest prefix containing ip, or
+        None if there is none.
+        """
+        key = self.key
+        length = self.length
+        value = self.value
+        left = self.left
+        right = self.right
+        result = NONE
+        node = 0
+        while node != NONE:
+            l = length[node]
+            if (ip ^ key[node]) & MASKS[l]:
+                break
+
+            if value[node] != NONE:
+                result = value[node]
+
+            if l == 32:
+                break
+
+            if (ip >> (31 - l)) & 1:
+                node = right[node]
+            else:
+                node = left[node]
+
+        if result == NONE:
+            return None
+
+        return result
+
+    def save(self, filename):
+        """ Writes the tree to filename (atomically replacing it) """
+        ## Other processes may be saving the same tree, so we each
+        ## write our own temporary file:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+        try:
+            fd = os.fdopen(fd, "wb")
+            try:
+                fd.write(HEADER.pack(MAGIC, len(self.key)))
+                for a in (self.key, self.value, self.left, self.right, self.length):
+                    array.array(a.typecode, a).tofile(fd)
+            finally:
+                fd.close()
+
+            os.rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def load(self, filename):
+        self.filename = filename
+        fd = open(filename, "rb")
+        try:
+            self.mtime = os.fstat(fd.fileno()).st_mtime
+            magic, count = HEADER.unpack(fd.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError("%s is not a radix tree file" % filename)
+
+            ## A private map is writable (so ctypes can use it) but its
+            ## pages are shared until they are written to (which we
+            ## never do):
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_COPY)
+        finally:
+            fd.close()
+
+        offset = HEADER.size
+        for name, ctype in (("key", ctypes.c_uint32), ("value", ctypes.c_int32),
+                            ("left", ctypes.c_int32), ("right", ctypes.c_int32),
+                            ("length", ctypes.c_uint8)):
+            setattr(self, name, (ctype * count).from_buffer(self.map, offset))
+            offset += ctypes.sizeof(ctype) * count
+
+    def close(self):
+        self.key = self.value = self.left = self.right = self.length = None
+        try:
+            self.map.close()
+        except AttributeError:
+            pass
+
+## Unit tests:
+import unittest, random
+
+class RadixTreeTests(unittest.TestCase):
+    """ Radix tree tests """
+    def brute_force(self, prefixes, ip):
+        """ The value of the longest prefix (the first one added if
+        there are duplicates)
+        """
+        for length in range(32, -1, -1):
+            for network, l, value in prefixes:
+                if l == length and (ip & MASKS[l]) == (network & MASKS[l]):
+                    return value
+
+    def test01Lookup(self):
+        """ Test longest prefix matches against a brute force search """
+        random.seed(1)
+        prefixes = []
+        for i in range(500):
+            length = random.choice([0, 8, 12, 16, 16, 20, 24, 24, 24, 28, 32])
+            network = random.choice([0x0A000000, 0xC0A80000, 0xCA3A3800]) | \
+                      random.randint(0, (1 << 24) - 1)
+            prefixes.append((network & MASKS[length], length, i))
+
+        ## Some duplicates:
+        prefixes.extend([ (n, l, v + 1000) for n, l, v in prefixes[:20] ])
+
+        tree = RadixTree()
+        for network, length, value in prefixes:
+            tree.add(network, length, value)
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            tree.save(filename)
+            saved = RadixTree(filename)
+
+            ips = [ network | random.randint(0, 255) for network, l, v in prefixes ] + \
+                  [ random.randint(0, 0xFFFFFFFF) for i in range(500) ]
+            for ip in ips:
+                expected = self.brute_force(prefixes, ip)
+                self.assertEqual(tree.lookup(ip), expected)
+                self.assertEqual(saved.lookup(ip), expected)
+
+            saved.close()
+        finally:
+            os.unlink(filename)
+
+    def test02NoDefault(self):
+        """ Test addresses without any matching prefix """
+        tree = RadixTree()
+        tree.add(0xC0A80000, 16, 1)
+        self.assertEqual(tree.lookup(0xC0A80101), 1)
+        self.assertEqual(tree.lookup(0x0A000001), None)
+        self.assertEqual(prefix_length(0xFFFFFF00), 24)
+        self.assertEqual(prefix_length(0xFF00FF00), None)
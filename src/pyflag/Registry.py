@@ -34,7 +34,7 @@ classes in the same plugin and have them all automatically loaded.
 import pyflag.conf
 config=pyflag.conf.ConfObject()
 
-import os,sys,imp
+import os,sys,imp,inspect,threading,cPickle,tempfile
 import pyflag.pyflaglog as pyflaglog
 
 ## Define the parameters we need. The default plugins directory is
@@ -43,6 +43,225 @@ import pyflag.pyflaglog as pyflaglog
 config.add_option("PLUGINS", default=os.path.dirname(__file__) + "/plugins",
                   help="Plugin directories to use")
 
+config.add_option("REGISTRY_MANIFEST", default=None,
+                  help="File to keep the plugin manifest in (default is registry.manifest in the RESULTDIR)")
+
+config.add_option("REGISTRY_LAZY", default=True, action="store_false",
+                  help="Only import plugins when their registry is first used")
+
+## Plugins are scanned into a manifest which records for each plugin
+## file its modification time, the classes it provides (with the
+## names of all their base classes) and the configuration options it
+## adds. Registries then only import the plugins which provide their
+## classes. The manifest is saved so later runs do not need to import
+## plugins just to find out what they contain. Plugins are scanned
+## again when they change.
+##
+## Plugins which change other modules when they are imported should
+## set eager = True so they are always imported by Init().
+
+## Bump this when the manifest format changes:
+MANIFEST_VERSION = 1
+
+## The manifest as a list of (path, entry) in the order plugins were
+## found:
+MANIFEST = None
+
+## Loaded plugin modules keyed by path:
+LOADED = {}
+
+## The plugins being imported right now:
+LOADING = set()
+
+## Held while scanning plugins and building registries:
+REGISTRY_LOCK = threading.RLock()
+
+def qualified_name(cls):
+    return "%s.%s" % (cls.__module__, cls.__name__)
+
+def plugin_files():
+    """ Returns the paths of all plugin files in the order we find them """
+    result = []
+    excluded_dirs = []
+    for path in config.PLUGINS.split(':'):
+        for dirpath, dirnames, filenames in os.walk(path):
+            if dirpath not in sys.path:
+                sys.path.append(dirpath)
+
+            excluded = False
+            for x in excluded_dirs:
+                if dirpath.startswith(x):
+                    excluded = True
+                    break
+
+            if excluded: continue
+
+            for filename in filenames:
+                if filename.lower().startswith("__dont_descend__"):
+                    for d in dirnames:
+                        excluded_path = os.path.join(dirpath, d)
+                        if excluded_path not in excluded_dirs:
+                            excluded_dirs.append(excluded_path)
+
+                if filename.endswith(".py"):
+                    result.append(dirpath+'/'+filename)
+
+    return result
+
+def load_plugin(path):
+    """ Imports the plugin at path. Returns None if we can not. """
+    try:
+        return LOADED[path]
+    except KeyError:
+        pass
+
+    ## Plugins which use registries while they are imported can not
+    ## be part of them:
+    if path in LOADING: return None
+
+    ## Lose the extension for the module name
+    module_name = os.path.basename(path)[:-3]
+    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Will attempt to load plugin '%s'" % path)
+    try:
+        #open the plugin file
+        fd = open(path ,"r")
+    except Exception,e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to open plugin file '%s': %s"
+                    % (path,e))
+        return None
+
+    #load the module into our namespace
+    LOADING.add(path)
+    try:
+        try:
+            module = imp.load_source(module_name,path,fd)
+        except Exception,e:
+            pyflaglog.log(pyflaglog.ERRORS, "*** Unable to load module %s: %s"
+                        % (module_name,e))
+            return None
+    finally:
+        LOADING.discard(path)
+        fd.close()
+
+    LOADED[path] = module
+    return module
+
+def scan_plugin(path, mtime):
+    """ Imports the plugin at path and returns its manifest entry (or
+    None if it can not be imported).
+    """
+    ## Remember the options the plugin adds:
+    options = []
+    add_option = pyflag.conf.ConfObject.add_option
+    def record_option(self, option, short_option=None, **args):
+        options.append((option, short_option, args.copy()))
+        return add_option(self, option, short_option, **args)
+
+    pyflag.conf.ConfObject.add_option = record_option
+    try:
+        module = load_plugin(path)
+    finally:
+        pyflag.conf.ConfObject.add_option = add_option
+
+    if not module: return None
+
+    entry = dict(mtime = mtime, options = options, classes = [],
+                 active = True, eager = getattr(module, 'eager', False),
+                 description = getattr(module, 'description', module.__name__))
+
+    #Is this module active?
+    if getattr(module, 'hidden', False):
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module Hidden"% (module.__name__))
+        entry['active'] = False
+
+    if not getattr(module, 'active', True):
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module not active" % (module.__name__))
+        entry['active'] = False
+
+    for name in dir(module):
+        Class = module.__dict__.get(name)
+        try:
+            bases = [ qualified_name(c) for c in inspect.getmro(Class) ]
+        except (AttributeError, TypeError):
+            ## Not a class
+            continue
+
+        entry['classes'].append((name, bases))
+
+    return entry
+
+def manifest_filename():
+    return config.REGISTRY_MANIFEST or os.path.join(config.RESULTDIR, "registry.manifest")
+
+def get_manifest():
+    """ Returns the manifest, scanning the plugins which changed since
+    it was saved.
+    """
+    global MANIFEST
+
+    REGISTRY_LOCK.acquire()
+    try:
+        if MANIFEST is not None: return MANIFEST
+
+        filename = manifest_filename()
+        try:
+            fd = open(filename, 'rb')
+            try:
+                version, plugins, saved = cPickle.load(fd)
+            finally:
+                fd.close()
+
+            if version != MANIFEST_VERSION or plugins != config.PLUGINS:
+                saved = {}
+        except Exception,e:
+            saved = {}
+
+        MANIFEST = []
+        changed = False
+        for path in plugin_files():
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            entry = saved.pop(path, None)
+            if not entry or entry['mtime'] != mtime:
+                entry = scan_plugin(path, mtime)
+                changed = True
+
+            ## Plugins which can not be imported are tried again next
+            ## time:
+            if entry:
+                MANIFEST.append((path, entry))
+
+        if changed or saved:
+            save_manifest(filename)
+
+        return MANIFEST
+    finally:
+        REGISTRY_LOCK.release()
+
+def save_manifest(filename):
+    try:
+        ## Other processes may be saving the manifest at the same time,
+        ## so we each write our own temporary file:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    except (IOError, OSError), e:
+        pyflaglog.log(pyflaglog.WARNINGS, "Unable to save plugin manifest %s: %s" % (filename, e))
+        return
+
+    try:
+        fd = os.fdopen(fd, "wb")
+        try:
+            cPickle.dump((MANIFEST_VERSION, config.PLUGINS, dict(MANIFEST)), fd, -1)
+        finally:
+            fd.close()
+
+        os.rename(tmp, filename)
+    except (IOError, OSError), e:
+        os.unlink(tmp)
+        pyflaglog.log(pyflaglog.WARNINGS, "Unable to save plugin manifest %s: %s" % (filename, e))
+
 class Registry:
     """ Main class to register classes derived from a given parent class. """
     modules = []
@@ -51,128 +270,47 @@ class Registry:
     classes = []
     order = []
     filenames = {}
-    ## These are the modules which have been disabled
-    loaded_modules = []
-
-    ## Excluded dirs are not descended into
-    excluded_dirs = []
     
     def __init__(self,ParentClass):
-        """ Search the plugins directory for all classes extending ParentClass.
+        """ Find all the plugin classes extending ParentClass.
         
         These will be considered as implementations and added to our internal registry.
         """
         ## Create instance variables
         self.classes = []
         self.order = []
-        
-        ## Recurse over all the plugin directories recursively
-        for path in config.PLUGINS.split(':'):
-            for dirpath, dirnames, filenames in os.walk(path):
-                sys.path.append(dirpath)
-                excluded = False
-                for x in self.excluded_dirs:
-                    if dirpath.startswith(x):
-                        excluded = True
-                        break
-
-                if excluded: continue
-                
-                for filename in filenames:
-                    #Lose the extension for the module name
-                    module_name = filename[:-3]
-                    if filename.lower().startswith("__dont_descend__"):
-                        for d in dirnames:
-                            excluded_path = os.path.join(dirpath, d)
-                            if excluded_path not in self.excluded_dirs:
-                                self.excluded_dirs.append(excluded_path)
-
-                    if filename.endswith(".py"):
-                        path = dirpath+'/'+filename
-                        try:
-                            if path not in self.loaded_modules:
-                                self.loaded_modules.append(path)
-                                
-                                pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Will attempt to load plugin '%s/%s'"
-                                            % (dirpath,filename))
-                                try:
-                                    #open the plugin file
-                                    fd = open(path ,"r")
-                                except Exception,e:
-                                    pyflaglog.log(pyflaglog.DEBUG, "Unable to open plugin file '%s': %s"
-                                                % (filename,e))
-                                    continue
-
-                                #load the module into our namespace
-                                try:
-                                    module = imp.load_source(module_name,dirpath+'/'+filename,fd)
-                                except Exception,e:
-                                    pyflaglog.log(pyflaglog.ERRORS, "*** Unable to load module %s: %s"
-                                                % (module_name,e))
-                                    continue
-
-                                fd.close()
-
-                                #Is this module active?
-                                try:
-                                    if module.hidden:
-                                        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module Hidden"% (module_name))
-                                        continue
-                                except AttributeError:
-                                    pass
-                                
-                                try:
-                                    if not module.active:
-                                        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "*** Will not load Module %s: Module not active" % (module_name))
-                                        continue
-                                except AttributeError:
-                                    pass
-                                
-                                #find the module description
-                                try:
-                                    module_desc = module.description
-                                except AttributeError:
-                                    module_desc = module_name
-
-                                ## Store information about this module here.
-                                self.modules.append(module)
-                                self.module_desc.append(module_desc)
-                                self.module_paths.append(path)
-                                
-                            else:
-                                try:
-                                    ## We already have the module in the cache:
-                                    module = self.modules[self.module_paths.index(path)]
-                                    module_desc = self.module_desc[self.module_paths.index(path)]
-                                except (ValueError, IndexError),e:
-                                    ## If not the module has been loaded, but disabled
-                                    continue
-
-                            #Now we enumerate all the classes in the
-                            #module to see which one is a ParentClass:
-                            for cls in dir(module):
-                                try:
-                                    Class = module.__dict__[cls]
-                                    if issubclass(Class,ParentClass) and Class!=ParentClass:
-                                        ## Check the class for consitancy
-                                        try:
-                                            self.check_class(Class)
-                                        except AttributeError,e:
-                                            err = "Failed to load %s '%s': %s" % (ParentClass,cls,e)
-                                            pyflaglog.log(pyflaglog.WARNINGS, err)
-                                            continue
-
-                                        ## Add the class to ourselves:
-                                        self.add_class(ParentClass, module_desc, cls, Class, filename)
-                                            
-                                # Oops: it isnt a class...
-                                except (TypeError, NameError) , e:
-                                    continue
-
-                        except TypeError, e:
-                            pyflaglog.log(pyflaglog.ERRORS, "Could not compile module %s: %s"
-                                        % (module_name,e))
-                            continue
+
+        parent = qualified_name(ParentClass)
+        for path, entry in get_manifest():
+            if not entry['active']: continue
+
+            names = [ name for name, bases in entry['classes'] if parent in bases[1:] ]
+            if not names: continue
+
+            module = load_plugin(path)
+            if not module: continue
+
+            ## Store information about this module here.
+            if path not in self.module_paths:
+                self.modules.append(module)
+                self.module_desc.append(entry['description'])
+                self.module_paths.append(path)
+
+            #Now we add all the classes in the module which are
+            #ParentClasses:
+            for cls in names:
+                Class = module.__dict__[cls]
+                ## Check the class for consitancy
+                try:
+                    self.check_class(Class)
+                except AttributeError,e:
+                    err = "Failed to load %s '%s': %s" % (ParentClass,cls,e)
+                    pyflaglog.log(pyflaglog.WARNINGS, err)
+                    continue
+
+                ## Add the class to ourselves:
+                self.add_class(ParentClass, entry['description'], cls, Class,
+                               os.path.basename(path))
 
     def add_class(self, ParentClass, module_desc, cls, Class, filename):
         """ Adds the class provided to our self. This is here to be
@@ -208,11 +346,13 @@ class Registry:
         @note: If there are several modules of the same name (which should be avoided)  the last one encountered during registring should persist. This may lead to indereminate behaviour.
         """
         if not load_as: load_as=name
-        
-        for module in self.modules:
-            if name==module.__name__:
-                sys.modules[load_as] = module
-                return
+
+        for path, entry in reversed(get_manifest()):
+            if os.path.basename(path) == name + ".py" and entry['active']:
+                module = load_plugin(path)
+                if module:
+                    sys.modules[load_as] = module
+                    return
 
         raise ImportError("No module by name %s" % name)
 
@@ -410,6 +550,36 @@ class FileFormatRegistry(Registry):
             ## The name of the class is the command name
             self.formats[("%s" % cls).split('.')[-1]] = cls
 
+class LazyRegistry:
+    """ Creates the registry (importing its plugins) when it is first used """
+    def __init__(self, registry_class, ParentClass):
+        self.__dict__['_args'] = (registry_class, ParentClass)
+        self.__dict__['_registry'] = None
+
+    def get_registry(self):
+        registry = self.__dict__['_registry']
+        if registry is None:
+            REGISTRY_LOCK.acquire()
+            try:
+                registry = self.__dict__['_registry']
+                if registry is None:
+                    registry_class, ParentClass = self.__dict__['_args']
+                    registry = registry_class(ParentClass)
+                    self.__dict__['_registry'] = registry
+            finally:
+                REGISTRY_LOCK.release()
+
+        return registry
+
+    def __getattr__(self, attr):
+        return getattr(self.get_registry(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.get_registry(), attr, value)
+
+    def __getitem__(self, item):
+        return self.get_registry()[item]
+
 import unittest
 class TestsRegistry(ScannerRegistry):
     pass
@@ -511,110 +681,131 @@ def Init():
     if LOCK:
         return
     LOCK=1
+
     ## Do the reports here
     import pyflag.Reports as Reports
     global REPORTS
     
-    REPORTS=ReportRegistry(Reports.report)
+    REPORTS = LazyRegistry(ReportRegistry, Reports.report)
 
     ## Collect all themes
     import pyflag.Theme as Theme
     global THEMES
-    THEMES = ThemeRegistry(Theme.BasicTheme)
+    THEMES = LazyRegistry(ThemeRegistry, Theme.BasicTheme)
 
     ## Now do the scanners
     import pyflag.Scanner as Scanner
     global SCANNERS
-    SCANNERS = ScannerRegistry(Scanner.GenScanFactory)
+    SCANNERS = LazyRegistry(ScannerRegistry, Scanner.GenScanFactory)
 
     ## Pick up all VFS drivers:
     import pyflag.FileSystem as FileSystem
     global VFS_FILES
-    VFS_FILES = VFSFileRegistry(FileSystem.File)
+    VFS_FILES = LazyRegistry(VFSFileRegistry, FileSystem.File)
     
     ## Pick all Log File drivers:
     import pyflag.LogFile as LogFile
     global LOG_DRIVERS
-    LOG_DRIVERS = OrderedRegistry(LogFile.Log)
+    LOG_DRIVERS = LazyRegistry(OrderedRegistry, LogFile.Log)
     
     ## Register all shell commands:
     import pyflag.pyflagsh as pyflagsh
     global SHELL_COMMANDS
-    SHELL_COMMANDS = ShellRegistry(pyflagsh.command)
+    SHELL_COMMANDS = LazyRegistry(ShellRegistry, pyflagsh.command)
 
     ## Register Filesystem drivers
     import pyflag.FileSystem as FileSystem
     global FILESYSTEMS
-    FILESYSTEMS = OrderedRegistry(FileSystem.DBFS)
+    FILESYSTEMS = LazyRegistry(OrderedRegistry, FileSystem.DBFS)
 
     ## Register FileFormat drivers
     import pyflag.format as format
     global FILEFORMATS
-    FILEFORMATS = FileFormatRegistry(format.DataType)
+    FILEFORMATS = LazyRegistry(FileFormatRegistry, format.DataType)
 
     ## Register Column Types:
     import pyflag.ColumnTypes as ColumnTypes
     global COLUMN_TYPES
-    COLUMN_TYPES = ColumnTypeRegistry(ColumnTypes.ColumnType)
+    COLUMN_TYPES = LazyRegistry(ColumnTypeRegistry, ColumnTypes.ColumnType)
 
     ## Register worker tasks
     import pyflag.Farm as Farm
     global TASKS
-    TASKS = OrderedRegistry(Farm.Task)
+    TASKS = LazyRegistry(OrderedRegistry, Farm.Task)
 
     ## Register carvers:
     global CARVERS
-    CARVERS = OrderedRegistry(Scanner.Carver)
+    CARVERS = LazyRegistry(OrderedRegistry, Scanner.Carver)
 
     ## Register SQL handlers
     import pyflag.FlagFramework as FlagFramework
     global EVENT_HANDLERS
-    EVENT_HANDLERS = OrderedRegistry(FlagFramework.EventHandler)
+    EVENT_HANDLERS = LazyRegistry(OrderedRegistry, FlagFramework.EventHandler)
 
     ## Register IO Images:
     import pyflag.IO as IO
     global IMAGES
-    IMAGES = OrderedRegistry(IO.Image)
+    IMAGES = LazyRegistry(OrderedRegistry, IO.Image)
 
     global FILE_HANDLERS
-    FILE_HANDLERS = FileHandlerRegistry(IO.FileHandler)
+    FILE_HANDLERS = LazyRegistry(FileHandlerRegistry, IO.FileHandler)
 
     ## Register packet handlers:
     import pyflag.Packets as Packets
     global PACKET_HANDLERS
-    PACKET_HANDLERS = OrderedRegistry(Packets.PacketHandler)
+    PACKET_HANDLERS = LazyRegistry(OrderedRegistry, Packets.PacketHandler)
 
     ## Register stats viewers:
     import pyflag.Stats as Stats
     global STATS_HANDLERS
-    STATS_HANDLERS = OrderedRegistry(Stats.Handler)
+    STATS_HANDLERS = LazyRegistry(OrderedRegistry, Stats.Handler)
 
     ## Register Case Tables for dynamic schema
     global CASE_TABLES
-    CASE_TABLES = OrderedRegistry(FlagFramework.CaseTable)
+    CASE_TABLES = LazyRegistry(OrderedRegistry, FlagFramework.CaseTable)
 
     global MAGIC_HANDLERS
     import pyflag.Magic as Magic
 
-    MAGIC_HANDLERS = OrderedRegistry(Magic.Magic)
+    MAGIC_HANDLERS = LazyRegistry(OrderedRegistry, Magic.Magic)
 
     global TABLE_RENDERERS
     import pyflag.UI as UI
 
-    TABLE_RENDERERS = OrderedRegistry(UI.TableRendererBaseClass)
+    TABLE_RENDERERS = LazyRegistry(OrderedRegistry, UI.TableRendererBaseClass)
 
     global ACTIONS
-    ACTIONS = OrderedRegistry(Action)
+    ACTIONS = LazyRegistry(OrderedRegistry, Action)
 
     global PRECANNED
-    PRECANNED = OrderedRegistry(PreCanned)
+    PRECANNED = LazyRegistry(OrderedRegistry, PreCanned)
 
     global FSLOADERS
-    FSLOADERS = OrderedRegistry(FileSystemLoader)
+    FSLOADERS = LazyRegistry(OrderedRegistry, FileSystemLoader)
 
     global GRAPHERS
     import pyflag.Graph as Graph
-    GRAPHERS = OrderedRegistry(Graph.GenericGraph)
+    GRAPHERS = LazyRegistry(OrderedRegistry, Graph.GenericGraph)
+
+    ## Plugins add their options when they are imported, so we add
+    ## the options of plugins we have not imported:
+    manifest = get_manifest()
+    for path, entry in manifest:
+        for option, short_option, args in entry['options']:
+            config.add_option(option, short_option, **args)
+
+    for path, entry in manifest:
+        if entry['eager'] and entry['active']:
+            load_plugin(path)
+
+    if not config.REGISTRY_LAZY:
+        for registry in (REPORTS, THEMES, SCANNERS, VFS_FILES, LOG_DRIVERS,
+                         SHELL_COMMANDS, FILESYSTEMS, FILEFORMATS, COLUMN_TYPES,
+                         TASKS, CARVERS, EVENT_HANDLERS, IMAGES, FILE_HANDLERS,
+                         PACKET_HANDLERS, STATS_HANDLERS, CASE_TABLES,
+                         MAGIC_HANDLERS, TABLE_RENDERERS, ACTIONS, PRECANNED,
+                         FSLOADERS, GRAPHERS):
+            registry.get_registry()
 
 def InitTests():
     return TestsRegistry(unittest.TestCase)
@@ -623,3 +814,73 @@ def import_module(name,load_as=None):
     Init()
     REPORTS.import_module(name,load_as)
 
+
+import tempfile, shutil, time
+
+class RegistryTests(unittest.TestCase):
+    """ Plugin manifest tests """
+    plugin = """
+import %s
+imported = True
+class Plugin%s(%s.Base): pass
+"""
+    def setUp(self):
+        global MANIFEST, LOADED
+        self.saved = (MANIFEST, LOADED, config.PLUGINS, config.REGISTRY_MANIFEST)
+        self.directory = tempfile.mkdtemp()
+        self.base = "registry_test_%s" % os.getpid()
+        fd = open(os.path.join(self.directory, self.base + ".py"), "w")
+        fd.write("class Base: pass\n")
+        fd.close()
+        sys.path.append(self.directory)
+
+        os.mkdir(os.path.join(self.directory, "plugins"))
+        for name in "ab":
+            self.write_plugin(name)
+
+        config.PLUGINS = os.path.join(self.directory, "plugins")
+        config.REGISTRY_MANIFEST = os.path.join(self.directory, "manifest")
+        MANIFEST = None
+        LOADED = {}
+
+    def write_plugin(self, name, mtime=None):
+        filename = os.path.join(self.directory, "plugins", "%s_%s.py" % (self.base, name))
+        fd = open(filename, "w")
+        fd.write(self.plugin % (self.base, name, self.base))
+        fd.close()
+        if mtime:
+            os.utime(filename, (mtime, mtime))
+
+    def tearDown(self):
+        global MANIFEST, LOADED
+        MANIFEST, LOADED, config.PLUGINS, config.REGISTRY_MANIFEST = self.saved
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory)
+
+    def restart(self):
+        """ Forget everything but the saved manifest """
+        global MANIFEST, LOADED
+        MANIFEST = None
+        LOADED = {}
+
+    def test01Manifest(self):
+        """ Test the manifest is reused and rescanned when plugins change """
+        base = __import__(self.base)
+        registry = LazyRegistry(Registry, base.Base)
+        self.assertEqual(len(registry.classes), 2)
+
+        ## Only plugins with classes we need are imported:
+        self.restart()
+        self.assertEqual(len(get_manifest()), 2)
+        self.assertEqual(LOADED, {})
+        registry = LazyRegistry(Registry, base.Base)
+        self.assertEqual(len(registry.classes), 2)
+        self.assertEqual(len(LOADED), 2)
+
+        ## Changed plugins are scanned again:
+        self.restart()
+        self.write_plugin("b", time.time() + 10)
+        self.write_plugin("c")
+        get_manifest()
+        self.assertEqual(len(LOADED), 2)
+        self.assert_(os.path.join(config.PLUGINS, "%s_a.py" % self.base) not in LOADED)
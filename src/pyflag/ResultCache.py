@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A cache for the results of table queries.
+
+The table widget pages through the results of potentially slow
+queries. DBO.cached_execute() keeps a window of rows around each page
+in this cache so that paging does not need to run the query again.
+
+Cache keys are made from the normalised query and the generation
+counters of all the tables it reads from. Writing to a table through
+the DBO helpers bumps its generation (see DBO.invalidate()), so stale
+results are never found again - they simply age out of the cache. This
+means that invalidation never needs to drop tables or lock the cache.
+
+Results are kept in memory, and are spilled to files on disk when the
+memory cache is full. Both tiers are bounded in size and evict the
+least recently used results first. Each process spills into its own
+directory under RESULTDIR/result_cache, which is removed when the
+process exits (directories left behind by processes which died are
+removed by the next process to use the disk cache).
+
+The active cache is returned by get_cache(). Any object with the
+get(), put() and flush() methods of ResultCache may be installed in
+the module variable CACHE instead.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Store as Store
+import pyflag.pyflaglog as pyflaglog
+import cPickle, os, re, time, atexit, shutil, errno
+from hashlib import md5
+
+config.add_option("RESULT_CACHE_MEMORY", default=32*1024*1024, type='int',
+                  help="Maximum number of bytes of table query results cached in memory")
+
+config.add_option("RESULT_CACHE_DISK", default=256*1024*1024, type='int',
+                  help="Maximum number of bytes of table query results cached on disk (0 disables the disk cache)")
+
+class ResultCache:
+    """ The interface of result caches.
+
+    Results are lists of rows. Caches must return copies of the rows
+    since callers are free to modify them.
+    """
+    def get(self, key):
+        """ Returns the result stored under key or raises KeyError """
+        raise KeyError(key)
+
+    def put(self, key, rows):
+        """ Stores the rows under key """
+
+    def flush(self):
+        """ Removes all results """
+
+class SpillStore(Store.Store):
+    """ A Store which hands objects evicted to make room to a callback """
+    def __init__(self, spill=None, **kwargs):
+        Store.Store.__init__(self, **kwargs)
+        self.spill = spill
+
+    def _evict(self, node, reason):
+        Store.Store._evict(self, node, reason)
+        if self.spill and node[Store.TIME] + self.max_age > time.time():
+            self.spill(node[Store.KEY], node[Store.OBJ])
+
+class FileStore(Store.Store):
+    """ A Store of file names. Files are removed when they leave the store. """
+    def _evict(self, node, reason):
+        Store.Store._evict(self, node, reason)
+        try:
+            os.unlink(node[Store.OBJ])
+        except OSError:
+            pass
+
+    def _reset(self):
+        try:
+            for node in self._nodes():
+                os.unlink(node[Store.OBJ])
+        except (AttributeError, OSError):
+            pass
+
+        Store.Store._reset(self)
+
+class MemoryCache(ResultCache):
+    """ Keeps pickled results in memory """
+    def __init__(self, max_bytes, age, spill=None):
+        self.store = SpillStore(spill=spill, max_size=1e9, age=age,
+                                max_bytes=max_bytes)
+
+    def get(self, key):
+        return cPickle.loads(self.store.get(key))
+
+    def put(self, key, rows):
+        self.put_data(key, cPickle.dumps(rows, 2))
+
+    def put_data(self, key, data):
+        self.store.put(data, key=key)
+
+    def flush(self):
+        self.store.flush()
+
+def remove_stale_directories(base):
+    """ Removes the cache directories of processes which no longer run """
+    try:
+        pids = os.listdir(base)
+    except OSError:
+        return
+
+    for pid in pids:
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ValueError:
+            continue
+        except OSError, e:
+            ## The process exists but is not ours:
+            if e.errno == errno.EPERM: continue
+
+        shutil.rmtree(os.path.join(base, pid), True)
+
+class DiskCache(ResultCache):
+    """ Keeps pickled results in files """
+    def __init__(self, max_bytes, age, directory=None):
+        self.directory = directory
+        self.store = FileStore(max_size=1e9, age=age, max_bytes=max_bytes,
+                               sizeof = os.path.getsize)
+
+    def get_directory(self):
+        if not self.directory:
+            base = os.path.join(config.RESULTDIR, "result_cache")
+            remove_stale_directories(base)
+            self.directory = os.path.join(base, str(os.getpid()))
+            atexit.register(self.remove_directory, os.getpid())
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        return self.directory
+
+    def remove_directory(self, pid):
+        ## Forked children inherit our exit handlers:
+        if pid == os.getpid():
+            shutil.rmtree(self.directory, True)
+
+    def get(self, key):
+        fd = open(self.store.get(key), 'rb')
+        try:
+            return cPickle.load(fd)
+        finally:
+            fd.close()
+
+    def put(self, key, rows):
+        self.put_data(key, cPickle.dumps(rows, 2))
+
+    def put_data(self, key, data):
+        filename = os.path.join(self.get_directory(), key)
+        try:
+            fd = open(filename + ".tmp", 'wb')
+            try:
+                fd.write(data)
+            finally:
+                fd.close()
+
+            os.rename(filename + ".tmp", filename)
+        except (IOError, OSError), e:
+            pyflaglog.log(pyflaglog.WARNINGS, "Unable to cache result on disk: %s" % e)
+            return
+
+        self.store.put(filename, key=key)
+
+    def flush(self):
+        self.store.flush()
+
+class TieredCache(ResultCache):
+    """ A memory cache which spills into a disk cache """
+    def __init__(self, memory_bytes, disk_bytes, age):
+        self.disk = None
+        spill = None
+        if disk_bytes > 0:
+            self.disk = DiskCache(disk_bytes, age)
+            spill = self.disk.put_data
+
+        self.memory = MemoryCache(memory_bytes, age, spill = spill)
+
+    def get(self, key):
+        try:
+            return self.memory.get(key)
+        except KeyError:
+            if not self.disk: raise
+
+        ## Promote the result back into memory:
+        rows = self.disk.get(key)
+        self.memory.put(key, rows)
+
+        return rows
+
+    def put(self, key, rows):
+        self.memory.put(key, rows)
+
+    def flush(self):
+        self.memory.flush()
+        if self.disk:
+            self.disk.flush()
+
+    def stats(self):
+        result = dict(memory = self.memory.store.stats())
+        if self.disk:
+            result['disk'] = self.disk.store.stats()
+
+        return result
+
+## Matches quoted strings (which must be kept as they are) or runs of
+## white space:
+normalise_re = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+def normalise(sql):
+    """ Collapses white space outside quoted strings, so trivially
+    different renderings of the same query share cache entries.
+    """
+    def cb(m):
+        return m.group(1) or ' '
+
+    return normalise_re.sub(cb, sql).strip()
+
+def make_key(case, sql, limit, length, generations):
+    """ Makes a cache key for the rows limit to limit+length of sql.
+
+    generations is a list of (table, generation) for all the tables
+    the query reads from.
+    """
+    generations = list(generations)
+    generations.sort()
+
+    return md5(repr((case, normalise(sql), limit, length,
+                         generations))).hexdigest()
+
+## The tables each query reads from (keyed by case and normalised
+## query):
+TABLES = Store.Store(max_size=1000, age=3600)
+
+CACHE = None
+CACHE_PID = None
+
+def get_cache():
+    """ Returns the active result cache """
+    global CACHE, CACHE_PID
+
+    ## Forked children must not share the files of their parent:
+    if not CACHE or (CACHE_PID and CACHE_PID != os.getpid()):
+        CACHE_PID = os.getpid()
+        CACHE = TieredCache(config.RESULT_CACHE_MEMORY, config.RESULT_CACHE_DISK,
+                            config.DBCACHE_AGE * 60)
+
+    return CACHE
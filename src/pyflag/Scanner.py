@@ -169,6 +169,7 @@ class GenScanFactory:
 
         ## Here we do the default (clear scanner_cache field) and hope that inherited classes either deal with it or call us
         sql = DB.glob2re(inode_glob)
+        flush_scanner_cache(self.case)
         db = DB.DBO(self.case)
         db.execute("update inode set scanner_cache = REPLACE(scanner_cache, %r, '') where inode rlike %r", (self.__class__.__name__, sql))
                    
@@ -179,6 +180,7 @@ class GenScanFactory:
         ## The scanners should do their thing on their tables and then call this (the base class) method to allow us to handle the simple stuff (clear the scanner cache field. If they don't call us, it is up to them to clean it up themselves.
         path = path_glob
         if not path.endswith("*"): path = path + "*"  
+        flush_scanner_cache(self.case)
         db = DB.DBO(self.case)
         db.execute("update inode join file on file.inode = inode.inode set scanner_cache = REPLACE(scanner_cache, %r, '') where file.path rlike %r",(self.__class__.__name__, DB.glob2re(path)))
         
@@ -309,9 +311,17 @@ class StoreAndScanType(StoreAndScan):
         try:
             mime_type = metadata['mime']
         except KeyError:
-            dbh = DB.DBO(self.case)
-            dbh.execute("select mime,type from type where inode_id=%r limit 1",(self.inode_id))
-            row=dbh.fetch()
+            import pyflag.Magic as Magic
+
+            try:
+                ## The type may not be written to the table yet:
+                type, mime = Magic.TYPES.pending_type(self.case, self.inode_id)
+                row = dict(mime=mime, type=type)
+            except KeyError:
+                dbh = DB.DBO(self.case)
+                dbh.execute("select mime,type from type where inode_id=%r limit 1",(self.inode_id))
+                row=dbh.fetch()
+
             if row:
                 mime_type = row['mime']
                 metadata['magic'] = row['type']
@@ -379,18 +389,542 @@ class ScanIfType(StoreAndScanType):
         pass
 
 def resetfile(ddfs, inode,factories):
+    flush_scanner_cache(ddfs.case)
     for f in factories:
         dbh=DB.DBO(ddfs.case)
         f.reset(inode)
         dbh.execute("update inode set scanner_cache = REPLACE(scanner_cache,%r,'') where inode=%r",
                                 (f.__class__.__name__, inode))
 
+config.add_option("SCAN_THREADS", default=0, type='int',
+                  help="Number of threads used to run independent scanners "
+                  "on the same file concurrently (0 scans serially)")
+
+config.add_option("SCAN_READAHEAD", default=2, type='int',
+                  help="Number of buffers the scan pipeline reads ahead of "
+                  "the scanners (only used when SCAN_THREADS > 0)")
+
+config.add_option("SCAN_COMMIT_BATCH", default=100, type='int',
+                  help="Number of inodes whose scanner_cache update is "
+                  "batched before being written to the inode table")
+
+config.add_option("SCAN_PROFILE", default=True, action="store_false",
+                  help="Do not record the time each scanner takes in the "
+                  "scanner_profile table")
+
+config.add_option("SCAN_PROFILE_SAMPLE", default=100, type='int',
+                  help="Only profile one in this many files (the counts are "
+                  "scaled up accordingly, 1 profiles every file)")
+
+import threading, Queue, time, socket, resource, sys
+
+## Linux can tell us the CPU time used by the current thread
+## (RUSAGE_THREAD), elsewhere we can only get the time used by the
+## process (which includes other scanners running concurrently):
+if sys.platform.startswith("linux"):
+    def thread_cpu():
+        usage = resource.getrusage(1)
+        return usage.ru_utime + usage.ru_stime
+else:
+    thread_cpu = time.clock
+
+def scan_stages(objs):
+    """ Groups the scanner objects into stages which may be run
+    concurrently.
+
+    objs are given in dependancy order (see
+    ScannerUtils.fill_in_dependancies). A stage is a contiguous run of
+    scanners with the same order attribute, none of which depends on
+    another scanner in the same stage. Stages are always run one after
+    the other so scanners still see the metadata set by the stages
+    before them, exactly as they would when scanning serially.
+
+    StoreAndScan scanners rewind and read our fd in their finish
+    method so they always get a stage of their own.
+    """
+    stages = []
+    current = []
+    names = set()
+    for o in objs:
+        factory = o.outer
+        depends = factory.depends
+        if type(depends)==type(''):
+            depends = [depends]
+
+        if current and (factory.order != current[0].outer.order or \
+                        [ d for d in depends if d in names ] or \
+                        isinstance(o, StoreAndScan) or \
+                        isinstance(current[-1], StoreAndScan)):
+            stages.append(current)
+            current = []
+            names = set()
+
+        current.append(o)
+        names.add(factory.__class__.__name__)
+
+    if current:
+        stages.append(current)
+
+    return stages
+
+## Where the times of each method are counted (see ScannerProfile):
+PROFILE_INDEX = { 'process': 3, 'slack': 5, 'finish': 7 }
+
+def run_scanner(o, method, *args, **kwargs):
+    """ Calls the method on the scanner object logging any errors """
+    ## Scanners which are profiled keep their counts in scan_profile
+    ## until the file is finished (see profile_files). Note that
+    ## scanners which scan the files they find include the time of
+    ## the scanners they call:
+    try:
+        counters = o.scan_profile
+        wall = time.time()
+        cpu = thread_cpu()
+    except AttributeError:
+        counters = None
+
+    try:
+        getattr(o, method)(*args, **kwargs)
+    except Exception,e:
+        pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) on Inode %s Error: %s" % (o,o.inode,e))
+
+    if counters is not None:
+        i = PROFILE_INDEX[method]
+        counters[i] += time.time() - wall
+        counters[i+1] += thread_cpu() - cpu
+        if i == 3:
+            counters[2] += len(args[0])
+
+class ScanPipeline:
+    """ A pool of threads which runs the scanners of a stage in
+    parallel.
+
+    The pool is shared by all files scanned in this process. Each
+    stage is dispatched to the pool and we wait for all its scanners
+    to complete before the next stage is started.
+
+    Scanners in a stage each get their own copy of the metadata dict
+    so they do not change it under each other. The keys they set or
+    remove are merged back (in stage order) when the stage is done,
+    so later stages see the same metadata as when scanning serially.
+    """
+    def __init__(self, threads):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.worker, name="Scanner%s" % i)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        while 1:
+            task = self.tasks.get()
+            ## We are stopped:
+            if task is None: break
+
+            o, method, args, kwargs, done = task
+            try:
+                run_scanner(o, method, *args, **kwargs)
+            finally:
+                done.put(o)
+
+    def stop(self):
+        """ Stops the threads once they finished their tasks """
+        for t in self.threads:
+            self.tasks.put(None)
+
+        for t in self.threads:
+            t.join()
+
+    def run(self, stages, method, *args, **kwargs):
+        """ Runs method on all the scanners in stages. """
+        ## Scanners which scan the files they discover call us from
+        ## within the pool - we must not wait on the pool in that case
+        ## or we may deadlock:
+        nested = threading.currentThread() in self.threads
+
+        for stage in stages:
+            ## Its cheaper to run a single scanner ourselves:
+            if len(stage)==1 or nested:
+                for o in stage:
+                    run_scanner(o, method, *args, **kwargs)
+                continue
+
+            metadata = kwargs.get('metadata')
+            copies = []
+            done = Queue.Queue()
+            for o in stage:
+                if metadata is not None:
+                    task_kwargs = kwargs.copy()
+                    task_kwargs['metadata'] = metadata.copy()
+                    copies.append(task_kwargs['metadata'])
+                else:
+                    task_kwargs = kwargs
+
+                self.tasks.put((o, method, args, task_kwargs, done))
+
+            for o in stage:
+                done.get()
+
+            if metadata is not None:
+                merge_metadata(metadata, copies)
+
+def merge_metadata(metadata, copies):
+    """ Merges the changes scanners made to their copies of metadata
+    back into it. Where scanners change the same key the last one
+    wins, as it would if they ran one after the other.
+    """
+    original = metadata.copy()
+    for copy in copies:
+        for k, v in copy.items():
+            if k not in original or original[k] is not v:
+                metadata[k] = v
+
+        for k in original:
+            if k not in copy:
+                metadata.pop(k, None)
+
+PIPELINE = None
+PIPELINE_PID = None
+
+def get_pipeline():
+    """ Returns the process wide scan pipeline or None if scanning is
+    to be done serially.
+    """
+    global PIPELINE, PIPELINE_PID
+
+    ## Threads do not survive a fork, so workers forked after the
+    ## pipeline was created need their own:
+    if config.SCAN_THREADS > 0 and PIPELINE_PID != os.getpid():
+        PIPELINE = ScanPipeline(config.SCAN_THREADS)
+        PIPELINE_PID = os.getpid()
+
+    return PIPELINE
+
+class ReadAhead:
+    """ Reads buffers from the fd in a seperate thread, so that IO
+    overlaps with the scanners processing the previous buffer.
+
+    The fd must be our own (scanners may seek and read theirs while
+    we read ahead) and is closed when we are.
+    """
+    def __init__(self, fd, buffsize, depth, offset=0):
+        self.fd = fd
+        self.buffsize = buffsize
+        self.queue = Queue.Queue(depth)
+        self.finished = False
+        self.done = False
+        self.error = None
+        ## The offset of the data returned by read so far:
+        self.offset = offset
+
+        fd.seek(offset)
+        self.thread = threading.Thread(target=self.reader)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def reader(self):
+        try:
+            while not self.finished:
+                try:
+                    data = self.fd.read(self.buffsize)
+                except IOError,e:
+                    data = ''
+
+                if not data: break
+                self.queue.put(data)
+        except Exception,e:
+            ## This is raised in the thread calling read:
+            self.error = sys.exc_info()
+
+        ## Always tell the reader we are done, or it would wait forever:
+        self.queue.put('')
+
+    def read(self):
+        if self.done: return ''
+
+        data = self.queue.get()
+        if not data:
+            self.done = True
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.finished = True
+
+        ## Drain the queue so the reader can not block on a put:
+        while self.thread.isAlive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+        self.thread.join()
+        try:
+            self.fd.close()
+        except: pass
+
+class ScannerCacheWriter:
+    """ Batches updates of the scanner_cache column in the inode table.
+
+    Updating the inode table after every file is expensive, so we
+    group inodes by the list of scanners which ran on them and write
+    each group with a single update statement.
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        ## Keyed by case, then by scanner names - values are lists of
+        ## inodes
+        self.pending = {}
+        self.count = 0
+
+    def add(self, case, inode, scanner_names):
+        self.mutex.acquire()
+        try:
+            names = self.pending.setdefault(case, {})
+            names.setdefault(scanner_names, []).append(inode)
+            self.count += 1
+        finally:
+            self.mutex.release()
+
+        if self.count >= config.SCAN_COMMIT_BATCH:
+            self.flush()
+
+    def scanners_pending(self, case, inode):
+        """ Returns a list of scanners which ran on inode but are
+        not yet written to the database.
+        """
+        result = []
+        self.mutex.acquire()
+        try:
+            for scanner_names, inodes in self.pending.get(case, {}).items():
+                if inode in inodes:
+                    result.extend(scanner_names.split(','))
+        finally:
+            self.mutex.release()
+
+        return result
+
+    def flush(self, case=None):
+        """ Writes all pending updates (for case only if specified) """
+        self.mutex.acquire()
+        try:
+            if case:
+                cases = { case: self.pending.pop(case, {}) }
+            else:
+                cases = self.pending
+                self.pending = {}
+
+            self.count = sum([ len(inodes) for names in self.pending.values()
+                               for inodes in names.values() ])
+        finally:
+            self.mutex.release()
+
+        for case, names in cases.items():
+            dbh = DB.DBO(case)
+            for scanner_names, inodes in names.items():
+                try:
+                    dbh.execute("update inode set scanner_cache = concat_ws(',',scanner_cache, %r) where inode in (%s)",
+                                (scanner_names,
+                                 ','.join([ DB.db_expand("%r", (i,)) for i in inodes ])))
+                except DB.DBError,e:
+                    pyflaglog.log(pyflaglog.WARNING, "Unable to update scanner cache: %s" % e)
+
+SCANNER_CACHE = ScannerCacheWriter()
+
+class ScannerProfile:
+    """ Counts the time each scanner takes in this process.
+
+    For each scanner we count the files it was given and the files it
+    skipped (i.e. it was not interested in them), the bytes it
+    processed and the wall and CPU time of its process, slack and
+    finish methods. The counts are added to the scanner_profile table
+    of the case (one row per scanner and worker) when we are flushed.
+    """
+    ## The counters in the order of the columns:
+    columns = [ 'files', 'skipped', 'bytes',
+                'process_wall', 'process_cpu', 'slack_wall', 'slack_cpu',
+                'finish_wall', 'finish_cpu' ]
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        ## Keyed by case, then by scanner name - values are lists of
+        ## counters
+        self.pending = {}
+        self.tables = set()
+        self.worker = "%s:%s" % (socket.gethostname(), os.getpid())
+
+    def counters(self, case, name):
+        try:
+            return self.pending[case][name]
+        except KeyError:
+            return self.pending.setdefault(case, {}).setdefault(
+                name, [0] * len(self.columns))
+
+    def add(self, case, name, counts, skipped=False, weight=1):
+        """ Adds the counts of a scanner for one file. The file stands
+        for weight files (see start_profile).
+        """
+        self.mutex.acquire()
+        try:
+            counters = self.counters(case, name)
+            for i in range(3, len(counts)):
+                counters[i] += counts[i] * weight
+
+            counters[0] += weight
+            counters[2] += counts[2] * weight
+            if skipped:
+                counters[1] += weight
+        finally:
+            self.mutex.release()
+
+    def check_table(self, dbh, case):
+        if case in self.tables: return
+
+        ## Times are in microseconds:
+        dbh.execute("""create table if not exists scanner_profile (
+        `scanner` VARCHAR(250) NOT NULL,
+        `worker` VARCHAR(250) NOT NULL,
+        `files` BIGINT NOT NULL default 0,
+        `skipped` BIGINT NOT NULL default 0,
+        `bytes` BIGINT NOT NULL default 0,
+        `process_wall` BIGINT NOT NULL default 0,
+        `process_cpu` BIGINT NOT NULL default 0,
+        `slack_wall` BIGINT NOT NULL default 0,
+        `slack_cpu` BIGINT NOT NULL default 0,
+        `finish_wall` BIGINT NOT NULL default 0,
+        `finish_cpu` BIGINT NOT NULL default 0,
+        PRIMARY KEY(`scanner`, `worker`))""")
+        self.tables.add(case)
+
+    def flush(self, case=None):
+        """ Adds the counts (for case only if specified) to the
+        scanner_profile table
+        """
+        self.mutex.acquire()
+        try:
+            if case:
+                cases = { case: self.pending.pop(case, {}) }
+            else:
+                cases = self.pending
+                self.pending = {}
+        finally:
+            self.mutex.release()
+
+        for case, names in cases.items():
+            if not names: continue
+
+            dbh = DB.DBO(case)
+            try:
+                self.check_table(dbh, case)
+                rows = []
+                for name, counters in names.items():
+                    ## Seconds to microseconds:
+                    values = counters[:3] + [ int(c * 1000000) for c in counters[3:] ]
+                    rows.append(tuple([ name, self.worker ] + values))
+
+                dbh.executemany("insert into scanner_profile (`scanner`, `worker`, " + \
+                                ", ".join([ "`%s`" % c for c in self.columns ]) + \
+                                ") values (%r, %r, " + \
+                                ", ".join([ "%r" ] * len(self.columns)) + \
+                                ") on duplicate key update " + \
+                                ", ".join([ "`%s`=`%s`+values(`%s`)" % (c,c,c) for c in self.columns ]),
+                                rows)
+
+                dbh.invalidate("scanner_profile")
+            except DB.DBError,e:
+                pyflaglog.log(pyflaglog.WARNING, "Unable to update scanner profile: %s" % e)
+
+PROFILE = ScannerProfile()
+
+def profile_summary(case):
+    """ Returns the profile of each scanner in the case (totalled over
+    all workers) as a list of dicts, most expensive first.
+    """
+    dbh = DB.DBO(case)
+    dbh.execute("select scanner, count(*) as workers, " + \
+                ", ".join([ "sum(`%s`) as `%s`" % (c,c) for c in ScannerProfile.columns ]) + \
+                " from scanner_profile group by scanner " \
+                "order by sum(process_wall + slack_wall + finish_wall) desc")
+
+    result = []
+    for row in dbh:
+        ## Sums are returned as decimals:
+        for c in ScannerProfile.columns:
+            row[c] = int(row[c] or 0)
+
+        result.append(row)
+
+    return result
+
+## Objects with a flush(case=None) method which buffer writes made by
+## scanners. They are all flushed by flush_scanner_cache():
+BATCH_WRITERS = [ SCANNER_CACHE, PROFILE ]
+
+def flush_scanner_cache(case=None):
+    """ Commits all batched scanner_cache updates (and any other
+    BATCH_WRITERS). This must be called when scanning is complete (the
+    Farm does it after each batch of jobs).
+    """
+    for writer in BATCH_WRITERS:
+        writer.flush(case)
+
+    ## Cached results of the tables we wrote to are stale now:
+    DB.commit_invalidations(case)
+
 MESSAGE_COUNT = 0
+
+## Profiling every file costs too much for small files (the CPU time
+## is a system call), so we only profile one in PROFILE_SAMPLE files:
+PROFILE_SAMPLE = None
+PROFILE_COUNTDOWN = 0
+
+def start_profile(objs):
+    """ Starts profiling the scanner objects of a file if the file is
+    sampled. Returns True if it is (the caller then needs to call
+    profile_files when the file is done).
+    """
+    global PROFILE_SAMPLE, PROFILE_COUNTDOWN
+
+    if PROFILE_COUNTDOWN > 0:
+        PROFILE_COUNTDOWN -= 1
+        return False
+
+    if PROFILE_SAMPLE is None:
+        PROFILE_SAMPLE = max(1, config.SCAN_PROFILE_SAMPLE)
+
+    PROFILE_COUNTDOWN = PROFILE_SAMPLE - 1
+    for o in objs:
+        o.scan_profile = [0] * len(ScannerProfile.columns)
+
+    return True
+
+def profile_files(objs, skipped=False):
+    """ Adds the counts of the scanner objects for the file they
+    scanned to the profile. Scanners which ignored the file count it
+    as skipped.
+    """
+    for o in objs:
+        try:
+            counts = o.scan_profile
+            del o.scan_profile
+        except AttributeError:
+            continue
+
+        PROFILE.add(o.case, o.outer.__class__.__name__, counts, skipped or o.ignore,
+                    weight = PROFILE_SAMPLE)
     
 ### This is used to scan a file with all the requested scanner factories
 def scanfile(ddfs,fd,factories):
     """ Given a file object and a list of factories, this function scans this file using the given factories
 
+    If config.SCAN_THREADS is set, data is read ahead of the scanners
+    and independent scanners run concurrently (see scan_stages).
+
     @arg ddfs: A filesystem object. This is sometimes used to add new files into the filesystem by the scanner
     @arg fd: The file object of the file to scan
     @arg factories: A list of scanner factories to use when scanning the file.
@@ -414,6 +948,9 @@ def scanfile(ddfs,fd,factories):
         ## This is not a valid inode, we skip it:
         scanners_run = []
 
+    ## Scanners which ran on this inode but are not committed yet:
+    scanners_run.extend(SCANNER_CACHE.scanners_pending(ddfs.case, fd.inode))
+
     fd.inode_id = row['inode_id']
 
     objs = []
@@ -423,6 +960,8 @@ def scanfile(ddfs,fd,factories):
     
     if len(objs)==0: return
 
+    profiled = config.SCAN_PROFILE and start_profile(objs)
+
     ## This dict stores metadata about the file which may be filled in
     ## by some scanners in order to indicate some fact to other
     ## scanners.
@@ -437,58 +976,73 @@ def scanfile(ddfs,fd,factories):
     else:
         pyflaglog.log(pyflaglog.VERBOSE_DEBUG, messages)
 
-    while 1:
-        ## If the file is too fragmented, we skip it because it might take too long... NTFS is a shocking filesystem, with some files so fragmented that it takes a really long time to read them. In our experience these files are not important for scanning so we disable them here. Maybe this should be tunable?
-        try:
-            if len(fd.blocks)>1000 or fd.size>100000000:
-                return
+    pipeline = get_pipeline()
+    stages = scan_stages(objs)
 
-            c=0
-            for i in fd.blocks:
-                c+=i[1]
+    ## If the file is too fragmented, we skip it because it might take too long... NTFS is a shocking filesystem, with some files so fragmented that it takes a really long time to read them. In our experience these files are not important for scanning so we disable them here. Maybe this should be tunable?
+    try:
+        if len(fd.blocks)>1000 or fd.size>100000000:
+            if profiled: profile_files(objs, skipped=True)
+            return
 
-            ## If there are not enough blocks to do a reasonable chunk of the file, we skip them as well...
-            if c>0 and c*fd.block_size<fd.size:
-                pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because there are not enough blocks %s < %s", fd.inode,c*fd.block_size,fd.size)
-                return
+        c=0
+        for i in fd.blocks:
+            c+=i[1]
 
-        except AttributeError:
-            pass
+        ## If there are not enough blocks to do a reasonable chunk of the file, we skip them as well...
+        if c>0 and c*fd.block_size<fd.size:
+            pyflaglog.log(pyflaglog.WARNING, "Skipping inode %s because there are not enough blocks %s < %s", fd.inode,c*fd.block_size,fd.size)
+            if profiled: profile_files(objs, skipped=True)
+            return
+
+    except AttributeError:
+        pass
 
+    reader = None
+    if pipeline:
         try:
-            data = fd.read(buffsize)
-            if not data: break
+            reader = ReadAhead(ddfs.open(inode=fd.inode), buffsize,
+                               config.SCAN_READAHEAD, offset=fd.tell())
+            read = reader.read
         except IOError,e:
-            break
+            pyflaglog.log(pyflaglog.DEBUG, "Unable to read ahead of inode %s: %s" % (fd.inode, e))
 
-        # call process method of each class
-        interest = 0
-
-        for o in objs:
-            if not o.ignore:
-                interest+=1
-
-        ## If none of the scanners are interested with this file, we
-        ## stop right here
-        if not interest:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "No interest for %s", fd.inode)
-            break
-        
-        for o in objs:
+    if not reader:
+        def read():
             try:
-                if not o.ignore:
-                    interest+=1
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Processing with %s", o)
-                    o.process(data,metadata=metadata)
+                return fd.read(buffsize)
+            except IOError,e:
+                return ''
 
-            except Exception,e:
-                pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
-                # Ignore the error and keep going here:
-                #raise
+    try:
+        while 1:
+            data = read()
+            if not data: break
 
-        if not interest:
-            pyflaglog.log(pyflaglog.DEBUG, "No interest for %s", fd.inode)
-            break
+            ## Only scanners which are still interested in this file
+            ## get the data:
+            active = [ [ o for o in stage if not o.ignore ] for stage in stages ]
+            active = [ stage for stage in active if stage ]
+
+            ## If none of the scanners are interested with this file, we
+            ## stop right here
+            if not active:
+                pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "No interest for %s", fd.inode)
+                break
+
+            if pipeline:
+                pipeline.run(active, "process", data, metadata=metadata)
+            else:
+                for stage in active:
+                    for o in stage:
+                        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Processing with %s", o)
+                        run_scanner(o, "process", data, metadata=metadata)
+    finally:
+        if reader:
+            reader.close()
+            ## Leave our fd where the reads stopped (as if we had read
+            ## it ourselves):
+            fd.seek(reader.offset)
 
     # call slack method of each object. fd.slack must be reset after the call
     # because the scanners actually have a copy of fd and some of them actually
@@ -499,25 +1053,24 @@ def scanfile(ddfs,fd,factories):
     fd.slack=False
     fd.overread=False
     if data:
-        for o in objs:
-            try:
-                o.slack(data, metadata=metadata)
-            except Exception,e:
-                pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) Error: %s" %(o,e))
+        if pipeline:
+            pipeline.run(stages, "slack", data, metadata=metadata)
+        else:
+            for o in objs:
+                run_scanner(o, "slack", data, metadata=metadata)
 
     # call finish method of each object
-    for o in objs:
-        try:
-            o.finish()
-        except Exception,e:
-            pyflaglog.log(pyflaglog.ERRORS,"Scanner (%s) on Inode %s Error: %s" %(o,fd.inode,e))
+    if pipeline:
+        pipeline.run(stages, "finish")
+    else:
+        for o in objs:
+            run_scanner(o, "finish")
+
+    if profiled: profile_files(objs)
 
     # Store the fact that we finished in the inode table:
     scanner_names = ','.join([ c.outer.__class__.__name__ for c in objs ])
-    try:
-        dbh.execute("update inode set scanner_cache = concat_ws(',',scanner_cache, %r) where inode=%r", (scanner_names, fd.inode))
-    except DB.DBError:
-        pass
+    SCANNER_CACHE.add(ddfs.case, fd.inode, scanner_names)
 
 class Drawer:
     """ This class is responsible for rendering scanners of similar classes.
@@ -717,3 +1270,75 @@ class Carver:
         ## dont carve the resultant file (or we could get recursive carves)
         #factories = [ f for f in factories if "Carv" not in f.__class__.__name__]
         #scanfile(self.fsfd, new_fd, factories)
+
+import unittest, types
+
+class TestScan(BaseScanner):
+    """ A scanner which does not need a filesystem """
+    def __init__(self, outer):
+        self.outer = outer
+        self.inode = "test"
+        self.ignore = False
+
+class ScannerTests(unittest.TestCase):
+    """ Scan pipeline tests """
+    def make_scanners(self, specs):
+        """ Makes scanner objects from a list of (name, order, depends) """
+        objs = []
+        for name, order, depends in specs:
+            factory = types.ClassType(name, (GenScanFactory,),
+                                      dict(order=order, depends=depends))()
+            objs.append(TestScan(factory))
+
+        return objs
+
+    def stage_names(self, stages):
+        return [ [ o.outer.__class__.__name__ for o in stage ] for stage in stages ]
+
+    def test01Stages(self):
+        """ Test that stages follow order and depends """
+        objs = self.make_scanners([ ("TypeScan", 5, []),
+                                    ("MD5Scan", 5, []),
+                                    ("IndexScan", 5, "TypeScan"),
+                                    ("ZipScan", 10, []),
+                                    ("GZScan", 10, ["ZipScan"]),
+                                    ("PstScan", 10, []) ])
+
+        self.assertEqual(self.stage_names(scan_stages(objs)),
+                         [ ["TypeScan", "MD5Scan"], ["IndexScan"],
+                           ["ZipScan"], ["GZScan", "PstScan"] ])
+
+    def test02Metadata(self):
+        """ Test that scanners in a stage get their own metadata """
+        objs = self.make_scanners([ ("TypeScan", 5, []),
+                                    ("MD5Scan", 5, []),
+                                    ("IndexScan", 10, []) ])
+        seen = {}
+
+        def process(o, data, metadata=None):
+            name = o.outer.__class__.__name__
+            seen[name] = metadata.copy()
+            metadata[name] = data
+            metadata['last'] = name
+            if name == "MD5Scan":
+                del metadata['old']
+
+        for o in objs:
+            o.process = lambda data, metadata=None, o=o: process(o, data, metadata)
+
+        metadata = {'old': 1}
+        pipeline = ScanPipeline(2)
+        try:
+            pipeline.run(scan_stages(objs), "process", "data", metadata=metadata)
+        finally:
+            pipeline.stop()
+
+        ## Scanners in the same stage do not see each other's changes:
+        self.assertEqual(seen['TypeScan'], {'old': 1})
+        self.assertEqual(seen['MD5Scan'], {'old': 1})
+
+        ## But the next stage sees them all:
+        self.assertEqual(seen['IndexScan'], {'TypeScan': 'data', 'MD5Scan': 'data',
+                                             'last': 'MD5Scan'})
+        self.assertEqual(metadata, {'TypeScan': 'data', 'MD5Scan': 'data',
+                                    'IndexScan': 'data', 'last': 'IndexScan'})
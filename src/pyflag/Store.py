@@ -17,6 +17,10 @@ the store at any one time.
 import thread,time,re
 import pyflag.pyflaglog as pyflaglog
 
+## Indexes into the linked list nodes. Each node is a list of [prev,
+## next, key, object, time, size]:
+PREV, NEXT, KEY, OBJ, TIME, SIZE = range(6)
+
 class Store:
     """ Stores objects for a length of time.
 
@@ -27,31 +31,88 @@ class Store:
     deletion of objects from the store will not cause their
     destruction. Therefore, objects may only exist in the store or out
     of store (in the client) - never in both places.
+
+    Objects are kept in a dict for lookup by key, as well as in a
+    doubly linked list ordered from oldest to newest. All operations
+    apart from expire() are therefore constant time.
     """
-    def __init__(self, max_size=300, age=1800):
+    def __init__(self, max_size=300, age=1800, max_bytes=0, sizeof=None):
         """ max_size is the maximum number of objects in the store, age is their maximum age.
+
+        If max_bytes is specified, we also limit the total size of
+        objects held. sizeof is a function which returns the size of
+        an object (by default we use len() where available).
         """
         self.max_size = max_size
         self.max_age = age
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or default_sizeof
         self.mutex = thread.allocate_lock()
-
-        ## creation_times is an array of (time, key, object). The time
-        ## is ordered in oldest first and newest last time order.
-        self.creation_times = []
         self.id = 0
 
+        ## Counters for cache statistics:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._reset()
+
+    def _reset(self):
+        ## The root is a sentinel node - root[NEXT] is the oldest node
+        ## and root[PREV] is the newest.
+        self.root = root = [None, None, None, None, None, 0]
+        root[PREV] = root[NEXT] = root
+        self.map = {}
+        self.bytes = 0
+
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        del self.map[node[KEY]]
+        self.bytes -= node[SIZE]
+
+    def _append(self, node):
+        """ Links the node in as the newest node """
+        root = self.root
+        last = root[PREV]
+        node[PREV] = last
+        node[NEXT] = root
+        last[NEXT] = root[PREV] = node
+        self.map[node[KEY]] = node
+        self.bytes += node[SIZE]
+
+    def _evict(self, node, reason):
+        self._unlink(node)
+        self.evictions += 1
+        pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Removed object %r because %s" % (node[OBJ], reason))
+
+    def _get_creation_times(self):
+        """ A list of [time, key, object] from oldest to newest (this
+        is what the store used to keep internally).
+        """
+        return [ [node[TIME], node[KEY], node[OBJ]] for node in self._nodes() ]
+
+    creation_times = property(_get_creation_times)
+
+    def _nodes(self):
+        root = self.root
+        node = root[NEXT]
+        while node is not root:
+            next = node[NEXT]
+            yield node
+            node = next
+
     def flush(self):
         self.mutex.acquire()
-        self.creation_times = []
+        self._reset()
         self.mutex.release()
 
     def size(self):
-        return len(self.creation_times)
+        return len(self.map)
         
     def put(self,object, prefix='', key=None):
         """ Stores an object in the Store.  Returns the key for the
-        object. If key is already supplied we use that instead - Note
-        that we do not check that it doesnt already exist.
+        object. If key is already supplied we use that instead - If an
+        object is already stored under this key it will be replaced.
         """
         self.mutex.acquire()
         try:
@@ -63,10 +124,22 @@ class Store:
             now = time.time()
             if not key:
                 key = "%s%s" % (prefix,self.id)
-                
-            self.creation_times.append([now,key, object])
+
+            try:
+                self._unlink(self.map[key])
+            except KeyError:
+                pass
+
+            self._append([None, None, key, object, now,
+                          self.max_bytes and self.sizeof(object) or 0])
             self.id+=1
 
+            ## Enforce the byte limit now, but never evict the object
+            ## we just stored:
+            if self.max_bytes:
+                while self.bytes > self.max_bytes and self.root[NEXT][KEY] != key:
+                    self._evict(self.root[NEXT], "store exceeds %s bytes" % self.max_bytes)
+
         finally:
             self.mutex.release()
 
@@ -79,74 +152,80 @@ class Store:
         """ Retrieve the key from the store.
         If remove is specified we remove it from the Store altogether.
         """
-        ## FIXME: This is slow for large stores... use a dict for
-        ## quick reference:
         self.mutex.acquire()
 
         try:
-            ## Find and remove the object from the store
-            i=0
-            for t, k, obj in self.creation_times:
-                if k==key:
-                    ## Remove the object from the store:
-                    t, k, obj = self.creation_times.pop(i)
-
-                    ## Reinsert it into the cache at the most recent
-                    ## time:
-                    if not remove:
-                        self.creation_times.append([time.time(), k, obj])
-                    
-                    self.check_full()
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
-                                  "Got key %s: %s" % (key,
-                                                      ("%r" % (obj,))[:100]))
-                    return obj
-                i+=1
-
-            ## If we are here we could not find the key:
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Key %s not found" % (key,))
-            raise KeyError("Key not found %s" % (key,))
+            try:
+                node = self.map[key]
+            except KeyError:
+                ## If we are here we could not find the key:
+                self.misses += 1
+                pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Key %s not found" % (key,))
+                raise KeyError("Key not found %s" % (key,))
+
+            self.hits += 1
+
+            ## Remove the object from the store:
+            self._unlink(node)
+
+            ## Reinsert it into the cache at the most recent time:
+            if not remove:
+                node[TIME] = time.time()
+                self._append(node)
+
+            self.check_full()
+            pyflaglog.log(pyflaglog.VERBOSE_DEBUG,
+                          "Got key %s: %s" % (key,
+                                              ("%r" % (node[OBJ],))[:100]))
+            return node[OBJ]
 
         finally:
             self.mutex.release()
         
     def check_full(self):
         """ Checks to ensure the Store is not full """
+        root = self.root
+        
         ## Check to see if we store too many objects - remove oldest
         ## objects first:
-        while len(self.creation_times)>self.max_size:
-            t, key, o = self.creation_times.pop(0)
-            pyflaglog.log(pyflaglog.VERBOSE_DEBUG, "Removed object %r because store is full" % (o,))
+        while len(self.map)>self.max_size:
+            self._evict(root[NEXT], "store is full")
+
+        while self.max_bytes and self.bytes > self.max_bytes and self.map:
+            self._evict(root[NEXT], "store exceeds %s bytes" % self.max_bytes)
 
         ## Now ensure that objects are not too old:
         now = time.time()
-        try:
-            while 1:
-                t,key,o = self.creation_times[0]
-                if t+self.max_age < now:
-                    self.creation_times.pop(0)
-                    pyflaglog.log(pyflaglog.VERBOSE_DEBUG,"Removed object %r because it is too old" % (o,))
-                else:
-                    break
-        except IndexError:
-            pass
+        while self.map and root[NEXT][TIME] + self.max_age < now:
+            self._evict(root[NEXT], "it is too old")
 
     def expire(self, regex):
         """ Automatially expire all objects with keys matching the regex """
         self.mutex.acquire()
 
         try:
-            tmp = []
-            for x in self.creation_times:
-                if not re.search(regex, x[1]):
-                    tmp.append(x)
-            self.creation_times = tmp
+            for node in list(self._nodes()):
+                if re.search(regex, node[KEY]):
+                    self._unlink(node)
         finally:
             self.mutex.release()
 
+    def stats(self):
+        """ Returns a dict of statistics about this store """
+        return dict(size = len(self.map), bytes = self.bytes,
+                    hits = self.hits, misses = self.misses,
+                    evictions = self.evictions)
+
     def __iter__(self):
-        for t, k, obj in self.creation_times:
-            yield obj
+        for node in list(self._nodes()):
+            yield node[OBJ]
+
+def default_sizeof(object):
+    """ The size of an object is its length if it has one """
+    try:
+        return len(object)
+    except (TypeError, AttributeError):
+        return 0
 
 ## Store unit tests:
 import unittest
@@ -191,3 +270,28 @@ class StoreTests(unittest.TestCase):
         s.expire("test\d+")
         ## Should have 5 "testsxxx" left
         self.assertEqual(len(s.creation_times),5)
+
+    def test04ByteLimit(self):
+        """ Test that the store keeps the total size under max_bytes """
+        s = Store(max_size = 100, max_bytes = 100)
+        keys = []
+        for i in range(0,10):
+            keys.append(s.put("x" * 30))
+
+        self.assert_(s.bytes <= 100)
+        self.assertRaises(KeyError, lambda : s.get(keys[0]))
+        s.get(keys[-1])
+
+    def test05Counters(self):
+        """ Test the hit/miss/eviction counters """
+        s = Store(max_size = 2)
+        key = s.put(1)
+        s.get(key)
+        self.assertRaises(KeyError, lambda : s.get("missing"))
+        for i in range(0,5):
+            s.put(i)
+
+        stats = s.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 3)
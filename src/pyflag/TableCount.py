@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Counts the rows of table queries.
+
+Counting the rows which match a filter may need to scan the whole
+table. count() answers straight away with an estimate, and counts
+the rows exactly in a background thread. Exact counts are cached
+keyed by the query and the generations of the tables it reads from
+(see ResultCache), so they are found again until a table changes.
+
+Estimates of unfiltered queries come from the table statistics. For
+filtered queries we count the matching rows within a few random
+ranges of the table's unique key and scale up.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.DB as DB
+import pyflag.Store as Store
+import pyflag.ResultCache as ResultCache
+import pyflag.pyflaglog as pyflaglog
+import threading, random
+
+config.add_option("COUNT_SAMPLE_SIZE", default=10000, type='int',
+                  help="Number of rows sampled to estimate how many rows match a filter (smaller tables are counted exactly)")
+
+config.add_option("COUNT_SAMPLES", default=10, type='int',
+                  help="Number of random ranges of rows sampled to estimate how many rows match a filter")
+
+## Exact counts keyed by ResultCache.make_key():
+COUNTS = Store.Store(max_size=1000, age=24*3600)
+
+## The threads counting rows keyed like COUNTS:
+RUNNING = {}
+RUNNING_LOCK = threading.Lock()
+
+def exact_count(dbh, sql, cache_key):
+    """ Counts the rows and caches the result under cache_key """
+    dbh.execute(sql)
+    total = dbh.fetch()['total']
+    COUNTS.put(total, key=cache_key)
+
+    return total
+
+def background_count(case, sql, cache_key):
+    try:
+        exact_count(DB.DBO(case), sql, cache_key)
+    except Exception, e:
+        pyflaglog.log(pyflaglog.WARNING, "Unable to count rows: %s", e)
+
+    RUNNING_LOCK.acquire()
+    try:
+        del RUNNING[cache_key]
+    finally:
+        RUNNING_LOCK.release()
+
+def table_rows(dbh, table):
+    """ The number of rows in table according to its statistics
+    (this is only an estimate for some table types).
+    """
+    dbh.execute("show table status like %r", table)
+    row = dbh.fetch()
+    if row:
+        return row['Rows']
+
+def estimate(dbh, sql, table, key, rows):
+    """ Estimates the rows of sql by sampling ranges of key.
+
+    Returns None if we can not.
+    """
+    if not key or not rows: return None
+    
+    dbh.execute("select min(%s) as low, max(%s) as high from `%s`", (key, key, table))
+    row = dbh.fetch()
+    low, high = row['low'], row['high']
+    if not isinstance(low, (int, long)) or not isinstance(high, (int, long)):
+        return None
+
+    ## Each range should hold about the same number of rows:
+    width = max(1, (high - low + 1) * config.COUNT_SAMPLE_SIZE / \
+                (rows * config.COUNT_SAMPLES))
+
+    matched = sampled = 0
+    for i in range(config.COUNT_SAMPLES):
+        start = random.randint(low, max(low, high - width + 1))
+        condition = "%s between %s and %s" % (key, start, start + width - 1)
+
+        dbh.execute("%s and %s", (sql, condition))
+        matched += dbh.fetch()['total']
+
+        dbh.execute("select count(*) as total from `%s` where %s", (table, condition))
+        sampled += dbh.fetch()['total']
+
+    if not sampled: return None
+
+    return int(rows * float(matched) / sampled)
+
+def count(case, sql, table=None, key=None, filtered=True):
+    """ Returns (total, exact) for sql, which must be a select
+    statement returning the count in its total column.
+
+    If we do not know the exact count yet we return an estimate (or
+    None if we can not make one) and count the rows in the
+    background.
+
+    If sql selects from a single table we can estimate its
+    count. table is the table, key is an integer column with unique
+    values (so we can sample the table) and filtered is set if sql
+    does not count all the rows.
+    """
+    dbh = DB.DBO(case)
+    cache_key = ResultCache.make_key(case, sql, 0, 0,
+                                     dbh.table_generations(dbh.query_tables(sql)))
+    try:
+        return COUNTS.get(cache_key), True
+    except KeyError:
+        pass
+
+    rows = None
+    if table:
+        rows = table_rows(dbh, table)
+
+        ## Small tables are quick to count:
+        if rows is not None and rows <= config.COUNT_SAMPLE_SIZE:
+            return exact_count(dbh, sql, cache_key), True
+
+    RUNNING_LOCK.acquire()
+    try:
+        if cache_key not in RUNNING:
+            t = threading.Thread(target = background_count,
+                                 args = (case, sql, cache_key))
+            t.setDaemon(True)
+            RUNNING[cache_key] = t
+            t.start()
+    finally:
+        RUNNING_LOCK.release()
+
+    if not table:
+        return None, False
+
+    if not filtered:
+        return rows, False
+    
+    try:
+        return estimate(dbh, sql, table, key, rows), False
+    except DB.DBError, e:
+        pyflaglog.log(pyflaglog.DEBUG, "Unable to estimate rows: %s", e)
+        return None, False
@@ -1,18 +1,40 @@
 #!/usr/bin/env python
 """ This module has a number of useful Time manipulation utilities
 """
-import _strptime, time
+import _strptime, time, re
 from datetime import date as datetime_date
 import pyflag.DB as DB
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+
+config.add_option("CASE_TZ_AGE", default=60, type='int',
+                  help="Number of seconds the case timezone is cached for. Changes made by "
+                  "other processes take this long to be noticed.")
 
 _regex_cache = {}
 
+## Making a TimeRE is expensive, so we keep one for the current
+## locale:
+_time_re = None
+_time_re_lang = None
+
+def get_time_re():
+    global _time_re, _time_re_lang
+
+    lang = _strptime._getlang()
+    if not _time_re or lang != _time_re_lang:
+        _time_re = _strptime.TimeRE()
+        _time_re_lang = lang
+        _regex_cache.clear()
+
+    return _time_re
+
 def strptime(data_string, format="%a %b %d %H:%M:%S %Y"):
     """Return a time struct based on the input string and the format string.
 
     This has been taken from the Python2.5 distribution and slightly modified.
     """
-    time_re = _strptime.TimeRE()
+    time_re = get_time_re()
     locale_time = time_re.locale_time
     format_regex = _regex_cache.get(format)
     if not format_regex:
@@ -170,26 +192,60 @@ def strptime(data_string, format="%a %b %d %H:%M:%S %Y"):
 
 # below are some helpful functions to deal with date and timezone translation
 
-from pyflag.dateutil.tz import gettz
+from pyflag.dateutil.tz import gettz, tzoffset, tzutc, tzlocal
 import pyflag.dateutil.parser
 import datetime
 from os.path import basename
 
 from pyflag.FileSystem import DBFS
 
+## The timezone name of each case, and when it expires:
+CASE_TZ = {}
+
 def get_case_tz_name(case):
     """ return the name of the current case timezone """
+    try:
+        expiry, name = CASE_TZ[case]
+        if expiry > time.time():
+            return name
+    except KeyError:
+        pass
+
     dbh = DB.DBO(case)
     dbh.execute('select value from meta where property="TZ" limit 1')
     row = dbh.fetch()
     if not row or row['value'] == "SYSTEM":
-    	return None
+    	name = None
     else:
-        return row['value']
+        name = row['value']
+
+    CASE_TZ[case] = (time.time() + config.CASE_TZ_AGE, name)
+    return name
+
+def flush_case_tz(case=None):
+    """ Forget the timezone of case (or all cases), e.g. because it
+    was changed.
+    """
+    if case is None:
+        CASE_TZ.clear()
+    else:
+        CASE_TZ.pop(case, None)
+
+## tzinfo objects by name - gettz reads the zone file each time:
+ZONES = {}
+
+def get_tz(name):
+    """ A cached version of gettz """
+    try:
+        return ZONES[name]
+    except KeyError:
+        tz = gettz(name)
+        ZONES[name] = tz
+        return tz
 
 def get_case_tz(case):
     """ return the tzinfo for the current case timezone """
-    return gettz(get_case_tz_name(case))
+    return get_tz(get_case_tz_name(case))
 
 def get_evidence_tz_name(case, fd):
     """ return the name of the timezone for the given piece of evidence """
@@ -208,26 +264,142 @@ def parse(timestr, case=None, evidence_tz=None, **options):
     """ Parse a time string using dateutil.parser.  Current Time and Evidence
     timezone are used as a defaults for missing values on parsing. The result
     is a time string suitable for mysql expressed in case timezone """
-    if not timestr:
-    	return None
+    try:
+        parser = PARSERS[(case, evidence_tz)]
+    except KeyError:
+        parser = DateParser(case, evidence_tz)
+        PARSERS[(case, evidence_tz)] = parser
 
-    evidence_tz = gettz(evidence_tz)
-    case_tz = get_case_tz(case)
+    return parser.parse(timestr, **options)
 
-    ## Maybe timestr is a unixtime:
-    try:
-        dt = datetime.datetime.fromtimestamp(int(timestr))
-    except:
-        DEFAULT = datetime.datetime(tzinfo=gettz("UTC"), *time.gmtime()[:6]).astimezone(evidence_tz)
-        dt = pyflag.dateutil.parser.parse(timestr, default=DEFAULT, **options).astimezone(case_tz)
+## Dates in common log and HTTP formats which the fast date parser
+## understands. They may be followed by fractions of a second and a
+## UTC offset or zone.
+MONTHS = dict([ (m, i + 1) for i, m in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]) ])
 
-    return time.strftime("%Y-%m-%d %H:%M:%S", dt.timetuple())
+DATE_FORMATS = [
+    ## Apache: 10/Oct/2000:13:55:36 -0700
+    r"(?P<d>\d{2})/(?P<b>[A-Za-z]{3})/(?P<Y>\d{4}):(?P<H>\d{2}):(?P<M>\d{2}):(?P<S>\d{2})",
+    ## RFC 1123: Sun, 06 Nov 1994 08:49:37 GMT
+    r"[A-Za-z]{3}, (?P<d>\d{1,2}) (?P<b>[A-Za-z]{3}) (?P<Y>\d{4}) (?P<H>\d{2}):(?P<M>\d{2}):(?P<S>\d{2})",
+    ## asctime: Sun Nov  6 08:49:37 1994
+    r"[A-Za-z]{3} (?P<b>[A-Za-z]{3}) +(?P<d>\d{1,2}) (?P<H>\d{2}):(?P<M>\d{2}):(?P<S>\d{2}) (?P<Y>\d{4})",
+    ## ISO 8601 and IIS: 2008-06-12 00:48:38
+    r"(?P<Y>\d{4})-(?P<m>\d{2})-(?P<d>\d{2})[T ](?P<H>\d{2}):(?P<M>\d{2}):(?P<S>\d{2})",
+    ]
+
+DATE_ZONE = r"(?:\.\d+)?(?: ?(?:(?P<z>GMT|UTC|Z)|(?P<o>[+-])(?P<oh>\d{2}):?(?P<om>\d{2})))?$"
+
+DATE_REGEXES = [ re.compile(f + DATE_ZONE) for f in DATE_FORMATS ]
+
+class DateParser:
+    """ Parses dates into the case timezone (like parse()).
+
+    Dates in one of the DATE_FORMATS are parsed directly, other dates
+    are parsed with dateutil, which is very slow. Dates from the same
+    source (e.g. a log column or an http header) are normally all in
+    the same format, so we try the format of the last date first.
+
+    If fast is False, all dates are parsed with dateutil.
+    """
+    def __init__(self, case=None, evidence_tz=None, fast=True):
+        self.case = case
+        self.evidence_tz = evidence_tz
+        self.fast = fast
+        self.regex = DATE_REGEXES[0]
+
+    def match(self, timestr):
+        """ Returns the match of timestr in any of the DATE_FORMATS """
+        if not self.fast:
+            return None
+
+        ## The same parser may be used by several threads, so we only
+        ## read self.regex once:
+        regex = self.regex
+        m = regex.match(timestr)
+        if m: return m
+
+        for other in DATE_REGEXES:
+            if other is regex: continue
+            m = other.match(timestr)
+            if m:
+                self.regex = other
+                return m
+
+    def zone(self, m):
+        """ Returns the tzinfo for the zone in the match (the same one
+        dateutil would give)
+        """
+        name = m.group('z')
+        if m.group('o'):
+            offset = int(m.group('oh')) * 3600 + int(m.group('om')) * 60
+            if m.group('o') == '-':
+                offset = -offset
+
+            if offset:
+                return tzoffset(None, offset)
+
+            name = "UTC"
+        elif name == 'Z':
+            name = "UTC"
+        elif not name:
+            return get_tz(self.evidence_tz)
+
+        if name in time.tzname:
+            return tzlocal()
+
+        return tzutc()
+
+    def fast_parse(self, timestr):
+        """ Returns the datetime of timestr, or None if it is not in
+        our format.
+        """
+        m = self.match(timestr.strip())
+        if not m: return None
+
+        d = m.groupdict()
+        try:
+            if d.get('b'):
+                month = MONTHS[d['b'].lower()]
+            else:
+                month = int(d['m'])
+
+            return datetime.datetime(int(d['Y']), month, int(d['d']),
+                                     int(d['H']), int(d['M']), int(d['S']),
+                                     tzinfo = self.zone(m))
+        except (KeyError, ValueError):
+            return None
+
+    def parse(self, timestr, **options):
+        if not timestr:
+            return None
+
+        case_tz = get_case_tz(self.case)
+
+        ## Maybe timestr is a unixtime:
+        try:
+            dt = datetime.datetime.fromtimestamp(int(timestr))
+        except:
+            ## Options change how dateutil parses the date:
+            dt = not options and self.fast_parse(timestr)
+            if dt:
+                dt = dt.astimezone(case_tz)
+            else:
+                evidence_tz = get_tz(self.evidence_tz)
+                DEFAULT = datetime.datetime(tzinfo=get_tz("UTC"), *time.gmtime()[:6]).astimezone(evidence_tz)
+                dt = pyflag.dateutil.parser.parse(timestr, default=DEFAULT, **options).astimezone(case_tz)
+
+        return time.strftime("%Y-%m-%d %H:%M:%S", dt.timetuple())
+
+## A DateParser for each case and evidence timezone (used by parse()):
+PARSERS = {}
 
 def convert(timeval, case=None, evidence_tz=None):
     """ Convert a datetime or time tuple from evidence timezone to case timezone """
     if not timeval: return
     
-    evidence_tz = gettz(evidence_tz)
+    evidence_tz = get_tz(evidence_tz)
     case_tz = get_case_tz(case)
 
     # convert to datetime if not already
@@ -243,3 +415,55 @@ def convert(timeval, case=None, evidence_tz=None):
 
     dt = timeval.astimezone(case_tz)
     return time.strftime("%Y-%m-%d %H:%M:%S", dt.timetuple())
+
+## Unit tests:
+import unittest
+
+class DateParserTests(unittest.TestCase):
+    """ Fast date parser """
+    case = "DateParserTests"
+    dates = [ "Sun, 06 Nov 1994 08:49:37 GMT", "Sun, 6 Nov 1994 08:49:37 +1000",
+              "Sun, 06 Nov 1994 08:49:37 UTC", "Sun Nov  6 08:49:37 1994",
+              "2008-06-12 00:48:38", "2008-06-12T00:48:38Z",
+              "2008-06-12T00:48:38.123-05:30", "Sun, 06 Nov 1994 08:49:37 EST" ]
+
+    def test01Dateutil(self):
+        """ Test that the fast parser agrees with dateutil """
+        for case_tz in (None, "Australia/Sydney"):
+            ## Do not look up the test case in the database:
+            CASE_TZ[self.case] = (time.time() + 3600, case_tz)
+            for evidence_tz in (None, "UTC", "America/New_York"):
+                for date in self.dates:
+                    fast = DateParser(self.case, evidence_tz)
+                    slow = DateParser(self.case, evidence_tz, fast=False)
+                    self.assertEqual(fast.parse(date), slow.parse(date))
+
+        flush_case_tz(self.case)
+
+    def test02Detect(self):
+        """ Test format detection """
+        CASE_TZ[self.case] = (time.time() + 3600, "UTC")
+        parser = DateParser(self.case, "UTC")
+        self.assertEqual(parser.parse("10/Oct/2000:13:55:36 -0700"), "2000-10-10 20:55:36")
+        self.assert_(parser.fast_parse("11/Oct/2000:13:55:36 +0000"))
+
+        ## Other formats are parsed fast too:
+        self.assertEqual(parser.parse("2008-06-12 00:48:38"), "2008-06-12 00:48:38")
+        self.assert_(parser.fast_parse("2008-06-12 00:48:38"))
+
+        ## Dates in no known format are parsed with dateutil:
+        self.assertEqual(parser.fast_parse("June 12 2008 00:48:38"), None)
+        self.assertEqual(parser.parse("June 12 2008 00:48:38"), "2008-06-12 00:48:38")
+        flush_case_tz(self.case)
+
+    def test03MixedFormats(self):
+        """ Test that earlier dates do not change how later ones parse """
+        CASE_TZ[self.case] = (time.time() + 3600, "UTC")
+        apache = "10/Oct/2000:13:55:36 -0700"
+        expected = parse(apache, self.case)
+        self.assertEqual(expected, "2000-10-10 20:55:36")
+        for date in self.dates + [ "June 12 2008 00:48:38" ] * 20:
+            parse(date, self.case)
+            self.assertEqual(parse(apache, self.case), expected)
+
+        flush_case_tz(self.case)
@@ -40,6 +40,9 @@ import pyflag.pyflaglog as pyflaglog
 config=pyflag.conf.ConfObject()
 import pyflag.parser as parser
 import pyflag.Registry as Registry
+import pyflag.Store as Store
+import pyflag.ResultCache as ResultCache
+import pyflag.TableCount as TableCount
 
 
 config.LOG_LEVEL=7
@@ -466,6 +469,68 @@ UI = None
 config.add_option("PAGESIZE", default=50, type='int',
                   help="number of rows to display per page in the Table widget")
 
+config.add_option("TABLE_STREAM", default=True, action="store_false",
+                  help="Stream the rows of tables to the browser as they are rendered")
+
+## A column which uniquely identifies the rows of each table (keyed
+## by case and table):
+UNIQUE_KEYS = Store.Store(max_size=1000)
+
+## The keys of the rows before each page of table queries which we
+## know about (see TableRenderer.seek_rows()):
+BOUNDARIES = Store.Store(max_size=500)
+
+def unique_key(dbh, table):
+    """ Returns a not null column of table with unique values (the
+    primary key if possible) or None if there is none.
+    """
+    cache_key = "%s|%s" % (dbh.case, table)
+    try:
+        return UNIQUE_KEYS.get(cache_key)
+    except KeyError:
+        pass
+
+    keys = {}
+    try:
+        dbh.execute("show index from `%s`", table)
+        for row in dbh:
+            if row['Non_unique'] or row['Null']: continue
+            keys.setdefault(row['Key_name'], []).append(row['Column_name'])
+    except DB.DBError:
+        pass
+
+    result = None
+    for name, columns in keys.items():
+        if len(columns) == 1 and (name == 'PRIMARY' or not result):
+            result = columns[0]
+
+    UNIQUE_KEYS.put(result, key=cache_key)
+    return result
+
+def seek_condition(sort, key, op, sort_value, key_value):
+    """ Returns a condition for rows after (op='>') or before
+    (op='<') the row with the sort_value and key_value, in the order
+    of the sort expression then the key.
+
+    Mysql sorts nulls before everything else.
+    """
+    if isinstance(sort_value, float):
+        sort_value = repr(sort_value)
+
+    if sort_value is None:
+        if op == '>':
+            return DB.db_expand("((%s is null and %s > %r) or %s is not null)",
+                                (sort, key, key_value, sort))
+
+        return DB.db_expand("(%s is null and %s < %r)", (sort, key, key_value))
+
+    result = DB.db_expand("(%s %s %r or (%s = %r and %s %s %r)",
+                          (sort, op, sort_value, sort, sort_value, key, op, key_value))
+    if op == '<':
+        result += " or %s is null" % sort
+
+    return result + ")"
+
 def _make_join_clause(total_elements):
     query_str = ''
     ## The tables are calculated as a join of all the individual
@@ -534,6 +599,10 @@ class TableRenderer:
     groupby = None
     _groupby = None
 
+    ## Should rows be rendered as they are sent to the browser (if
+    ## TABLE_STREAM is set and the UI supports it)?
+    stream = True
+
     def __init__(self, **args):
         self.__dict__.update(args)
         
@@ -584,16 +653,44 @@ class TableRenderer:
         """  This returns the total number of rows in this table - it
         could take a while which is why its a popup."""
         def count_cb(query, result):
-            sql = self._make_sql(query).split("from",1)[1]
-            #sql = self._make_sql(query)[len("select "):]
-
-            dbh=DB.DBO(self.case)
-            dbh.execute("select count(*) as total from " + sql)
-            row=dbh.fetch()
+            total, exact = self.count_rows(query)
             result.heading("Total rows")
-            result.para("%s rows" % row['total'])
+            if exact:
+                result.para("%s rows" % total)
+                return
+
+            if total is None:
+                result.para("Counting rows...")
+            else:
+                result.para("About %s rows (estimate)" % total)
+
+            result.para("The exact number of rows is being counted.")
+            result.refresh(config.REFRESH, query)
 
         result.toolbar(count_cb, "Count rows matching filter", icon = "add.png")
+
+    def count_rows(self, query):
+        """ Returns (total, exact) for the rows matching the filter
+        (see TableCount.count())
+        """
+        if self.groupby or self._groupby:
+            return TableCount.count(self.case, "select count(*) as total from (%s) as grouped" % \
+                                    self._make_sql(query, ordering=False, select="1"))
+
+        sql = self._make_sql(query, ordering=False, select="count(*) as total")
+        tables = set([ e.join_table() for e in self.elements + self.filter_elements ])
+        if len(tables) != 1:
+            return TableCount.count(self.case, sql)
+
+        table = tables.pop()
+        key = unique_key(DB.DBO(self.case), table)
+        if key:
+            key = "`%s`.`%s`" % (table, key)
+
+        filtered = self.filter_str or self.where not in (None, '', '1', 1) or \
+                   [ e for e in self.elements + self.filter_elements if e.where() ]
+
+        return TableCount.count(self.case, sql, table, key, filtered)
         
     def groupby_button(self, query, result):
         """ This allows grouping (counting) rows with the same value """
@@ -729,8 +826,12 @@ class TableRenderer:
             icon = "sql.png", pane = 'popup',
             )
     
-    def _make_sql(self, query, ordering=True):
-        """ Calculates the SQL for the table widget based on the query """
+    def _make_sql(self, query, ordering=True, columns=(), select=None):
+        """ Calculates the SQL for the table widget based on the query
+
+        columns is a list of (sql, alias) to select as well as the
+        elements. If select is given we select it instead.
+        """
         ## Calculate the SQL
         query_str = "select "
         try:
@@ -750,7 +851,11 @@ class TableRenderer:
             if not e.case: e.case = self.case
 
         ## The columns and their aliases:
-        query_str += ",".join([ e.select() + " as `" + e.name + "`" for e in self.elements ])
+        if select:
+            query_str += select
+        else:
+            query_str += ",".join([ e.select() + " as `" + e.name + "`" for e in self.elements ] + \
+                                  [ "%s as `%s`" % c for c in columns ])
         
         query_str += _make_join_clause(total_elements)
 
@@ -806,11 +911,109 @@ class TableRenderer:
         ## paging of slow queries.
         try:    self.limit = int(query.get(self.limit_context,0))
         except: self.limit = 0
+
+        rows = self.seek_rows(dbh, query)
+        if rows is not None:
+            return iter(rows)
         
         dbh.cached_execute(self.sql,limit=self.limit, length=self.pagesize)
         
         return dbh
 
+    def seek_rows(self, dbh, query):
+        """ Returns the rows of the page using keyset pagination, or
+        None if we can not for this table.
+
+        Rather than skipping over all the rows before the page (which
+        gets slower the deeper we page), we remember the sort value
+        and unique key of the last row of each page and ask for the
+        rows after it. Jumping to a page we have not seen skips rows
+        from the nearest page boundary we know.
+        """
+        if self.groupby or self._groupby: return None
+
+        ## The key must identify the rows of the result so we only
+        ## seek on single table queries:
+        tables = set([ e.join_table() for e in self.elements + self.filter_elements ])
+        if len(tables) != 1: return None
+        table = tables.pop()
+
+        try:
+            sort = self.elements[self.order].order_by()
+        except IndexError:
+            return None
+
+        key = unique_key(dbh, table)
+        if not key: return None
+        key = "`%s`.`%s`" % (table, key)
+
+        if self.direction == 1:
+            direction, op = "asc", ">"
+        else:
+            direction, op = "desc", "<"
+
+        sql = self._make_sql(query, ordering=False,
+                             columns = ((sort, "_sort"), (key, "_key")))
+        order = " order by %s %s, %s %s" % (sort, direction, key, direction)
+        cache_key = ResultCache.make_key(self.case, sql + order, 0, self.pagesize,
+                                         dbh.table_generations([table]))
+        try:
+            boundaries = BOUNDARIES.get(cache_key)
+        except KeyError:
+            boundaries = {0: None}
+            BOUNDARIES.put(boundaries, key=cache_key)
+
+        start = max([ b for b in boundaries.keys() if b <= self.limit ])
+        if boundaries[start]:
+            sql += "and %s " % seek_condition(sort, key, op, *boundaries[start])
+
+        dbh.cached_execute(sql + order, limit=self.limit - start, length=self.pagesize)
+        rows = [ row for row in dbh ]
+        if len(rows) == self.pagesize:
+            boundaries[self.limit + self.pagesize] = (rows[-1]['_sort'], rows[-1]['_key'])
+
+        return rows
+
+    def render_rows(self, rows, hiddens, result):
+        """ A generator of the html for each row """
+        old_sorted = None
+        old_sorted_style = ''
+
+        for row in rows:
+            tds = ''
+
+            ## Render each row at a time:
+            for i in range(len(self.elements)):
+                if i in hiddens: continue
+
+                ## Give the row to the column element to allow it
+                ## to translate the output suitably:
+                value = row[self.elements[i].name]
+                try:
+                    cell_ui = result.__class__(result)
+                    ## Elements are expected to render on cell_ui
+                    tmp = self.elements[i].display(value,row,cell_ui)
+                    if tmp: cell_ui = tmp
+                except Exception, e:
+                    pyflaglog.log(pyflaglog.ERROR, expand("Unable to render %r: %s" , (value , e)))
+
+                ## Render the row styles so that equal values on
+                ## the sorted column have the same style
+                if i==self.order and value!=old_sorted:
+                    old_sorted=value
+                    if old_sorted_style=='':
+                        old_sorted_style='alternateRow'
+                    else:
+                        old_sorted_style=''
+
+                ## Render the sorted column with a different style
+                if i==self.order:
+                    tds+="<td class='sorted-column'>%s</td>" % (FlagFramework.smart_unicode(cell_ui))
+                else:
+                    tds+=DB.expand("<td class='table-cell'>%s</td>",cell_ui)
+
+            yield "<tr class='%s'> %s </tr>\n" % (old_sorted_style,tds)
+
     def render_table(self, query, result):
         """ Renders the actual table itself """
         result.result+='''<table class="PyFlagTable" >
@@ -853,52 +1056,28 @@ class TableRenderer:
 
         result.result+='''</tr></thead><tbody class="scrollContent">'''
 
-        old_sorted = None
-        old_sorted_style = ''
-
-        ## Total number of rows
-        self.row_count=0
-
-        for row in g:
-            row_elements = []
-            tds = ''
-
-            ## Render each row at a time:
-            for i in range(len(self.elements)):
-                if i in hiddens: continue
-
-                ## Give the row to the column element to allow it
-                ## to translate the output suitably:
-                value = row[self.elements[i].name]
-                try:
-                    cell_ui = result.__class__(result)
-                    ## Elements are expected to render on cell_ui
-                    tmp = self.elements[i].display(value,row,cell_ui)
-                    if tmp: cell_ui = tmp
-                except Exception, e:
-                    pyflaglog.log(pyflaglog.ERROR, expand("Unable to render %r: %s" , (value , e)))
+        ## Fetching the page is quick - its rendering the cells which
+        ## takes the time:
+        rows = [ row for row in g ]
+        self.row_count = len(rows)
+        rows = self.render_rows(rows, hiddens, result)
 
-                ## Render the row styles so that equal values on
-                ## the sorted column have the same style
-                if i==self.order and value!=old_sorted:
-                    old_sorted=value
-                    if old_sorted_style=='':
-                        old_sorted_style='alternateRow'
-                    else:
-                        old_sorted_style=''
-
-                ## Render the sorted column with a different style
-                if i==self.order:
-                    tds+="<td class='sorted-column'>%s</td>" % (FlagFramework.smart_unicode(cell_ui))
-                else:
-                    tds+=DB.expand("<td class='table-cell'>%s</td>",cell_ui)
+        ## The rows may be rendered as the page is sent:
+        marker = None
+        if self.stream and config.TABLE_STREAM:
+            try:
+                marker = result.generator.defer(rows)
+            except AttributeError:
+                pass
 
-            result.result+="<tr class='%s'> %s </tr>\n" % (old_sorted_style,tds)
-            self.row_count += 1
+        if marker:
+            result.result += marker
+        else:
+            for row in rows:
+                result.result += row
 
         result.result+="</tbody></table>"
 
-
     def export_button(self, query, result):
         """ Provides an interface for exporting the table in a useful way """
 
@@ -30,41 +30,221 @@
 
 This is most useful when reading data structure with a fixed format (structs, arrays etc).
 """
-import struct,time,cStringIO
+import struct,time,cStringIO,os,mmap,weakref,threading
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Store as Store
 
 ## This is the default size that will be read when not specified
 DEFAULT_SIZE=600*1024*1024
 
+config.add_option("FORMAT_CACHE_SIZE", default=16*1024*1024, type='int',
+                  help="Maximum number of bytes of file pages cached for the file format parsers (0 disables the cache)")
+
+## Reads are done in pages of this size:
+PAGE_SIZE = 16 * 1024
+
+## Reads larger than this go straight to the file:
+MAX_CACHED_READ = 16 * PAGE_SIZE
+
+class PageCache(Store.Store):
+    """ A Store of file pages shared by all Buffers.
+
+    get() and put() are called for every page read, so unlike Store
+    they do not log. Pages never expire - they are only evicted when
+    the cache is full.
+    """
+    def __init__(self, max_bytes):
+        Store.Store.__init__(self, max_size=1e9, age=0, max_bytes=max_bytes)
+
+    def get(self, key):
+        self.mutex.acquire()
+        try:
+            try:
+                node = self.map[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self._unlink(node)
+            self._append(node)
+
+            return node[Store.OBJ]
+        finally:
+            self.mutex.release()
+
+    def put(self, page, key):
+        if len(page) > self.max_bytes:
+            return
+
+        self.mutex.acquire()
+        try:
+            try:
+                self._unlink(self.map[key])
+            except KeyError:
+                pass
+
+            self._append([None, None, key, page, 0, len(page)])
+            while self.bytes > self.max_bytes:
+                self._evict(self.root[Store.NEXT], "cache is full")
+        finally:
+            self.mutex.release()
+
+    def _evict(self, node, reason):
+        self._unlink(node)
+        self.evictions += 1
+
+PAGES = None
+
+def get_page_cache():
+    global PAGES
+
+    if PAGES is None:
+        PAGES = PageCache(config.FORMAT_CACHE_SIZE)
+
+    return PAGES
+
+class PageSource:
+    """ Reads data from a fd on behalf of Buffers.
+
+    Real files are memory mapped and read only string streams are
+    read directly. Other file like objects (e.g. VFS files) are read a
+    page at the time through the shared page cache, so parsers reading
+    small structures do not generate a read through the VFS for each
+    access.
+
+    We assume that the data in whole pages does not change. Partial
+    pages (at the end of the fd) are never cached, so fds which are
+    still growing are read correctly.
+    """
+    ## Sources get unique ids so page cache keys are never reused:
+    count = 0
+
+    def __init__(self, fd):
+        self.fd = fd
+        PageSource.count += 1
+        self.id = PageSource.count
+        self.data = None
+
+        ## Parsers tend to read close to their last read, so we keep
+        ## the last page at hand. The page number and its data are
+        ## kept in one tuple so threads sharing the source always see
+        ## a matching pair:
+        self.last = (None, None)
+        ## Protects the file position of fd:
+        self.lock = threading.Lock()
+
+        if isinstance(fd, file) and fd.mode.startswith('r') and '+' not in fd.mode:
+            try:
+                if os.fstat(fd.fileno()).st_size > 0:
+                    self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, mmap.error):
+                pass
+
+        elif isinstance(fd, cStringIO.InputType):
+            self.data = fd.getvalue()
+
+    def read(self, offset, length):
+        if offset < 0:
+            raise IOError("Invalid offset %s" % offset)
+
+        if self.data is not None:
+            return self.data[offset:offset+length]
+
+        cache = get_page_cache()
+        if length > MAX_CACHED_READ or not cache.max_bytes:
+            return self.read_fd(offset, length)
+
+        page = offset / PAGE_SIZE
+        last = (offset + length - 1) / PAGE_SIZE
+        start = offset - page * PAGE_SIZE
+
+        ## The common case of a read within a single page:
+        if page == last:
+            return self.read_page(page, cache)[start:start+length]
+
+        result = []
+        while page <= last:
+            data = self.read_page(page, cache)
+            result.append(data)
+            if len(data) < PAGE_SIZE: break
+            page += 1
+
+        return ''.join(result)[start:start+length]
+
+    def read_fd(self, offset, length):
+        self.lock.acquire()
+        try:
+            self.fd.seek(offset)
+            return self.fd.read(length)
+        finally:
+            self.lock.release()
+
+    def read_page(self, page, cache):
+        last_page, last_data = self.last
+        if page == last_page:
+            return last_data
+
+        key = (self.id, page)
+        try:
+            data = cache.get(key)
+        except KeyError:
+            data = self.read_fd(page * PAGE_SIZE, PAGE_SIZE)
+            if len(data) < PAGE_SIZE:
+                return data
+
+            cache.put(data, key)
+
+        self.last = (page, data)
+
+        return data
+
+## The page source of each fd (where the fd can be weakly referenced):
+SOURCES = weakref.WeakKeyDictionary()
+
+def get_source(fd):
+    try:
+        return SOURCES[fd]
+    except KeyError:
+        source = PageSource(fd)
+        SOURCES[fd] = source
+    except TypeError:
+        source = PageSource(fd)
+
+    return source
+
 class Buffer:
     """ This class looks very much like a string, but in fact uses a file object.
 
     The advantage here is that when we do string slicing, we are not duplicating strings all over the place (better performace). Also it is always possible to tell where a particular piece of data came from.
+
+    All Buffers over the same fd share a PageSource which reads the
+    data (see above), and slices are just new views of the source.
     """
-    def __init__(self,fd,offset=0,size=None):
+    def __init__(self,fd,offset=0,size=None,source=None):
         """ We can either specify a string, or a fd as the first arg """
         self.offset=offset
         self.fd=fd
+        self.source = source or get_source(fd)
         if size!=None:
             self.size=size
         else:
-            self.fd=fd
-            if size!=None:
-                self.size=size
-            else:
-                ## Try to calculate the size by seeking the fd to the end
-                offset = fd.tell()
-                try:
-                    fd.seek(0,2)
-                except Exception,e:
-                    print "%s: %r" % (e,fd)
-                self.size=fd.tell()
-                fd.seek(offset)
+            ## Try to calculate the size by seeking the fd to the end
+            offset = fd.tell()
+            try:
+                fd.seek(0,2)
+            except Exception,e:
+                print "%s: %r" % (e,fd)
+            self.size=fd.tell()
+            fd.seek(offset)
 
 #        if self.size<0:
 #            raise IOError("Unable to set negative size (%s) for buffer (offset was %s)" % (self.size,self.offset))
         
     def clone(self):
-        return self.__class__(fd=self.fd, offset=self.offset, size=self.size)
+        return self.__class__(fd=self.fd, offset=self.offset, size=self.size,
+                              source=self.source)
 
     def __len__(self):
         return self.size
@@ -74,13 +254,11 @@ class Buffer:
 
         It is useful in files which specify an absolute offset into the file within some of the data structures.
         """
-        return self.__class__(fd=self.fd,offset=offset)
+        return self.__class__(fd=self.fd,offset=offset, source=self.source)
 
     def __getitem__(self,offset):
         """ Return a single char from the string """
-        self.fd.seek(offset+self.offset)
-        return self.fd.read(1)
-
+        return self.source.read(offset+self.offset, 1)
 
     ## FIXME: Python slicing will only pass uint_32 using the syntax
     def __getslice__(self,a=0,b=None):
@@ -91,16 +269,17 @@ class Buffer:
         if b:
             if b>self.size:
                 b=self.size
-            return self.__class__(fd=self.fd,offset=self.offset+a,size=b-a)
+            return self.__class__(fd=self.fd,offset=self.offset+a,size=b-a,
+                                  source=self.source)
         else:
-            return self.__class__(fd=self.fd,offset=self.offset+a)
+            return self.__class__(fd=self.fd,offset=self.offset+a,
+                                  source=self.source)
 
     def __str__(self):
-        self.fd.seek(self.offset)
         if self.size>=0:
-            data=self.fd.read(self.size)
+            data=self.source.read(self.offset, self.size)
         else:
-            data=self.fd.read(DEFAULT_SIZE)
+            data=self.source.read(self.offset, DEFAULT_SIZE)
             
 #        if len(data) < self.size:
 #            raise IOError("Unable to read %s bytes from %s" %(self.size,self.offset))
@@ -204,3 +383,46 @@ class RAW(DataType):
                 tmp.append('.')
 
         return ''.join(tmp)
+
+## Unit tests:
+import unittest, random, tempfile
+
+class Proxy:
+    """ A file like object which is not a real file (like a VFS file) """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def seek(self, offset, whence=0):
+        self.fd.seek(offset, whence)
+
+    def tell(self):
+        return self.fd.tell()
+
+    def read(self, length=None):
+        return self.fd.read(length)
+
+class BufferTests(unittest.TestCase):
+    """ Buffer reads through the different page sources """
+    def test01Reads(self):
+        """ Test that all sources return the same data """
+        random.seed(1)
+        data = ''.join([ chr(random.randint(0, 255)) for i in range(5 * PAGE_SIZE + 100) ])
+        tmp = tempfile.TemporaryFile()
+        tmp.write(data)
+        tmp.flush()
+        fd = os.fdopen(os.dup(tmp.fileno()), 'rb')
+
+        for f in (fd, cStringIO.StringIO(data), Proxy(tmp)):
+            b = Buffer(fd=f)
+            self.assertEqual(len(b), len(data))
+            for i in range(200):
+                offset = random.randint(0, len(data) + 10)
+                length = random.randint(0, 3 * PAGE_SIZE)
+                self.assertEqual(b[offset:offset+length].__str__(),
+                                 data[offset:offset+length])
+                self.assertEqual(b[offset], data[offset:offset+1])
+
+            self.assertEqual(b[PAGE_SIZE:].__str__(), data[PAGE_SIZE:])
+
+        self.assert_(get_source(fd).data is not None)
+        self.assertEqual(get_source(Proxy(tmp)).data, None)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Runs the standard performance scenarios and flags regressions.
+
+Use this program like so:
+
+>>> pyflag_launch benchmark_suite.py --runs 3 --save_baseline
+
+>>> pyflag_launch benchmark_suite.py --scenario scan --scenario paging
+
+Each scenario is run in a new python process (with its own workers)
+against the test images in the upload directory:
+
+ - load: Load the DFTT keyword image through Sleuthkit.
+ - scan: Scan the loaded image with the default scanners.
+ - pcap: Load stdcapture_0.3.pcap through the PCAP filesystem.
+ - log: Load a log file with a newly created preset.
+ - index: List the hits of the DFTT keywords in every inode.
+ - paging: Render pages of the Browse Types table.
+
+We report the best time and the peak resident memory (of the process
+and all its workers) for each scenario. Every result is appended to
+the history file, one tab seperated line per scenario:
+
+  time, version, scenario, runs, seconds, peak rss (kb)
+
+Results more than tolerance percent slower (or larger) than the
+baseline are flagged as regressions and we exit with status 1. The
+baseline has the same format as the history and is written by
+--save_baseline.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import sys, os, time, subprocess, resource
+
+config.set_usage(usage="""%prog [options]
+
+Runs the standard performance scenarios and compares them to a baseline.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+SCENARIOS = [ "load", "scan", "pcap", "log", "index", "paging" ]
+
+config.add_option('scenario', default=[], action='append',
+                  help = "Scenario to run (may be given more than once, default all of %s)" % ",".join(SCENARIOS))
+
+config.add_option('runs', default=1, type='int',
+                  help = "Number of times to run each scenario")
+
+config.add_option('history', default=os.path.join(config.RESULTDIR, "benchmark_history.txt"),
+                  help = "File to append the results to")
+
+config.add_option('baseline', default=os.path.join(config.RESULTDIR, "benchmark_baseline.txt"),
+                  help = "File with the baseline results")
+
+config.add_option('save_baseline', default=False, action='store_true',
+                  help = "Store these results as the new baseline")
+
+config.add_option('tolerance', default=20, type='int',
+                  help = "Percentage above the baseline which is considered a regression")
+
+config.add_option('log', default="IIS Log:pyflag_iis_standard_log.gz",
+                  help = "Log driver and log file for the log scenario as driver:filename")
+
+config.add_option('pages', default=10, type='int',
+                  help = "Number of pages to render in the paging scenario")
+
+config.add_option('child', default=None,
+                  help = "Run one scenario in this process (used internally)")
+
+config.parse_options()
+
+DISK_CASE = "PyFlagBenchmarkCase"
+PCAP_CASE = "PyFlagBenchmarkPCAP"
+DISK_IMAGE = "2-kwsrch-fat/fat-img-kw.dd"
+PCAP_IMAGE = "stdcapture_0.3.pcap"
+PRESET = "PyFlagBenchmark"
+KEYWORDS = [ "first", "SECOND", "1cross1", "2cross2", "1slack1", "deleted",
+             "1fragment1" ]
+
+def peak_rss():
+    """ The peak resident size (in kb) of this process and any of its
+    descendants (our workers) which are still running.
+    """
+    result = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parents = {}
+    try:
+        for pid in os.listdir("/proc"):
+            try:
+                ppid = int(open("/proc/%s/stat" % pid).read().rsplit(")",1)[1].split()[1])
+                parents.setdefault(ppid, []).append(int(pid))
+            except (ValueError, IndexError, IOError):
+                pass
+    except OSError:
+        return result
+
+    pids = list(parents.get(os.getpid(), []))
+    while pids:
+        pid = pids.pop()
+        pids.extend(parents.get(pid, []))
+        try:
+            for line in open("/proc/%s/status" % pid):
+                if line.startswith("VmHWM:"):
+                    result = max(result, int(line.split()[1]))
+        except IOError:
+            pass
+
+    return result
+
+if config.child:
+    Registry.Init()
+    import pyflag.pyflagsh as pyflagsh
+    import pyflag.DB as DB
+    import pyflag.FlagFramework as FlagFramework
+    import pyflag.Farm as Farm
+
+    Farm.start_workers()
+
+    def execute(report, **args):
+        pyflagsh.shell_execv(command="execute",
+                             argv=[report] + [ "%s=%s" % x for x in args.items() ])
+
+    def scan(case, *scanners):
+        pyflagsh.shell_execv(env=pyflagsh.environment(case=case), command="scan",
+                             argv=["*"] + list(scanners))
+
+    def load(case, filename, subsys, fstype):
+        try:
+            execute("Case Management.Remove case", remove_case=case)
+        except: pass
+
+        execute("Case Management.Create new case", create_case=case, TZ="SYSTEM")
+        execute("Load Data.Load IO Data Source", case=case, iosource="test",
+                subsys=subsys, filename=filename, offset=0, TZ="SYSTEM")
+        execute("Load Data.Load Filesystem image", case=case, iosource="test",
+                fstype=fstype, mount_point="/")
+
+    def load_disk():
+        import pyflag.Indexing as Indexing
+
+        ## The words must be in the dictionary before we scan:
+        for word in KEYWORDS:
+            Indexing.insert_dictionary_word(word, 'literal', classification='Benchmark')
+
+        load(DISK_CASE, DISK_IMAGE, "Standard", "Sleuthkit")
+
+    def default_scanners():
+        return [ s.name for s in Registry.SCANNERS.classes if s.default ]
+
+    def scanned_disk():
+        """ Makes sure the disk case is loaded and scanned """
+        try:
+            dbh = DB.DBO(DISK_CASE)
+            dbh.execute("select count(*) as count from type")
+            if dbh.fetch()['count'] > 0: return
+        except Exception:
+            pass
+
+        load_disk()
+        scan(DISK_CASE, *default_scanners())
+
+    ## Set up the scenario (this is not timed) and return a callable
+    ## which runs it:
+    if config.child == 'load':
+        run = load_disk
+
+    elif config.child == 'scan':
+        load_disk()
+        scanners = default_scanners()
+        run = lambda: scan(DISK_CASE, *scanners)
+
+    elif config.child == 'pcap':
+        run = lambda: load(PCAP_CASE, PCAP_IMAGE, "Advanced", "PCAP Filesystem")
+
+    elif config.child == 'log':
+        import pyflag.LogFile as LogFile
+
+        driver, filename = config.log.split(":", 1)
+        try:
+            execute("Case Management.Create new case", create_case=DISK_CASE, TZ="SYSTEM")
+        except: pass
+
+        log = Registry.LOG_DRIVERS.dispatch(driver)(case=DISK_CASE)
+        log.parse(FlagFramework.query_type(datafile=filename, log_preset=PRESET))
+        log.store(PRESET)
+        LogFile.drop_table(DISK_CASE, PRESET)
+
+        def run():
+            log = LogFile.load_preset(DISK_CASE, PRESET, [filename])
+            for progress in log.load(PRESET):
+                pass
+
+    elif config.child == 'index':
+        import pyflag.Indexing as Indexing
+
+        scanned_disk()
+        dbh = DB.DBO(DISK_CASE)
+        dbh.execute("select inode_id from inode")
+        inode_ids = [ row['inode_id'] for row in dbh ]
+
+        def run():
+            for word in KEYWORDS:
+                for inode_id in inode_ids:
+                    for hit in Indexing.list_hits(DISK_CASE, inode_id, word):
+                        pass
+
+    elif config.child == 'paging':
+        import pyflag.HTMLUI as HTMLUI
+
+        scanned_disk()
+
+        def run():
+            report_cls = Registry.REPORTS.dispatch('Disk Forensics', 'Browse Types')
+            for page in range(config.pages):
+                query = FlagFramework.query_type(family='Disk Forensics',
+                                                 report='Browse Types',
+                                                 case=DISK_CASE)
+                query.set('limit', page * config.PAGESIZE)
+                result = HTMLUI.HTMLUI(query=query, initial=True)
+                report = report_cls(None, ui=result)
+                report.display(query, result)
+                result.display()
+
+    else:
+        print "Unknown scenario %s" % config.child
+        sys.exit(1)
+
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+
+    print elapsed, peak_rss()
+    sys.exit(0)
+
+def run(scenario):
+    p = subprocess.Popen([ sys.executable, sys.argv[0], "--child", scenario,
+                           "--log", config.log, "--pages", str(config.pages) ],
+                         stdout = subprocess.PIPE)
+    output = p.communicate()[0]
+    if p.returncode:
+        raise RuntimeError("Scenario %s failed" % scenario)
+
+    elapsed, rss = output.strip().splitlines()[-1].split()
+    return float(elapsed), int(rss)
+
+def read_results(filename):
+    """ Returns the last result for each scenario in filename as a
+    dict of (seconds, rss).
+    """
+    result = {}
+    try:
+        fd = open(filename)
+    except IOError:
+        return result
+
+    for line in fd:
+        fields = line.rstrip("\n").split("\t")
+        try:
+            result[fields[2]] = (float(fields[4]), int(fields[5]))
+        except (IndexError, ValueError):
+            pass
+
+    return result
+
+def format_results(now, results):
+    return "".join([ "%s\t%s\t%s\t%s\t%.3f\t%s\n" % (
+        now, config.VERSION, scenario, config.runs, seconds, rss)
+                     for scenario, seconds, rss in results ])
+
+def regressed(value, baseline):
+    return baseline and value > baseline * (100 + config.tolerance) / 100.0
+
+baseline = read_results(config.baseline)
+results = []
+regressions = 0
+
+print "%10s %10s %10s %12s %12s" % ("Scenario", "Best (s)", "Base (s)", "RSS (kb)", "Base (kb)")
+for scenario in config.scenario or SCENARIOS:
+    times = []
+    rss = 0
+    for i in range(config.runs):
+        elapsed, r = run(scenario)
+        times.append(elapsed)
+        rss = max(rss, r)
+
+    seconds = min(times)
+    results.append((scenario, seconds, rss))
+
+    base_seconds, base_rss = baseline.get(scenario, (0, 0))
+    flags = []
+    if regressed(seconds, base_seconds): flags.append("time")
+    if regressed(rss, base_rss): flags.append("memory")
+    regressions += len(flags)
+
+    print "%10s %10.3f %10.3f %12s %12s %s" % (
+        scenario, seconds, base_seconds, rss, base_rss,
+        flags and "REGRESSION (%s)" % ",".join(flags) or "")
+
+now = time.strftime("%Y-%m-%d %H:%M:%S")
+fd = open(config.history, "a")
+fd.write(format_results(now, results))
+fd.close()
+
+if config.save_baseline:
+    ## Keep the baseline of scenarios we did not run:
+    for scenario, seconds, rss in results:
+        baseline[scenario] = (seconds, rss)
+
+    fd = open(config.baseline, "w")
+    fd.write(format_results(now, [ (s, seconds, rss) for s, (seconds, rss)
+                                   in baseline.items() ]))
+    fd.close()
+
+if regressions:
+    sys.exit(1)
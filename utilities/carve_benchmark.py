@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures carving throughput as the number of signatures grows.
+
+Use this program like so:
+
+>>> pyflag_launch carve_benchmark.py --size 64 --counts 1,4,16,64
+
+We make up random data and random signatures and report the
+throughput (in MB/s) of a single CarveEngine pass over the data, and
+of searching for each signature separately with a regex (as the
+carvers used to). The engine's throughput should stay flat as
+signatures are added.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.CarveEngine as CarveEngine
+import random, time, re
+
+config.set_usage(usage="""%prog [options]
+
+Measures carving throughput for different numbers of signatures.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('size', default=64, type='int',
+                  help = "Size of the data to carve in mb")
+
+config.add_option('counts', default='1,4,16,64',
+                  help = "Comma seperated list of signature counts to test")
+
+config.parse_options()
+
+BLOCKSIZE = 1024 * 1024
+
+def make_signature():
+    return "".join([ "\\x%02x" % random.randint(0, 255) for i in range(6) ])
+
+def time_engine(data, signatures):
+    engine = CarveEngine.CarveEngine()
+    for s in signatures:
+        engine.add(s, s)
+
+    start = time.time()
+    stream = engine.stream()
+    for i in range(0, len(data), BLOCKSIZE):
+        stream.process(data[i:i+BLOCKSIZE])
+
+    stream.finish()
+    return time.time() - start
+
+def time_regexes(data, signatures):
+    regexes = [ re.compile(s) for s in signatures ]
+    start = time.time()
+    for i in range(0, len(data), BLOCKSIZE):
+        block = data[i:i+BLOCKSIZE]
+        for r in regexes:
+            for m in r.finditer(block): pass
+
+    return time.time() - start
+
+random.seed(1)
+data = "".join([ chr(random.randint(0, 255)) for i in range(BLOCKSIZE) ]) * config.size
+mb = len(data) / 1024.0 / 1024
+
+print "%12s %16s %16s" % ("Signatures", "Engine (MB/s)", "Regexes (MB/s)")
+for count in config.counts.split(","):
+    signatures = [ make_signature() for i in range(int(count)) ]
+    print "%12s %16.1f %16.1f" % (count, mb / time_engine(data, signatures),
+                                  mb / time_regexes(data, signatures))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the job claiming throughput of the Farm.
+
+Use this program like so:
+
+>>> pyflag_launch farm_benchmark.py --workers 1,2,4,8,16 --jobs 20000
+
+A scratch copy of the jobs table is filled with empty jobs, and the
+requested number of worker processes drain it using the same lease
+and acknowledge calls as Farm.worker_run. We report the number of
+jobs per second for each worker count. The --legacy option measures
+the old lock tables based claiming for comparison.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.Farm as Farm
+import os, sys, time
+
+config.set_usage(usage="""%prog [options]
+
+Measures Farm job claiming throughput against the number of workers.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('workers', default='1,2,4,8,16',
+                  help = "Comma seperated list of worker counts to test")
+
+config.add_option('jobs', default=10000, type='int',
+                  help = "Number of jobs to process in each run")
+
+config.add_option('legacy', default=False, action='store_true',
+                  help = "Use the old lock tables based job claiming")
+
+Registry.Init()
+config.parse_options()
+
+TABLE = "bench_jobs"
+
+def fill_queue(count):
+    dbh = DB.DBO()
+    dbh.execute("drop table if exists %s", TABLE)
+    dbh.execute("create table %s like jobs", TABLE)
+    dbh.mass_insert_start(TABLE, _fast=True)
+    for i in range(count):
+        dbh.mass_insert(command = 'Noop', arg1 = i, state = 'pending',
+                        cookie = 0)
+    dbh.mass_insert_commit()
+
+def legacy_claim(dbh):
+    """ This is how workers used to claim jobs """
+    dbh.execute("lock tables %s write", TABLE)
+    try:
+        dbh.execute("select * from %s where state='pending' limit %s",
+                    (TABLE, config.JOB_QUEUE))
+        jobs = [ row for row in dbh ]
+        for row in jobs:
+            dbh.execute("update %s set state='processing', pid=%r where id=%r",
+                        (TABLE, os.getpid(), row['id']))
+    finally:
+        dbh.execute("unlock tables")
+
+    for row in jobs:
+        dbh.execute("delete from %s where id=%r", (TABLE, row['id']))
+
+    return jobs
+
+def lease_claim(dbh):
+    lease_id, jobs = Farm.claim_jobs(dbh, TABLE, config.JOB_QUEUE)
+    Farm.acknowledge_jobs(dbh, TABLE, [ row['id'] for row in jobs ])
+
+    return jobs
+
+def worker(claim):
+    ## Each process needs its own connections
+    DB.DBO.DBH.flush()
+    DB.mysql_connection_args = None
+    dbh = DB.DBO()
+    while 1:
+        if not claim(dbh): break
+
+def run(workers):
+    fill_queue(config.jobs)
+    if config.legacy:
+        claim = legacy_claim
+    else:
+        claim = lease_claim
+
+    start = time.time()
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if not pid:
+            try:
+                worker(claim)
+            finally:
+                os._exit(0)
+
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    return time.time() - start
+
+print "%8s %10s %12s" % ("Workers", "Seconds", "Jobs/sec")
+for workers in config.workers.split(","):
+    workers = int(workers)
+    elapsed = run(workers)
+    print "%8s %10.2f %12.1f" % (workers, elapsed, config.jobs / elapsed)
+
+DB.DBO().execute("drop table if exists %s", TABLE)
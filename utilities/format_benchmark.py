@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Times the file format parsers with and without the page cache.
+
+Use this program like so:
+
+>>> pyflag_launch format_benchmark.py --hive NTUSER.DAT --pst outlook.pst
+
+We parse each file three ways:
+
+ - uncached: every access reads from the file (as Buffers used to).
+ - cached: the file is read through the shared page cache (as
+   happens for files in the VFS).
+ - mmap: the file is memory mapped.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.format as format
+from FileFormats.RegFile import RegF, ls_r
+from FileFormats.PST import PSTHeader
+import time, sys
+
+config.set_usage(usage="""%prog [options]
+
+Times parsing registry hives and PST files.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('hive', default=None,
+                  help = "Registry hive to parse")
+
+config.add_option('pst', default=None,
+                  help = "PST file to parse")
+
+config.parse_options()
+
+class File:
+    """ A file like object which is not a real file, so it can not be
+    memory mapped (like a VFS file)
+    """
+    def __init__(self, filename):
+        self.fd = open(filename, 'rb')
+
+    def seek(self, offset, whence=0):
+        self.fd.seek(offset, whence)
+
+    def tell(self):
+        return self.fd.tell()
+
+    def read(self, length=None):
+        return self.fd.read(length)
+
+def parse_hive(b):
+    def cb(nk_key, path=''):
+        for value in nk_key.values():
+            value['data']
+
+    ls_r(RegF(b).root_key, cb=cb)
+
+def parse_pst(b):
+    PSTHeader(b).find_descriptors()
+
+def time_parse(filename, parse):
+    results = []
+    for name, cache_size, fd in (("uncached", 0, File(filename)),
+                                 ("cached", config.FORMAT_CACHE_SIZE, File(filename)),
+                                 ("mmap", 0, open(filename, 'rb'))):
+        format.PAGES = format.PageCache(cache_size)
+        start = time.time()
+        parse(format.Buffer(fd=fd))
+        results.append((name, time.time() - start))
+
+    return results
+
+print "%10s %10s %10s" % ("File", "Mode", "Time (s)")
+for filename, parse in ((config.hive, parse_hive), (config.pst, parse_pst)):
+    if not filename: continue
+
+    for name, t in time_parse(filename, parse):
+        print "%10s %10s %10.3f" % (filename[-10:], name, t)
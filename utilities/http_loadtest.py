@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the latency of the pyflag web server under load.
+
+Use this program like so:
+
+>>> pyflag_launch http_loadtest.py --clients 10 --requests 100 --url /images/logo.png --url "/?family=Disk%20Forensics&report=BrowseFS&case=demo"
+
+Each client is a thread with its own keep-alive connection, which
+requests the urls in turn. We report the number of requests per second
+and the median (p50) and 99th percentile (p99) latency for each url.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import threading, httplib, time
+
+config.set_usage(usage="""%prog [options]
+
+Measures the web server's latency with many concurrent clients.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('host', default='127.0.0.1',
+                  help = "The host the server is running on")
+
+config.add_option('port', default=8000, type='int',
+                  help = "The port the server is listening on")
+
+config.add_option('url', default=[], action='append',
+                  help = "Url to request (may be given many times)")
+
+config.add_option('clients', default=10, type='int',
+                  help = "Number of concurrent clients")
+
+config.add_option('requests', default=100, type='int',
+                  help = "Number of requests each client makes")
+
+config.add_option('gzip', default=False, action='store_true',
+                  help = "Accept gzip encoded responses")
+
+config.parse_options()
+
+## Latencies for each url:
+latencies = {}
+errors = []
+lock = threading.Lock()
+
+def client():
+    connection = httplib.HTTPConnection(config.host, config.port)
+    headers = {}
+    if config.gzip:
+        headers['Accept-Encoding'] = 'gzip'
+
+    result = {}
+    for i in range(config.requests):
+        url = config.url[i % len(config.url)]
+        start = time.time()
+        try:
+            connection.request("GET", url, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                raise IOError("%s returned %s" % (url, response.status))
+
+            ## The server may not keep the connection open:
+            if response.will_close:
+                connection.close()
+                connection = httplib.HTTPConnection(config.host, config.port)
+        except (IOError, httplib.HTTPException), e:
+            lock.acquire()
+            errors.append(str(e))
+            lock.release()
+            connection.close()
+            connection = httplib.HTTPConnection(config.host, config.port)
+            continue
+
+        result.setdefault(url, []).append(time.time() - start)
+
+    connection.close()
+    lock.acquire()
+    for url, times in result.items():
+        latencies.setdefault(url, []).extend(times)
+    lock.release()
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+if not config.url:
+    config.url = ['/']
+
+start = time.time()
+threads = [ threading.Thread(target=client) for i in range(config.clients) ]
+for t in threads:
+    t.start()
+
+for t in threads:
+    t.join()
+
+elapsed = time.time() - start
+total = sum([ len(times) for times in latencies.values() ])
+
+print "%s clients, %s requests in %.2f s (%.1f requests/s), %s errors" % (
+    config.clients, total, elapsed, total / elapsed, len(errors))
+
+print "%10s %10s %10s  %s" % ("Requests", "p50 (ms)", "p99 (ms)", "Url")
+for url in config.url:
+    times = latencies.get(url, [])
+    if not times: continue
+
+    times.sort()
+    print "%10s %10.1f %10.1f  %s" % (len(times), percentile(times, 50) * 1000,
+                                      percentile(times, 99) * 1000, url[:60])
@@ -307,6 +307,7 @@ def run(keepalive=None):
                        files_we_have.add(f)
 
                    load_file(filename, processor, pcap_dbh)
+                   pcapfs.flush_writers()
 
                    last_time = time.time()
             else:
@@ -330,6 +331,7 @@ def run(keepalive=None):
             if time.time() - last_time > config.timeout:
                 print "Flushing reassembler"
                 processor.flush()
+                pcapfs.flush_writers()
                 last_time = time.time()
 
         print "%s: Sleeping for %s seconds" % (time.ctime(), config.sleep)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Compares the keyword index backends.
+
+Use this program like so:
+
+>>> pyflag_launch index_benchmark.py --case PyFlagTestCase --inodes 1000 --hits 1000
+
+We make up random hits for a number of inodes and words and store them
+both in a scratch copy of the LogicalIndexOffsets table and in a
+posting index in a temporary directory. We then report the size of
+each index and the average time to list the hits of a word within an
+inode.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.PostingIndex as PostingIndex
+import random, time, tempfile, shutil
+
+config.set_usage(usage="""%prog [options]
+
+Compares the size and query latency of the keyword index backends.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('case', default=None,
+                  help = "Case to create the scratch table in")
+
+config.add_option('inodes', default=1000, type='int',
+                  help = "Number of inodes to index")
+
+config.add_option('words', default=20, type='int',
+                  help = "Number of words in the dictionary")
+
+config.add_option('hits', default=100, type='int',
+                  help = "Average number of hits per word per inode")
+
+config.add_option('queries', default=1000, type='int',
+                  help = "Number of queries to time")
+
+Registry.Init()
+config.parse_options()
+
+if not config.case:
+    print "You must specify a case"
+    raise SystemExit(1)
+
+TABLE = "bench_LogicalIndexOffsets"
+
+def make_hits():
+    for inode_id in range(1, config.inodes + 1):
+        for word_id in range(1, config.words + 1):
+            offset = 0
+            for i in range(random.randint(0, 2 * config.hits)):
+                offset += random.randint(1, 10000)
+                yield inode_id, word_id, offset, random.randint(3, 20)
+
+def load_table():
+    dbh = DB.DBO(config.case)
+    dbh.execute("drop table if exists %s", TABLE)
+    dbh.execute("create table %s like LogicalIndexOffsets", TABLE)
+    dbh.execute("alter table %s add index(inode_id, word_id)", TABLE)
+    dbh.mass_insert_start(TABLE, _fast=True)
+    for inode_id, word_id, offset, length in make_hits():
+        dbh.mass_insert(inode_id = inode_id, word_id = word_id,
+                        offset = offset, length = length)
+    dbh.mass_insert_commit()
+
+    dbh.execute("show table status like %r", TABLE)
+    row = dbh.fetch()
+    return row['Data_length'] + row['Index_length']
+
+def load_posting(directory):
+    writer = PostingIndex.SegmentWriter("%s/0.seg" % directory)
+    inodes = set()
+    hits = {}
+    for inode_id, word_id, offset, length in make_hits():
+        inodes.add(inode_id)
+        hits.setdefault((word_id, inode_id), []).append((offset, length))
+
+    for (word_id, inode_id), h in hits.items():
+        writer.add(word_id, inode_id, h)
+
+    writer.cover(inodes)
+    writer.close()
+
+    return PostingIndex.PostingIndex(directory)
+
+def time_queries(list_hits):
+    queries = [ (random.randint(1, config.inodes), random.randint(1, config.words))
+                for i in range(config.queries) ]
+    start = time.time()
+    for inode_id, word_id in queries:
+        for hit in list_hits(inode_id, word_id): pass
+
+    return (time.time() - start) * 1000 / config.queries
+
+def table_list_hits(inode_id, word_id, dbh = DB.DBO(config.case)):
+    dbh.execute("select offset,length from %s where inode_id = %r and word_id = %r order by offset",
+                (TABLE, inode_id, word_id))
+    return dbh
+
+random.seed(1)
+table_size = load_table()
+table_time = time_queries(table_list_hits)
+
+random.seed(1)
+directory = tempfile.mkdtemp()
+try:
+    index = load_posting(directory)
+    posting_size = index.size()
+    posting_time = time_queries(index.list_hits)
+finally:
+    shutil.rmtree(directory)
+
+DB.DBO(config.case).execute("drop table if exists %s", TABLE)
+
+print "%10s %14s %14s" % ("Backend", "Size (bytes)", "Query (ms)")
+print "%10s %14s %14.3f" % ("table", table_size, table_time)
+print "%10s %14s %14.3f" % ("posting", posting_size, posting_time)
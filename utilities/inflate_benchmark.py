@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Times random reads from gzip files.
+
+Use this program like so:
+
+>>> pyflag_launch inflate_benchmark.py --size 64 --intervals 1,4,16,0
+
+We make up a gzip file of the given size (in mb of uncompressed
+data), and time random reads from it for each checkpoint interval (in
+mb). An interval of 0 disables checkpoints, so every read decompresses
+the file from the start.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.DeflateIndex as DeflateIndex
+import random, time, tempfile, gzip, os
+
+config.set_usage(usage="""%prog [options]
+
+Times random reads from gzip files for different checkpoint intervals.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('size', default=64, type='int',
+                  help = "Size of the uncompressed data in mb")
+
+config.add_option('intervals', default='1,4,16,0',
+                  help = "Comma seperated list of checkpoint intervals (in mb) to test")
+
+config.add_option('reads', default=100, type='int',
+                  help = "Number of random reads to time for each interval")
+
+config.add_option('length', default=4096, type='int',
+                  help = "Length of each read")
+
+config.parse_options()
+
+def make_file():
+    fd, filename = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+
+    words = [ "%x" % random.randint(0, 1 << 20) for i in range(10000) ]
+    gz = gzip.GzipFile(filename, 'wb')
+    size = 0
+    while size < config.size * 1024 * 1024:
+        data = " ".join([ random.choice(words) for i in range(10000) ])
+        gz.write(data)
+        size += len(data)
+
+    gz.close()
+
+    return filename, size
+
+def time_reads(filename, size, interval):
+    DeflateIndex.STREAMS.flush()
+    DeflateIndex.WINDOWS = None
+
+    fd = open(filename, 'rb')
+    reader = DeflateIndex.InflateReader(fd, filename, wbits=DeflateIndex.GZIP,
+                                        interval = interval * 1024 * 1024 or size + 1)
+
+    ## The first pass builds the index:
+    start = time.time()
+    reader.get_size()
+    index_time = time.time() - start
+
+    offsets = [ random.randint(0, size - config.length) for i in range(config.reads) ]
+    start = time.time()
+    for offset in offsets:
+        reader.seek(offset)
+        reader.read(config.length)
+
+    read_time = time.time() - start
+    fd.close()
+
+    return index_time, read_time * 1000 / config.reads
+
+random.seed(1)
+filename, size = make_file()
+try:
+    print "%10s %16s %16s" % ("Interval", "First pass (s)", "Read (ms)")
+    for interval in config.intervals.split(","):
+        index_time, read_time = time_reads(filename, size, int(interval))
+        print "%10s %16.2f %16.2f" % (interval, index_time, read_time)
+finally:
+    os.unlink(filename)
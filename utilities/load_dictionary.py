@@ -90,20 +90,23 @@ dbh.execute(
     )""")
 
 count=0
-for file in args[0:]:
-    fd=open(file)
-    print "Reading File %s" % file
+def read_words(fd):
+    global count
+    
     for line in fd:
         if len(line)>3:
-            try:
-                dbh.execute("insert into dictionary set word=\"%s\",class=\"%s\",type=%r" %
-                            (DB.escape(line.strip()),wordclass,type))
-                count+=1
-            except DB.DBError:
-                pass
+            yield (line.strip(), wordclass, type)
+            count+=1
 
             if (count % 1000) == 0:
                 sys.stdout.write("Added %s words\r" % count)
                 sys.stdout.flush()
-                
+
+for file in args[0:]:
+    fd=open(file)
+    print "Reading File %s" % file
+    ## The words are sent to the database as multi row inserts:
+    dbh.executemany("insert ignore into dictionary (word, class, type) values (%r,%r,%r)",
+                    read_words(fd))
+    dbh.invalidate("dictionary")
     fd.close()
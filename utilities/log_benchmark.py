@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the rate at which log files are loaded.
+
+Use this program like so:
+
+>>> pyflag_launch log_benchmark.py --case demo --preset apache:access.log --preset iis:ex0801.log
+
+Each log file is loaded with its preset (and so its log driver) twice:
+Once with insert statements and once bulk loaded using LOAD DATA
+LOCAL INFILE. We report the rows loaded per second for each.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.LogFile as LogFile
+import pyflag.DB as DB
+import time
+
+Registry.Init()
+
+config.set_usage(usage="""%prog [options]
+
+Measures the rate at which log files are loaded for each log driver.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('case', default=None,
+                  help = "Case to load the logs into (mandatory). Case must have been created already.")
+
+config.add_option('preset', default=[], action='append',
+                  help = "A preset and the log file to load with it as preset:filename (may be given more than once)")
+
+config.parse_options()
+
+if not config.case or not config.preset:
+    print "You must specify a case and at least one preset"
+    raise SystemExit(1)
+
+def time_load(preset, filename, bulk):
+    log = LogFile.load_preset(config.case, preset, [filename])
+    dbh = DB.DBO(config.case)
+    table = dbh.get_temp()
+
+    try:
+        start = time.time()
+        for progress in log.load(table, bulk=bulk):
+            pass
+
+        elapsed = time.time() - start
+        dbh.execute("select count(*) as count from `%s_log`", table)
+        count = dbh.fetch()['count']
+    finally:
+        LogFile.drop_table(config.case, table)
+
+    return count, elapsed
+
+print "%16s %16s %10s %16s %16s" % ("Preset", "Driver", "Rows", "Insert (rows/s)", "Bulk (rows/s)")
+for arg in config.preset:
+    preset, filename = arg.split(":", 1)
+    driver = LogFile.load_preset(config.case, preset).__class__.name
+    result = []
+    for bulk in (False, True):
+        count, elapsed = time_load(preset, filename, bulk)
+        result.append(count / max(elapsed, 1e-6))
+
+    print "%16s %16s %10s %16.0f %16.0f" % (preset, driver, count, result[0], result[1])
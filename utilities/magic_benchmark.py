@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how quickly files are classified by magic.
+
+Use this program like so:
+
+>>> pyflag_launch magic_benchmark.py --case demo --count 5000
+
+We read the headers of the first count files in the case (a loaded
+test image) and report the files per second classified:
+
+ - all handlers: every handler scores the data before the signatures
+   are checked (as the resolver used to).
+ - two tier: the signatures are checked first, and the handlers only
+   score files which the signatures do not decide.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.FileSystem as FileSystem
+import pyflag.Magic as Magic
+import time
+
+config.set_usage(usage="""%prog [options]
+
+Measures magic classification throughput.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('case', default=None,
+                  help = "Case to take files from")
+
+config.add_option('count', default=5000, type='int',
+                  help = "Number of files to classify")
+
+config.parse_options()
+
+if not config.case:
+    print "You must specify a case"
+    raise SystemExit(1)
+
+Registry.Init()
+
+fsfd = FileSystem.DBFS(config.case)
+dbh = DB.DBO(config.case)
+dbh.execute("select inode_id from inode limit %s", config.count)
+headers = []
+for row in dbh:
+    try:
+        fd = fsfd.open(inode_id = row['inode_id'])
+        headers.append((row['inode_id'], fd.read(config.MAGIC_HEADER_SIZE)))
+        fd.close()
+    except (IOError, RuntimeError):
+        pass
+
+resolver = Magic.get_resolver()
+
+def classify(two_tier):
+    resolver.two_tier = two_tier
+    start = time.time()
+    for inode_id, data in headers:
+        max_score, scores = resolver.estimate_type(data, config.case, inode_id)
+
+    return time.time() - start
+
+## How many files the signatures decide on their own:
+decided = 0
+for inode_id, data in headers:
+    scores = dict([ (cls, 0) for cls in resolver.magic_handlers ])
+    if resolver.score_header(data[:config.MAGIC_HEADER_SIZE], scores, [0, None])[0] >= 100:
+        decided += 1
+
+print "Classifying %s files (%s decided by their header)" % (len(headers), decided)
+print "%14s %16s" % ("Resolver", "Files/s")
+for name, two_tier in (("all handlers", False), ("two tier", True)):
+    t = classify(two_tier)
+    print "%14s %16.1f" % (name, len(headers) / max(t, 1e-6))
@@ -33,6 +33,11 @@ IMPORTANT:
 The first time the database is used (in loading a case) the index will be automatically built. This may take a long time, but is only done once.
 
 You can build the index using the -i parameter.
+
+After loading, the NSRL hashes are also written to a sorted hash set
+file (see the NSRL_HASHSET option). MD5Scan checks this file before
+querying the database, so most files never need a query. Use -x to
+rewrite the hash set from the database without loading anything.
 """
 from optparse import OptionParser
 import DB,conf,sys
@@ -42,6 +47,8 @@ import pyflag.conf
 config=pyflag.conf.ConfObject()
 import gzip
 import pyflag.Registry as Registry
+import pyflag.HashSet as HashSet
+import struct
 
 config.set_usage(usage="""%prog path_to_nsrl_directory path_to_nsrl_directory
 
@@ -60,9 +67,18 @@ config.add_option('stats' , short_option='s', action='store_true',
                   default = False,
                   help = "Prints statistics about the NSRL database loaded")
 
+config.add_option('hashset', short_option='x', action='store_true',
+                  default = False,
+                  help = "Write the NSRL hash set file from the database instead")
+
+config.add_option('bloom_bits', default=10, type='int',
+                  help = "Bits per hash in the bloom filter of the hash set (0 for no bloom filter)")
+
 Registry.Init()
 config.parse_options()
 
+import plugins.DiskForensics.HashComparison as HashComparison
+
 try:
     dbh = DB.DBO(config.hashdb)
     ## Check for the tables
@@ -101,6 +117,40 @@ if config.index:
     print "Done!!"
     sys.exit(0)
 
+def sorted_hashes():
+    """ Yields the unique NSRL hashes in order.
+
+    We fetch the hashes one 2 byte prefix at the time (using the md5
+    index) so we never need to hold the whole table in memory.
+    """
+    for prefix in range(0x10000):
+        start = struct.pack(">H", prefix)
+        if prefix < 0xffff:
+            dbh.execute("select md5 from NSRL_hashes where md5 >= %b and md5 < %b",
+                        (start, struct.pack(">H", prefix + 1)))
+        else:
+            dbh.execute("select md5 from NSRL_hashes where md5 >= %b", start)
+
+        hashes = list(set([ row['md5'] for row in dbh ]))
+        hashes.sort()
+        for digest in hashes:
+            yield digest
+
+def WriteHashSet():
+    filename = HashComparison.hashset_filename()
+    print "Writing NSRL hash set to %s" % filename
+    dbh.check_index("NSRL_hashes","md5",4)
+    dbh.execute("select count(*) as c from NSRL_hashes")
+    count = dbh.fetch()['c']
+
+    written = HashSet.write_hashset(filename, sorted_hashes(), count,
+                                    config.bloom_bits)
+    print "Wrote %s hashes" % written
+
+if config.hashset:
+    WriteHashSet()
+    sys.exit(0)
+
 ## First do the main NSRL hash table
 def MainNSRLHash(dirname):
     try:
@@ -206,4 +256,6 @@ if __name__=="__main__":
             print "Unable to read main hash db, doing product table only"
             
         ProductTable(arg)    
-        print "You may wish to run this program with the -i arg to create indexes now. Otherwise indexes will be created the first time they are needed."
+
+    ## This also creates the md5 index:
+    WriteHashSet()
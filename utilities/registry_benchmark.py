@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures pyflag startup time.
+
+Use this program like so:
+
+>>> pyflag_launch registry_benchmark.py --runs 3
+
+Each run starts a new python process which initialises the registry
+(as pyflagsh, workers and utilities do). We time:
+
+ - cold: without a plugin manifest, so every plugin is imported.
+ - warm: with the manifest saved by the cold run.
+ - first use: using all the registries after a warm start, which
+   imports the plugins they need.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import sys, os, time, subprocess
+
+config.set_usage(usage="""%prog [options]
+
+Measures how long the registry takes to initialise.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('runs', default=3, type='int',
+                  help = "Number of times to run each test")
+
+config.add_option('child', default=None,
+                  help = "Run one test in this process (used internally)")
+
+config.parse_options()
+
+REGISTRIES = [ "REPORTS", "THEMES", "SCANNERS", "VFS_FILES", "LOG_DRIVERS",
+               "SHELL_COMMANDS", "FILESYSTEMS", "FILEFORMATS", "COLUMN_TYPES",
+               "TASKS", "CARVERS", "EVENT_HANDLERS", "IMAGES", "FILE_HANDLERS",
+               "PACKET_HANDLERS", "STATS_HANDLERS", "CASE_TABLES", "MAGIC_HANDLERS",
+               "TABLE_RENDERERS", "ACTIONS", "PRECANNED", "FSLOADERS", "GRAPHERS" ]
+
+if config.child:
+    if config.child == 'cold':
+        try:
+            os.unlink(Registry.manifest_filename())
+        except OSError:
+            pass
+
+    start = time.time()
+    Registry.Init()
+    if config.child == 'first use':
+        for name in REGISTRIES:
+            getattr(Registry, name).classes
+
+    print time.time() - start
+    sys.exit(0)
+
+def run(test):
+    p = subprocess.Popen([ sys.executable, sys.argv[0], "--child", test ],
+                         stdout = subprocess.PIPE)
+    output = p.communicate()[0]
+
+    return float(output.strip().splitlines()[-1])
+
+print "%12s %10s %10s" % ("Test", "Best (s)", "Worst (s)")
+for test in ("cold", "warm", "first use"):
+    times = []
+    for i in range(config.runs):
+        ## Each warm run needs a manifest:
+        if test != 'cold' and not os.access(Registry.manifest_filename(), os.F_OK):
+            run('cold')
+
+        times.append(run(test))
+
+    print "%12s %10.3f %10.3f" % (test, min(times), max(times))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how the scan pipeline scales with SCAN_THREADS.
+
+Use this program like so:
+
+>>> pyflag_launch scan_pipeline_benchmark.py --size 64 --threads 0 --threads 4
+
+We run a number of independent scanners (so they are all in the same
+stage) over a file held in memory, once for each number of threads,
+and report the throughput and the speedup over scanning serially
+(--threads 0). The file is not read from disk so only the scanners
+are measured, and we check that each run produces the same results.
+
+Scanners only run concurrently while they are in C code which
+releases the GIL (hashing and compressing large buffers do), so
+--python adds a scanner written in python which does not scale at
+all. Of course there is no speedup on a machine with a single CPU.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Scanner as Scanner
+import time, hashlib, zlib, random, os
+
+config.set_usage(usage="""%prog [options]
+
+Measures the speedup of the scan pipeline.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('size', default=64, type='int',
+                  help = "Size of the file in mb")
+
+config.add_option('buffer', default=1024, type='int',
+                  help = "Size of each buffer given to the scanners in kb")
+
+config.add_option('threads', default=[], action='append', type='int',
+                  help = "Number of threads to test (may be given more than once, default 0,1,2,4)")
+
+config.add_option('python', default=False, action='store_true',
+                  help = "Also run a scanner written in python")
+
+config.add_option('runs', default=3, type='int',
+                  help = "Number of times to run each test (the best is reported)")
+
+config.parse_options()
+
+class BenchmarkFactory:
+    order = 10
+    depends = []
+
+class HashScan:
+    """ A scanner like the hashing scanners """
+    inode = "benchmark"
+    ignore = False
+    outer = BenchmarkFactory()
+
+    def __init__(self, new):
+        self.hash = new()
+
+    def process(self, data, metadata=None):
+        self.hash.update(data)
+
+    def finish(self):
+        self.result = self.hash.hexdigest()
+
+class CompressScan(HashScan):
+    """ A scanner which compresses the file """
+    def __init__(self):
+        self.compressor = zlib.compressobj(1)
+        self.length = 0
+
+    def process(self, data, metadata=None):
+        self.length += len(self.compressor.compress(data))
+
+    def finish(self):
+        self.result = self.length + len(self.compressor.flush())
+
+class CountScan(HashScan):
+    """ A scanner in python which counts the newlines """
+    def __init__(self):
+        self.count = 0
+
+    def process(self, data, metadata=None):
+        for c in data:
+            if c == "\n":
+                self.count += 1
+
+    def finish(self):
+        self.result = self.count
+
+def scanners():
+    objs = [ HashScan(hashlib.md5), HashScan(hashlib.sha1),
+             HashScan(hashlib.sha256), CompressScan() ]
+    if config.python:
+        objs.append(CountScan())
+
+    return objs
+
+def scan(buffers, pipeline):
+    """ Scans the buffers like scanfile() does """
+    objs = scanners()
+    stages = Scanner.scan_stages(objs)
+
+    metadata = {}
+    start = time.time()
+    for data in buffers:
+        if pipeline:
+            pipeline.run(stages, "process", data, metadata=metadata)
+        else:
+            for o in objs:
+                Scanner.run_scanner(o, "process", data, metadata=metadata)
+
+    if pipeline:
+        pipeline.run(stages, "finish")
+    else:
+        for o in objs:
+            Scanner.run_scanner(o, "finish")
+
+    return time.time() - start, [ o.result for o in objs ]
+
+threads = config.threads or [0, 1, 2, 4]
+
+## Random data does not compress, so compressing takes as long as it can:
+block = "".join([ chr(random.randint(0, 255)) for i in range(config.buffer * 1024) ])
+buffers = [ block ] * (config.size * 1024 / config.buffer)
+size = len(block) * len(buffers)
+
+try:
+    cpus = os.sysconf("SC_NPROCESSORS_ONLN")
+except (ValueError, OSError, AttributeError):
+    cpus = "unknown"
+
+print "Scanning %s mb with %s scanners on %s cpus" % (size / 1024 / 1024, len(scanners()), cpus)
+print "%10s %12s %10s" % ("Threads", "MB/s", "Speedup")
+
+expected = None
+serial = None
+for t in threads:
+    if t:
+        pipeline = Scanner.ScanPipeline(t)
+    else:
+        pipeline = None
+
+    best = None
+    for i in range(config.runs):
+        elapsed, results = scan(buffers, pipeline)
+        if expected is None:
+            expected = results
+        elif results != expected:
+            raise RuntimeError("Scanning with %s threads gave different results" % t)
+
+        best = min(best or elapsed, elapsed)
+
+    if pipeline:
+        pipeline.stop()
+
+    if serial is None:
+        serial = best
+
+    print "%10s %12.1f %9.2fx" % (t, size / best / 1024 / 1024, serial / best)
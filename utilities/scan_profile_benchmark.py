@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the overhead of profiling scanners.
+
+Use this program like so:
+
+>>> pyflag_launch scan_profile_benchmark.py --files 10000 --size 16
+
+We run an md5 scanner (the cheapest scanner we have) over many small
+files with and without profiling, and report the overhead of the
+profiling counters. Small files are the worst case because the
+counters are updated for each call of a scanner's methods (only for
+one in SCAN_PROFILE_SAMPLE files). Times are in process CPU time so
+other load on the machine does not skew the result. We also
+report the overhead per file for each scanner, which should be
+compared to the cost of scanning a file in practice (scanfile()
+queries the database for every file, which takes much longer).
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Scanner as Scanner
+import time, hashlib, random
+
+config.set_usage(usage="""%prog [options]
+
+Measures the overhead of SCAN_PROFILE.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('files', default=10000, type='int',
+                  help = "Number of files to scan")
+
+config.add_option('size', default=16, type='int',
+                  help = "Size of each file in kb")
+
+config.add_option('runs', default=10, type='int',
+                  help = "Number of times to run each test")
+
+config.add_option('chunk', default=100, type='int',
+                  help = "Number of files to scan in each mode before "
+                  "switching to the other")
+
+config.parse_options()
+
+class MD5Factory:
+    pass
+
+class MD5Scan:
+    """ A scanner object like those made by the MD5 scanner """
+    case = "scan_profile_benchmark"
+    inode = "benchmark"
+    ignore = False
+    outer = MD5Factory()
+
+    def process(self, data, metadata=None):
+        self.md5.update(data)
+
+    def finish(self):
+        self.md5.hexdigest()
+
+def scan(data, profile, files):
+    start = time.clock()
+    o = MD5Scan()
+    metadata = {}
+    for i in range(files):
+        ## This is what scanfile() does for each file:
+        profiled = profile and Scanner.start_profile([o])
+
+        o.md5 = hashlib.md5()
+        Scanner.run_scanner(o, "process", data, metadata=metadata)
+        Scanner.run_scanner(o, "finish")
+        if profiled: Scanner.profile_files([o])
+
+    ## We do not have a case to write the counts to:
+    Scanner.PROFILE.pending = {}
+    return time.clock() - start
+
+data = "".join([ chr(random.randint(0, 255)) for i in range(config.size * 1024) ])
+
+## The files are scanned in chunks with and without profiling (in
+## random order) and we report the median of the ratios of each pair
+## so that changes in the load of the machine cancel out:
+totals = {False:0, True:0}
+ratios = []
+for i in range(config.runs):
+    for j in range(0, config.files, config.chunk):
+        files = min(config.chunk, config.files - j)
+        modes = [False, True]
+        random.shuffle(modes)
+        t = {}
+        for profile in modes:
+            t[profile] = scan(data, profile, files)
+            totals[profile] += t[profile]
+
+        if t[False] > 0:
+            ratios.append(t[True] / t[False])
+
+ratios.sort()
+ratio = ratios[len(ratios) / 2]
+
+print "%10s %12s" % ("Profile", "Files/s")
+for profile in (False, True):
+    print "%10s %12.0f" % (profile and "on" or "off",
+                           config.runs * config.files / totals[profile])
+
+print "Overhead %.2f%% (%.1f us per file)" % (
+    100.0 * (ratio - 1),
+    1e6 * (ratio - 1) * totals[False] / (config.runs * config.files))
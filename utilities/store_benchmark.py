@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" A micro benchmark for pyflag.Store.
+
+Use this program like so:
+
+>>> pyflag_launch store_benchmark.py --sizes 100,1000,10000,100000
+
+For each store size we fill a store, and then time random gets and
+puts on the full store. The time per operation should remain constant
+as the store grows.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Store as Store
+import random, time
+
+config.set_usage(usage="""%prog [options]
+
+Times Store operations for different store sizes.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('sizes', default='100,1000,10000,100000',
+                  help = "Comma seperated list of store sizes to test")
+
+config.add_option('operations', default=100000, type='int',
+                  help = "Number of operations to time for each size")
+
+config.parse_options()
+
+def time_operations(size):
+    s = Store.Store(max_size=size, age=3600)
+    keys = [ s.put(i) for i in range(size) ]
+
+    lookups = [ random.choice(keys) for i in range(config.operations) ]
+    start = time.time()
+    for key in lookups:
+        s.get(key)
+    get_time = time.time() - start
+
+    ## Each put on a full store also evicts the oldest object:
+    start = time.time()
+    for i in range(config.operations):
+        s.put(i)
+    put_time = time.time() - start
+
+    return get_time, put_time
+
+print "%10s %12s %12s" % ("Size", "get (us)", "put (us)")
+for size in config.sizes.split(","):
+    size = int(size)
+    get_time, put_time = time_operations(size)
+    print "%10s %12.2f %12.2f" % (size,
+                                  get_time * 1e6 / config.operations,
+                                  put_time * 1e6 / config.operations)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures how long a gallery page of thumbnails takes to render.
+
+Use this program like so:
+
+>>> pyflag_launch thumbnail_benchmark.py --case demo --pagesize 100
+
+We take the first pagesize images in the case (as found by the
+TypeScan scanner) and make their thumbnails as the gallery renderer
+does for a page:
+
+ - cold: the thumbnail cache is empty, so each image is decoded and
+   scaled (this is what happened on every view before).
+ - warm: the thumbnails are read from the cache.
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Registry as Registry
+import pyflag.DB as DB
+import pyflag.FileSystem as FileSystem
+import pyflag.Graph as Graph
+import os, time
+
+config.set_usage(usage="""%prog [options]
+
+Times rendering a gallery page with and without cached thumbnails.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('case', default=None,
+                  help = "Case to take images from")
+
+config.add_option('pagesize', default=100, type='int',
+                  help = "Number of images on the page")
+
+config.add_option('runs', default=3, type='int',
+                  help = "Number of times to render the warm page")
+
+config.parse_options()
+
+if not config.case:
+    print "You must specify a case"
+    raise SystemExit(1)
+
+Registry.Init()
+
+dbh = DB.DBO(config.case)
+dbh.execute("select inode_id from type where mime like 'image/%%' limit %s",
+            config.pagesize)
+inode_ids = [ row['inode_id'] for row in dbh ]
+fsfd = FileSystem.DBFS(config.case)
+
+def render_page():
+    start = time.time()
+    for inode_id in inode_ids:
+        fd = fsfd.open(inode_id = inode_id)
+        Graph.Thumbnailer(fd, Graph.THUMBNAIL_SIZE).display()
+
+    return time.time() - start
+
+## Make sure we start cold:
+for inode_id in inode_ids:
+    try:
+        os.unlink(Graph.thumbnail_filename(config.case, inode_id, Graph.THUMBNAIL_SIZE))
+    except OSError:
+        pass
+
+print "Rendering a page of %s images" % len(inode_ids)
+print "%10s %12s %14s" % ("Cache", "Page (ms)", "Image (ms)")
+
+results = [ ("cold", render_page()) ]
+for i in range(config.runs):
+    results.append(("warm", render_page()))
+
+for name, t in results:
+    print "%10s %12.1f %14.2f" % (name, t * 1000, t * 1000 / max(1, len(inode_ids)))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# ******************************************************
+#  Version: FLAG $Version: 0.87-pre1 Date: Thu Jun 12 00:48:38 EST 2008$
+# ******************************************************
+#
+# * This program is free software; you can redistribute it and/or
+# * modify it under the terms of the GNU General Public License
+# * as published by the Free Software Foundation; either version 2
+# * of the License, or (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+# ******************************************************
+""" Measures the rate of date conversions for common date formats.
+
+Use this program like so:
+
+>>> pyflag_launch time_benchmark.py --count 10000 --case demo
+
+For each format we report the conversions per second of:
+
+ - uncached: dateutil, looking up the case timezone each time (as
+   Time.parse used to). This is only measured if a case is given.
+ - dateutil: dateutil with the cached case timezone.
+ - fast: the fast date parser (Time.DateParser).
+"""
+import pyflag.conf
+config=pyflag.conf.ConfObject()
+import pyflag.Time as Time
+import time
+
+config.set_usage(usage="""%prog [options]
+
+Measures the rate of date conversions for common date formats.""",
+                 version="Version: %prog PyFlag "+str(config.VERSION))
+
+config.add_option('count', default=10000, type='int',
+                  help = "Number of dates to convert for each format")
+
+config.add_option('case', default=None,
+                  help = "Case to take the timezone from (If not given we convert to UTC and do not measure uncached conversions)")
+
+config.parse_options()
+
+DATES = [ ("Apache", "10/Oct/2000:13:55:36 -0700"),
+          ("RFC 1123", "Sun, 06 Nov 1994 08:49:37 GMT"),
+          ("asctime", "Sun Nov  6 08:49:37 1994"),
+          ("IIS", "2008-06-12 00:48:38"),
+          ("ISO 8601", "2008-06-12T00:48:38Z"),
+          ]
+
+case = config.case or "time_benchmark"
+
+def rate(parser, date, flush=False):
+    start = time.time()
+    for i in range(config.count):
+        if flush:
+            Time.flush_case_tz()
+
+        try:
+            parser.parse(date)
+        except ValueError:
+            return None
+
+    return config.count / (time.time() - start)
+
+def format_rate(r):
+    if r is None:
+        return "%16s" % "failed"
+
+    return "%16.0f" % r
+
+print "%10s %16s %16s %16s" % ("Format", "Uncached (/s)", "Dateutil (/s)", "Fast (/s)")
+for name, date in DATES:
+    Time.flush_case_tz()
+    if config.case:
+        uncached = format_rate(rate(Time.DateParser(case, "UTC", fast=False), date, flush=True))
+    else:
+        uncached = "%16s" % '-'
+        ## We do not have a case to ask:
+        Time.CASE_TZ[case] = (time.time() + 3600, "UTC")
+
+    print "%10s %s %s %s" % (name, uncached,
+                             format_rate(rate(Time.DateParser(case, "UTC", fast=False), date)),
+                             format_rate(rate(Time.DateParser(case, "UTC"), date)))
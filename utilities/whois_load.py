@@ -46,12 +46,27 @@ config.optparser.add_option('-d','--delete', action="store_true",
 config.optparser.add_option('-a','--all', action="store_true",
                   help="""Load all repositories""")
 
+config.optparser.add_option('-s','--snapshot', action="store_true",
+                  help="""Only write the whois routes snapshot (WHOIS_ROUTES) from the database""")
+
 for k in urls.keys():
   config.optparser.add_option('','--%s' % k, action="store_true",
                     help = "Load %s databases" % k)
 
 config.parse_options()
 
+def write_snapshot(dbh):
+  ## Whois lookups use a radix tree of the routes (see
+  ## Whois.get_routes()):
+  import plugins.LogAnalysis.Whois as Whois
+
+  print "Writing whois routes to %s" % Whois.routes_filename()
+  Whois.write_routes(dbh)
+
+if config.snapshot:
+  write_snapshot(DB.DBO(None))
+  sys.exit(0)
+
 if config.all:
   for k in urls.keys():
     setattr(config, k, 1)
@@ -416,6 +431,12 @@ for k,url in urls.items():
         network = network + num_hosts(masks[align[0]])
         del masks[align[0]]
 
+source_dbh.mass_insert_commit()
+routes_dbh.mass_insert_commit()
+dbh.mass_insert_commit()
+
+write_snapshot(dbh)
+
 # add indexes
 #dbh.check_index("whois_routes","network")
 #dbh.check_index("whois_routes","netmask")